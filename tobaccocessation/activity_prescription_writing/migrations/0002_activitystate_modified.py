@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activity_prescription_writing', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activitystate',
+            name='modified',
+            field=models.DateTimeField(auto_now=True,
+                                       default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -4,7 +4,9 @@ from django import forms
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericRelation
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
 from django.utils.encoding import python_2_unicode_compatible, smart_text
 from pagetree.models import PageBlock
 
@@ -26,6 +28,29 @@ class Medication(models.Model):
     def __str__(self):
         return "%s" % (self.name)
 
+    @classmethod
+    def rx_counts(cls):
+        """{name: rx_count}, cached until a medication changes. A name
+        used twice counts as its first medication, as Block.medication
+        orders them."""
+        counts = cache.get(RX_COUNTS_KEY)
+        if counts is None:
+            counts = dict(cls.objects.order_by('-id').values_list(
+                'name', 'rx_count'))
+            cache.set(RX_COUNTS_KEY, counts, None)
+        return counts
+
+
+RX_COUNTS_KEY = "activity_prescription_writing.rx_counts"
+
+
+def medication_changed(sender, *args, **kwargs):
+    cache.delete(RX_COUNTS_KEY)
+
+
+post_save.connect(medication_changed, sender=Medication)
+post_delete.connect(medication_changed, sender=Medication)
+
 
 @python_2_unicode_compatible
 class Block(models.Model):
@@ -38,6 +63,10 @@ class Block(models.Model):
     css_template_file = "activity_prescription_writing/prescription_css.html"
     display_name = "Activity: Prescription Writing"
 
+    # each prescription the medication needs is these fields, suffixed
+    # with _2, _3... after the first
+    RX_FIELDS = ['dosage', 'disp', 'sig', 'refills']
+
     def pageblock(self):
         return self.pageblocks.all()[0]
 
@@ -73,48 +102,41 @@ class Block(models.Model):
         return True
 
     def clear_user_submissions(self, user):
-        try:
-            state = ActivityState.objects.get(user=user, block=self)
-            obj = json.loads(state.json)
-            obj[self.medication_name] = {}
-            state.json = json.dumps(obj)
-            state.save()
-        except ActivityState.DoesNotExist:
-            pass  # calling reset before they've done anything
+        if ActivityState.objects.filter(user=user, block=self).exists():
+            state = ActivityState.update_medication(
+                self, user, self.medication_name, {})
+            ActivityState.cache_for_user(user, state)
+        # else calling reset before they've done anything
 
     def submit(self, user, data):
-        state = ActivityState.get_for_user(self, user)
-        obj = json.loads(state.json)
-        obj[self.medication_name] = {}
-
-        for key, value in data.items():
-            obj[self.medication_name][key] = value
-        state.json = json.dumps(obj)
-        state.save()
-
-    def unlocked(self, user):
-        unlock = False
-        state = ActivityState.get_for_user(self, user)
-        obj = json.loads(state.json)
-
-        if self.medication_name in obj:
-            d = obj[self.medication_name]
-            if self.medication()[0].rx_count == 1:
-                unlock = 'dosage' in d and len(d['dosage']) > 0 and \
-                    'disp' in d and len(d['disp']) > 0 and \
-                    'sig' in d and len(d['sig']) > 0 and \
-                    'refills' in d and len(d['refills']) > 0
-            else:
-                unlock = 'dosage' in d and len(d['dosage']) > 0 and \
-                    'disp' in d and len(d['disp']) > 0 and \
-                    'sig' in d and len(d['sig']) > 0 and \
-                    'refills' in d and len(d['refills']) > 0 and \
-                    'dosage_2' in d and len(d['dosage_2']) > 0 and \
-                    'disp_2' in d and len(d['disp_2']) > 0 and \
-                    'sig_2' in d and len(d['sig_2']) > 0 and \
-                    'refills_2' in d and len(d['refills_2']) > 0
-
-        return unlock
+        state = ActivityState.update_medication(
+            self, user, self.medication_name, dict(data.items()))
+        ActivityState.cache_for_user(user, state)
+
+    def rx_count(self):
+        if not hasattr(self, '_rx_count'):
+            self._rx_count = Medication.rx_counts().get(
+                self.medication_name, 1)
+        return self._rx_count
+
+    def required_fields(self):
+        fields = list(self.RX_FIELDS)
+        for n in range(2, self.rx_count() + 1):
+            fields += ['%s_%d' % (f, n) for f in self.RX_FIELDS]
+        return fields
+
+    def complete(self, answers):
+        """every field of every prescription is filled in"""
+        return all([len(answers.get(f, '')) > 0
+                    for f in self.required_fields()])
+
+    def unlocked(self, user, state=None):
+        """state may be passed in if the caller has already loaded it"""
+        if state is None:
+            state = ActivityState.cached_for_user(self, user)
+
+        answers = state.data.get(self.medication_name)
+        return answers is not None and self.complete(answers)
 
 
 class PrescriptionBlockForm(forms.ModelForm):
@@ -128,6 +150,7 @@ class ActivityState (models.Model):
                              on_delete=models.CASCADE)
     block = models.ForeignKey(Block, on_delete=models.CASCADE)
     json = models.TextField(blank=True)
+    modified = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = (("user", "block"),)
@@ -135,18 +158,93 @@ class ActivityState (models.Model):
     def loads(self):
         return json.loads(self.json)
 
+    @property
+    def data(self):
+        """the decoded json, decoded once. Use loads() for a copy to
+        change."""
+        if not hasattr(self, '_data'):
+            self._data = self.loads()
+        return self._data
+
     @classmethod
-    def get_for_user(cls, block, user):
-        state, created = ActivityState.objects.get_or_create(user=user,
-                                                             block=block)
-        if created:
-            obj = {}
-            for m in Medication.objects.all():
-                obj[m.name] = {}
+    def blank(cls, block, user):
+        """An empty, unsaved state for the user"""
+        return ActivityState(user=user, block=block, json=json.dumps({}))
 
-            state.json = json.dumps(obj)
-            state.save()
+    @classmethod
+    def initial_json(cls):
+        obj = {}
+        for m in Medication.objects.all():
+            obj[m.name] = {}
+        return json.dumps(obj)
 
+    @classmethod
+    def provision(cls, users):
+        """Create the users' missing states for every block in one
+        insert, e.g. when they enroll"""
+        initial = cls.initial_json()
+        blocks = list(Block.objects.all())
+        cls.objects.bulk_create(
+            [ActivityState(user=user, block=block, json=initial)
+             for user in users for block in blocks],
+            batch_size=500, ignore_conflicts=True)
+
+    @classmethod
+    def lookup(cls, block, user):
+        """The user's stored state, or a blank one. Never saves."""
+        state = ActivityState.objects.filter(user=user, block=block).first()
+        if state is None:
+            state = cls.blank(block, user)
+        return state
+
+    @classmethod
+    def cached_for_user(cls, block, user):
+        """
+        The user's state for the block. All their states are looked up
+        in one query the first time, and kept for as long as the user
+        object lives, which for request.user is the request. Never saves.
+        """
+        if '_prescription_states' not in user.__dict__:
+            user.__dict__['_prescription_states'] = dict([
+                (s.block_id, s)
+                for s in ActivityState.objects.filter(user=user)])
+
+        states = user.__dict__['_prescription_states']
+        if block.id not in states:
+            states[block.id] = cls.blank(block, user)
+        return states[block.id]
+
+    @classmethod
+    def cache_for_user(cls, user, state):
+        """make state the one cached_for_user returns, e.g. after a write"""
+        if '_prescription_states' in user.__dict__:
+            user.__dict__['_prescription_states'][state.block_id] = state
+
+    @classmethod
+    def get_for_user(cls, block, user, lock=False):
+        """lock the row until the end of the transaction, on databases
+        that support it. Creates the state if it wasn't provisioned."""
+        states = ActivityState.objects
+        if lock:
+            states = states.select_for_update()
+        state, created = states.get_or_create(
+            user=user, block=block,
+            defaults={'json': cls.initial_json()})
+        return state
+
+    @classmethod
+    def update_medication(cls, block, user, medication_name, value):
+        """
+        Atomically replace one medication's answers in the user's state.
+        The state is re-read under a row lock, so a concurrent submit
+        can't overwrite the other medications with what it read earlier.
+        """
+        with transaction.atomic():
+            state = cls.get_for_user(block, user, lock=True)
+            obj = state.loads()
+            obj[medication_name] = value
+            state.json = json.dumps(obj)
+            state.save(update_fields=['json', 'modified'])
         return state
 
 
@@ -156,6 +254,7 @@ class PrescriptionColumn(object):
         self.block = block
         self.medication = medication
         self.field = field
+        self._prefetched = None
 
     def key_row(self):
         return [self.identifier(),
@@ -168,20 +267,44 @@ class PrescriptionColumn(object):
         return "%s_%s_%s" % (
             self.hierarchy.id, self.medication.id, self.field)
 
-    def user_value(self, user):
+    def user_state(self, user):
+        if self._prefetched is not None:
+            return self._prefetched.get((self.block.id, user.id))
+
         try:
-            state = ActivityState.objects.get(
-                block=self.block,
-                user=user).loads()
-            if (self.medication.name in state and
-                    self.field in state[self.medication.name]):
-                return state[self.medication.name][self.field]
-            state[self.medication.name]
+            return ActivityState.objects.get(
+                block=self.block, user=user).loads()
         except ActivityState.DoesNotExist:
-            pass
+            return None
+
+    def user_value(self, user):
+        state = self.user_state(user)
+        if (state is not None and
+                self.medication.name in state and
+                self.field in state[self.medication.name]):
+            return state[self.medication.name][self.field]
 
         return ''
 
+    @classmethod
+    def prefetch(cls, columns, users):
+        """
+        Load & decode the prescription states for a page of users
+        in a single query, shared by all the given columns.
+        """
+        block_ids = set([c.block.id for c in columns])
+        if len(block_ids) == 0:
+            return
+
+        data = {}
+        states = ActivityState.objects.filter(
+            block__id__in=block_ids, user__in=users)
+        for state in states:
+            data[(state.block_id, state.user_id)] = state.loads()
+
+        for column in columns:
+            column._prefetched = data
+
     @classmethod
     def all(cls, hrchy, section, key_only=True):
         columns = []
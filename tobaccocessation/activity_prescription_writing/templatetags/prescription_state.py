@@ -12,12 +12,13 @@ class GetPrescription(template.Node):
         b = context[self.block]
         u = context['request'].user
 
-        state = ActivityState.get_for_user(b, u).loads()
+        stored = ActivityState.cached_for_user(b, u)
+        state = stored.loads()
 
         if b.medication_name in state.keys():
             state = state[b.medication_name]
 
-        state['complete'] = b.unlocked(u)
+        state['complete'] = b.unlocked(u, stored)
         context[self.var_name] = state
         return ''
 
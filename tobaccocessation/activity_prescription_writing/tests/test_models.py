@@ -1,18 +1,23 @@
 from __future__ import unicode_literals
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import TestCase
 from django.test.client import RequestFactory, Client
 from django.utils.encoding import smart_text
 from pagetree.helpers import get_section_from_path
 from pagetree.models import Hierarchy
-from tobaccocessation.activity_prescription_writing.models import Block, \
-    Medication, PrescriptionColumn
+from tobaccocessation.activity_prescription_writing.models import \
+    ActivityState, Block, Medication, PrescriptionColumn, RX_COUNTS_KEY
 
 
 class TestBlock(TestCase):
     fixtures = ['prescriptionwriting.json']
 
+    def setUp(self):
+        # rolling back another test's edits doesn't send signals
+        cache.delete(RX_COUNTS_KEY)
+
     def test_medication(self):
         med = Medication.objects.create(name="something",
                                         dosage="dosage",
@@ -181,6 +186,56 @@ class TestBlock(TestCase):
         self.assertTrue(varenicline2.unlocked(user))
         self.assertFalse(patch.unlocked(user))
 
+    def test_required_fields(self):
+        block = Block(medication_name='Nicotine Patch')
+        self.assertEquals(block.required_fields(),
+                          ['dosage', 'disp', 'sig', 'refills'])
+
+        Medication.objects.filter(name='Nicotine Patch').update(rx_count=3)
+        cache.delete(RX_COUNTS_KEY)  # update() doesn't send post_save
+        block = Block(medication_name='Nicotine Patch')
+        self.assertEquals(len(block.required_fields()), 12)
+        self.assertEquals(block.required_fields()[-4:],
+                          ['dosage_3', 'disp_3', 'sig_3', 'refills_3'])
+
+        self.assertFalse(block.complete({'dosage': '1', 'disp': '2',
+                                         'sig': '3', 'refills': '4'}))
+        self.assertTrue(block.complete(dict(
+            [(f, 'x') for f in block.required_fields()])))
+
+    def test_unlocked_cached(self):
+        user = User.objects.create(username="test")
+        patch = Block.objects.create(medication_name='Nicotine Patch')
+        varenicline = Block.objects.create(medication_name='Varenicline')
+        patch.submit(user, {'dosage': '21mg', 'disp': '28 patches',
+                            'sig': 'one daily', 'refills': '1'})
+
+        user = User.objects.get(id=user.id)
+        Medication.rx_counts()
+        # the user's states, then nothing
+        with self.assertNumQueries(1):
+            self.assertTrue(patch.unlocked(user))
+        with self.assertNumQueries(0):
+            self.assertFalse(varenicline.unlocked(user))
+            self.assertTrue(patch.unlocked(user))
+
+        # renaming invalidates the counts
+        Medication.objects.filter(name='Varenicline').first().save()
+        self.assertIsNone(cache.get(RX_COUNTS_KEY))
+
+    def test_update_medication(self):
+        user = User.objects.create(username="test")
+        block = Block.objects.create(medication_name='Varenicline')
+        block.submit(user, {'dosage': '0.5mg'})
+
+        # a submit that read the state earlier keeps the other medications
+        state = ActivityState.update_medication(
+            block, user, 'Nicotine Patch', {'dosage': '21mg'})
+        self.assertEquals(state.loads()['Varenicline'], {'dosage': '0.5mg'})
+        self.assertEquals(
+            ActivityState.objects.get(user=user, block=block).loads()[
+                'Nicotine Patch'], {'dosage': '21mg'})
+
 
 class TestPrescriptionColumn(TestCase):
     fixtures = ['prescriptionwriting.json']
@@ -291,3 +346,22 @@ class TestPrescriptionColumn(TestCase):
         self.assertEquals(columns[5].field, "disp_2")
         self.assertEquals(columns[6].field, "sig_2")
         self.assertEquals(columns[7].field, "refills_2")
+
+    def test_prefetch(self):
+        medication_name = 'Nicotine Patch'
+        med = Medication.objects.get(name=medication_name)
+        block = self.create_block(self.section, medication_name)
+        columns = [PrescriptionColumn(self.hierarchy, block, med, "sig"),
+                   PrescriptionColumn(self.hierarchy, block, med, "refills")]
+
+        block.submit(self.user, {'sig': 'instructions go here'})
+        other = User.objects.create_user('other', 'other@ccnmtl.com', 'test')
+
+        with self.assertNumQueries(1):
+            PrescriptionColumn.prefetch(columns, [self.user, other])
+
+        with self.assertNumQueries(0):
+            self.assertEquals(columns[0].user_value(self.user),
+                              'instructions go here')
+            self.assertEquals(columns[1].user_value(self.user), '')
+            self.assertEquals(columns[0].user_value(other), '')
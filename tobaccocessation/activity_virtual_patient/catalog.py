@@ -0,0 +1,157 @@
+"""
+Read-mostly catalog of the virtual patient reference data.
+
+Medications, their concentration, dosage & refill choices, treatment
+classifications, options and feedback are tiny tables that only change
+when an admin edits them. Each process loads them once, indexed by id,
+tag & patient. Edits bump a version token in the cache, which every
+process checks before reusing its copy, so all workers reload together.
+
+Catalog objects are shared. Copy them before setting attributes.
+"""
+from tobaccocessation.main import versions
+
+
+VERSION_KEY = "activity_virtual_patient.catalog.version"
+
+_catalog = None  # for this process
+
+
+class Catalog(object):
+
+    def __init__(self, medications, concentrations, dosages, refills,
+                 classifications, options, feedback):
+        self.medications = medications  # in display order
+        self.medication = dict([(m.id, m) for m in medications])
+        self.by_tag = {}
+        for med in medications:
+            self.by_tag.setdefault(med.tag, []).append(med)
+
+        self.concentration = dict([(c.id, c) for c in concentrations])
+        self.dosage = dict([(d.id, d) for d in dosages])
+        self.refill = dict([(r.id, r) for r in refills])
+
+        # medication id -> its correct choice
+        self.correct_concentration = dict([
+            (c.medication_id, c) for c in concentrations if c.correct])
+        self.correct_dosage = dict([
+            (d.medication_id, d) for d in dosages if d.correct])
+
+        self.classifications = classifications  # by rank
+        self.classification = dict([(c.id, c) for c in classifications])
+
+        self.options = {}  # patient id -> treatment options
+        for option in options:
+            option.classification = self.classification[
+                option.classification_id]
+            option.medication_one = self.medication[option.medication_one_id]
+            if option.medication_two_id is not None:
+                option.medication_two = self.medication[
+                    option.medication_two_id]
+            self.options.setdefault(option.patient_id, []).append(option)
+
+        # patient id -> the medications in its options, plus combination
+        self.treatments = dict([
+            (patient_id, self.option_medications(options))
+            for (patient_id, options) in self.options.items()])
+
+        for fb in feedback:
+            fb.classification = self.classification[fb.classification_id]
+
+        # patient id -> {decision key -> TreatmentFeedback}
+        self.decisions = {}
+        for patient_id, options in self.options.items():
+            self.decisions[patient_id] = self.decision_table(
+                options, [f for f in feedback if f.patient_id == patient_id])
+
+    def option_medications(self, options):
+        meds = set(self.medications_for_tag("combination"))
+        for option in options:
+            meds.add(option.medication_one)
+            if option.medication_two is not None:
+                meds.add(option.medication_two)
+        return sorted(meds, key=lambda m: (m.display_order, m.id))
+
+    def decision_table(self, options, feedback):
+        """
+        Compile a patient's treatment options & feedback into a table
+        keyed by (medication ids, correct rx, combination), as
+        PatientAssessmentBlock.feedback looks them up. The medication ids
+        are every medication with the option's tags, since those are the
+        choices a student prescribing it fills in.
+        """
+        table = {}
+        for option in options:
+            tags = set([option.medication_one.tag])
+            if option.medication_two is not None:
+                tags.add(option.medication_two.tag)
+            combination = len(tags) == 2
+            ids = frozenset([m.id for tag in tags
+                             for m in self.medications_for_tag(tag)])
+
+            for correct_rx in [True, False]:
+                if option.classification.rank == 1:
+                    # for the best, factor in correct dosage
+                    matches = [f for f in feedback
+                               if f.classification_id ==
+                               option.classification_id and
+                               f.correct_dosage == correct_rx]
+                else:
+                    # for ineffective + harmful factor in combination
+                    matches = [f for f in feedback
+                               if f.classification_id ==
+                               option.classification_id and
+                               f.combination_therapy == combination]
+
+                key = (ids, correct_rx, combination)
+                if len(matches) == 1 and key not in table:
+                    table[key] = matches[0]
+        return table
+
+    def decide(self, patient_id, medication_ids, correct_rx, combination):
+        """the TreatmentFeedback for a prescription, or None"""
+        key = (frozenset(medication_ids), correct_rx, combination)
+        return self.decisions.get(patient_id, {}).get(key)
+
+    @classmethod
+    def build(cls):
+        from tobaccocessation.activity_virtual_patient.models import \
+            ConcentrationChoice, DosageChoice, Medication, RefillChoice, \
+            TreatmentClassification, TreatmentFeedback, TreatmentOption
+
+        return cls(list(Medication.objects.order_by('display_order', 'id')),
+                   list(ConcentrationChoice.objects.order_by(
+                       'display_order', 'id')),
+                   list(DosageChoice.objects.order_by('display_order', 'id')),
+                   list(RefillChoice.objects.order_by('display_order', 'id')),
+                   list(TreatmentClassification.objects.order_by('rank')),
+                   list(TreatmentOption.objects.order_by('id')),
+                   list(TreatmentFeedback.objects.order_by('id')))
+
+    def medications_for_tag(self, tag):
+        return self.by_tag.get(tag, [])
+
+    def patient_treatments(self, patient_id):
+        if patient_id not in self.treatments:
+            # a patient without options is only offered combination
+            return self.medications_for_tag("combination")
+        return self.treatments[patient_id]
+
+
+def get_version():
+    return versions.get_version(VERSION_KEY)
+
+
+def invalidate():
+    versions.bump(VERSION_KEY)
+
+
+def get_catalog():
+    global _catalog
+
+    version = get_version()
+    if _catalog is None or _catalog.version != version:
+        catalog = Catalog.build()
+        catalog.version = version
+        _catalog = catalog
+    return _catalog
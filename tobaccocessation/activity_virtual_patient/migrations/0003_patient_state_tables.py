@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill(apps, schema_editor):
+    """Copy each ActivityState's patients into the normalized tables. The
+    json is left as it is, so the tables can be switched on later."""
+    ActivityState = apps.get_model('activity_virtual_patient',
+                                   'ActivityState')
+    Patient = apps.get_model('activity_virtual_patient', 'Patient')
+    Medication = apps.get_model('activity_virtual_patient', 'Medication')
+    PatientTreatmentState = apps.get_model('activity_virtual_patient',
+                                           'PatientTreatmentState')
+    PatientRxState = apps.get_model('activity_virtual_patient',
+                                    'PatientRxState')
+
+    patient_ids = set(Patient.objects.values_list('id', flat=True))
+    medication_ids = set(Medication.objects.values_list('id', flat=True))
+
+    for state in ActivityState.objects.all().iterator():
+        patients = json.loads(state.json).get('patients', {})
+        for patient_id, data in patients.items():
+            if int(patient_id) not in patient_ids:
+                continue
+
+            for tag, value in data.items():
+                treatment = PatientTreatmentState.objects.create(
+                    user_id=state.user_id, hierarchy_id=state.hierarchy_id,
+                    patient_id=patient_id, tag=tag,
+                    classification=value.get('classification'),
+                    prescribe='prescribe' in value,
+                    combination='combination' in value)
+
+                PatientRxState.objects.bulk_create([
+                    PatientRxState(treatment=treatment,
+                                   medication_id=med_id,
+                                   concentration=rx.get('concentration'),
+                                   dosage=rx.get('dosage'))
+                    for (med_id, rx) in value.get('rx', {}).items()
+                    if int(med_id) in medication_ids])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pagetree', '0002_delete_testblock'),
+        ('activity_virtual_patient', '0002_auto_20150612_1525'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientTreatmentState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True,
+                                        serialize=False, verbose_name='ID')),
+                ('tag', models.CharField(max_length=25)),
+                ('classification', models.CharField(
+                    blank=True, max_length=25, null=True)),
+                ('prescribe', models.BooleanField(default=False)),
+                ('combination', models.BooleanField(default=False)),
+                ('hierarchy', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    to='pagetree.Hierarchy')),
+                ('patient', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    to='activity_virtual_patient.Patient')),
+                ('user', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': set([
+                    ('user', 'hierarchy', 'patient', 'tag')]),
+            },
+        ),
+        migrations.CreateModel(
+            name='PatientRxState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True,
+                                        serialize=False, verbose_name='ID')),
+                ('concentration', models.CharField(
+                    blank=True, max_length=50, null=True)),
+                ('dosage', models.CharField(
+                    blank=True, max_length=50, null=True)),
+                ('medication', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    to='activity_virtual_patient.Medication')),
+                ('treatment', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    related_name='rx',
+                    to='activity_virtual_patient.PatientTreatmentState')),
+            ],
+            options={
+                'unique_together': set([('treatment', 'medication')]),
+            },
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activity_virtual_patient', '0003_patient_state_tables'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activitystate',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
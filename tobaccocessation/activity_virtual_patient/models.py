@@ -1,15 +1,18 @@
 from django import forms
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericRelation
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible, smart_text
-from django.db.models.query_utils import Q
-from django.db.models.signals import pre_save, post_init
-from django.dispatch.dispatcher import receiver
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch.dispatcher import Signal, receiver
+from copy import copy
 import json
 from operator import itemgetter
 from pagetree.models import PageBlock, Hierarchy
+from tobaccocessation.activity_virtual_patient import catalog
 
 
 @python_2_unicode_compatible
@@ -67,11 +70,13 @@ class Patient(models.Model):
         return "%s. %s" % (self.display_order, self.name)
 
     def treatments(self):
-        qs = Medication.objects.filter(
-            Q(medication_one__patient__id=self.id) |
-            Q(medication_two__patient__id=self.id) |
-            Q(tag="combination")).distinct().order_by("display_order")
-        return qs
+        """
+        The medications in the patient's treatment options, plus
+        combination therapy, in display order. Read from the catalog,
+        as copies, since callers annotate them.
+        """
+        return [copy(m) for m in
+                catalog.get_catalog().patient_treatments(self.id)]
 
     def appropriate_treatment_options(self):
         return self.treatmentoptionreasoning_set.filter(classification__rank=1)
@@ -153,56 +158,475 @@ class TreatmentFeedback(models.Model):
             (self.patient, self.classification.description)
 
 
+def reference_data_changed(sender, *args, **kwargs):
+    catalog.invalidate()
+
+
+for model in [Medication, ConcentrationChoice, DosageChoice, RefillChoice,
+              TreatmentClassification, TreatmentOption, TreatmentFeedback]:
+    post_save.connect(reference_data_changed, sender=model)
+    post_delete.connect(reference_data_changed, sender=model)
+
+
+def state_tables():
+    """
+    When VIRTUAL_PATIENT_STATE_TABLES is on, patient state is kept in
+    PatientTreatmentState & PatientRxState rows rather than in the
+    ActivityState json. States written before the switch are read from
+    their json until the next write moves them into the tables.
+
+    The switch is one way. Once on, writes empty the json, and only the
+    tables hold those patients. Turning it back off would lose them.
+    """
+    return getattr(settings, 'VIRTUAL_PATIENT_STATE_TABLES', False)
+
+
+# sent with user, hierarchy & patient_id when a user's patient state is
+# written or cleared
+patient_state_changed = Signal(
+    providing_args=['user', 'hierarchy', 'patient_id'])
+
+
+class StaleActivityState(Exception):
+    """the state was written by someone else since it was read"""
+    pass
+
+
 class ActivityState (models.Model):
+    # times update_patient re-reads a state that changed under it
+    UPDATE_ATTEMPTS = 3
+
     user = models.ForeignKey(User,
                              related_name="virtual_patient_user",
                              on_delete=models.CASCADE)
     hierarchy = models.ForeignKey(Hierarchy, on_delete=models.CASCADE)
     json = models.TextField()
+    # bumped on every write, keys the results memoized for the state
+    version = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField(auto_now=True)
+
+    _data = None
+    _memo = None
+    _changed = False
+    _from_json = False
+    # every patient with rows has been loaded into data
+    complete = False
 
     class Meta:
         unique_together = (("user", "hierarchy"),)
 
+    @property
+    def data(self):
+        """The decoded json. Decoded on first use, so states that are
+        only listed or deleted never pay for it."""
+        if self._data is None:
+            self._data = json.loads(self.json)
+            self._from_json = (self.tables and
+                               len(self._data['patients']) > 0)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._changed = True
+
+    @property
+    def tables(self):
+        return state_tables()
+
+    @property
+    def from_json(self):
+        """patients are still held in the json rather than the tables"""
+        return self.data is not None and self._from_json
+
+    def encode(self):
+        """re-serialize the json, only if the data was changed"""
+        if not self._changed:
+            return
+
+        data = self.data
+        if self.tables:
+            data = dict(data, patients={})
+        self.json = json.dumps(data)
+        self._changed = False
+
+    @classmethod
+    def blank(cls, user, hierarchy):
+        """An empty, unsaved state for the user"""
+        # setup the template
+        state = {}
+        state['patients'] = {}
+        return ActivityState(user=user, hierarchy=hierarchy,
+                             json=json.dumps(state))
+
+    @classmethod
+    def lookup(cls, user, hierarchy):
+        """The user's stored state, or a blank one. Never saves."""
+        state = ActivityState.objects.filter(
+            user=user, hierarchy=hierarchy).first()
+        if state is None:
+            state = cls.blank(user, hierarchy)
+        return state
+
+    @classmethod
+    def cached_for_user(cls, user, hierarchy):
+        """
+        The user's state, looked up once for as long as the user object
+        lives, which for request.user is the request. Never saves.
+        """
+        states = user.__dict__.setdefault('_virtual_patient_states', {})
+        if hierarchy.id not in states:
+            states[hierarchy.id] = cls.lookup(user, hierarchy)
+        return states[hierarchy.id]
+
+    @classmethod
+    def cache_for_user(cls, user, state):
+        """make state the one cached_for_user returns, e.g. after a write"""
+        states = user.__dict__.setdefault('_virtual_patient_states', {})
+        states[state.hierarchy_id] = state
+
+    def memoize(self, key, compute):
+        """compute() once per key for this version of the state"""
+        if self._memo is None:
+            self._memo = {}
+
+        key = (self.version,) + key
+        if key not in self._memo:
+            self._memo[key] = compute()
+        return self._memo[key]
+
+    @classmethod
+    def provision(cls, users):
+        """Create the users' missing states for every hierarchy with a
+        virtual patient in one insert, e.g. when they enroll"""
+        ctype = ContentType.objects.get_for_model(PatientAssessmentBlock)
+        hierarchies = list(Hierarchy.objects.filter(
+            section__pageblock__content_type=ctype).distinct())
+        blank = json.dumps({'patients': {}})
+        cls.objects.bulk_create(
+            [ActivityState(user=user, hierarchy=hierarchy, json=blank)
+             for user in users for hierarchy in hierarchies],
+            batch_size=500, ignore_conflicts=True)
+
     @classmethod
     def get_for_user(cls, user, hierarchy):
-        try:
-            stored_state = ActivityState.objects.get(user=user,
-                                                     hierarchy=hierarchy)
-        except ActivityState.DoesNotExist:
-            # setup the template
-            state = {}
-            state['patients'] = {}
+        """The user's state, created if it wasn't provisioned"""
+        state, created = ActivityState.objects.get_or_create(
+            user=user, hierarchy=hierarchy,
+            defaults={'json': json.dumps({'patients': {}})})
+        return state
 
-            stored_state = ActivityState.objects.create(
-                user=user, hierarchy=hierarchy, json=json.dumps(state))
+    @classmethod
+    def locked_for_user(cls, user, hierarchy):
+        """
+        The user's state, created if need be, with its row locked until
+        the end of the transaction on databases that support it.
+        """
+        state, created = ActivityState.objects.select_for_update() \
+            .get_or_create(user=user, hierarchy=hierarchy,
+                           defaults={'json': json.dumps({'patients': {}})})
+        return state
 
-        return stored_state
+    @classmethod
+    def update_patient(cls, user, hierarchy, patient_id, change):
+        """
+        Atomically replace one patient's state with change(patient state).
+        The state is re-read under a row lock, so concurrent submits each
+        see the other's writes. Where rows can't be locked, a write that
+        lost the race is retried against a fresh read. If change returns
+        None nothing is written and None is returned, else the new state.
+        """
+        for attempt in range(cls.UPDATE_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    state = cls.locked_for_user(user, hierarchy)
+                    data = change(state.patient_state_for(patient_id))
+                    if data is None:
+                        return None
+                    state.set_patient_state(patient_id, data)
+                patient_state_changed.send(
+                    sender=cls, user=user, hierarchy=hierarchy,
+                    patient_id=patient_id)
+                return state
+            except StaleActivityState:
+                if attempt == cls.UPDATE_ATTEMPTS - 1:
+                    raise
 
     @classmethod
     def clear_for_user(cls, user, hierarchy, patient_id):
-        state = ActivityState.objects.get(user=user, hierarchy=hierarchy)
-        state.data['patients'][patient_id] = {}
-        state.save()
+        state = cls.update_patient(user, hierarchy, patient_id,
+                                   lambda patient_state: {})
+        cls.cache_for_user(user, state)
 
     def patient_state(self, patient):
-        patient_id = str(patient.id)
+        return self.patient_state_for(str(patient.id))
+
+    def patient_state_for(self, patient_id):
         if patient_id not in self.data["patients"]:
-            self.data["patients"][patient_id] = {}
+            self.data["patients"][patient_id] = self.stored_patient_state(
+                patient_id)
         return self.data["patients"][patient_id]
 
+    def stored_patient_state(self, patient_id):
+        if (not self.tables or self.from_json or self.complete or
+                self.pk is None):
+            return {}
+        return PatientTreatmentState.load(
+            self.user_id, self.hierarchy_id, [patient_id]).get(patient_id, {})
+
     def save_patient_state(self, patient, data):
-        self.data["patients"][str(patient.id)] = data
-        self.save()
+        self.set_patient_state(str(patient.id), data)
+
+    def set_patient_state(self, patient_id, data):
+        read_version = self.version
+        self.data["patients"][patient_id] = data
+        self._changed = True
+        self.version += 1
+        self.modified = timezone.now()
+        self._memo = None
+        if self.pk is None:
+            self.save()
+        elif not self.tables or self.from_json:
+            # in table mode the json is emptied, the tables hold the patients
+            self.save_versioned(read_version, ['json', 'version', 'modified'])
+        else:
+            self.save_versioned(read_version, ['version', 'modified'])
+
+        if not self.tables:
+            return
+
+        if self.from_json:
+            PatientTreatmentState.replace(
+                self.user_id, self.hierarchy_id, self.data["patients"])
+            self._from_json = False
+        else:
+            PatientTreatmentState.store(
+                self.user_id, self.hierarchy_id, patient_id, data)
+
+    def save_versioned(self, read_version, fields):
+        """
+        Write the fields only if the stored state is still at
+        read_version, i.e. nobody else wrote since it was read.
+        Raises StaleActivityState otherwise.
+        """
+        self.encode()
+        updated = ActivityState.objects.filter(
+            pk=self.pk, version=read_version).update(
+            **dict([(f, getattr(self, f)) for f in fields]))
+        if updated == 0:
+            self.version = read_version
+            raise StaleActivityState()
+
+
+@python_2_unicode_compatible
+class PatientTreatmentState(models.Model):
+    """One medication tag of a user's state for a patient"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    hierarchy = models.ForeignKey(Hierarchy, on_delete=models.CASCADE)
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
+    tag = models.CharField(max_length=25)
+    classification = models.CharField(max_length=25, blank=True, null=True)
+    prescribe = models.BooleanField(default=False)
+    combination = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = (("user", "hierarchy", "patient", "tag"),)
+
+    def __str__(self):
+        return "%s %s %s" % (self.user, self.patient, self.tag)
+
+    def as_dict(self):
+        """the row in its ActivityState json form"""
+        value = {}
+        if self.classification is not None:
+            value['classification'] = self.classification
+        if self.prescribe:
+            value['prescribe'] = 'true'
+        if self.combination:
+            value['combination'] = 'true'
+
+        rx = dict([(str(r.medication_id), r.as_dict())
+                   for r in self.rx.all()])
+        if len(rx) > 0:
+            value['rx'] = rx
+        return value
+
+    def update(self, value):
+        """Take on the value's flags. Returns True if any changed."""
+        fields = {'classification': value.get('classification'),
+                  'prescribe': 'prescribe' in value,
+                  'combination': 'combination' in value}
+        changed = False
+        for field, v in fields.items():
+            if getattr(self, field) != v:
+                setattr(self, field, v)
+                changed = True
+        return changed
+
+    def store_rx(self, rx, existing):
+        """write the rx rows that differ from rx, {medication id: dict}"""
+        stale = [r.id for (med_id, r) in existing.items() if med_id not in rx]
+        if len(stale) > 0:
+            PatientRxState.objects.filter(id__in=stale).delete()
+
+        created = []
+        for med_id, value in rx.items():
+            row = existing.get(med_id)
+            if row is None:
+                row = PatientRxState(treatment=self, medication_id=med_id)
+                row.update(value)
+                created.append(row)
+            elif row.update(value):
+                row.save()
+        PatientRxState.objects.bulk_create(created)
 
+    @classmethod
+    def load(cls, user_id, hierarchy_id, patient_ids):
+        """{patient id: patient state} for the given patients"""
+        rows = cls.objects.filter(
+            user_id=user_id, hierarchy_id=hierarchy_id,
+            patient_id__in=patient_ids).prefetch_related('rx')
+
+        patients = {}
+        for row in rows:
+            patients.setdefault(str(row.patient_id), {})[row.tag] = \
+                row.as_dict()
+        return patients
 
-@receiver(post_init, sender=ActivityState)
-def post_init_activity_state(sender, instance, *args, **kwargs):
-    instance.data = json.loads(instance.json)
+    @classmethod
+    def store(cls, user_id, hierarchy_id, patient_id, data):
+        """Bring a patient's rows in line with data, writing only the
+        rows that changed"""
+        with transaction.atomic():
+            rows = dict([(r.tag, r) for r in cls.objects.filter(
+                user_id=user_id, hierarchy_id=hierarchy_id,
+                patient_id=patient_id).prefetch_related('rx')])
+
+            stale = [r.id for (tag, r) in rows.items() if tag not in data]
+            if len(stale) > 0:
+                cls.objects.filter(id__in=stale).delete()
+
+            for tag, value in data.items():
+                row = rows.get(tag)
+                existing = {}
+                if row is None:
+                    row = cls(user_id=user_id, hierarchy_id=hierarchy_id,
+                              patient_id=patient_id, tag=tag)
+                    row.update(value)
+                    row.save()
+                else:
+                    existing = dict([(str(r.medication_id), r)
+                                     for r in row.rx.all()])
+                    if row.update(value):
+                        row.save()
+                row.store_rx(value.get('rx', {}), existing)
+
+    @classmethod
+    def replace(cls, user_id, hierarchy_id, patients):
+        """Swap all of a user's rows for the patients' json states"""
+        with transaction.atomic():
+            cls.objects.filter(
+                user_id=user_id, hierarchy_id=hierarchy_id).delete()
+            for patient_id, data in patients.items():
+                cls.store(user_id, hierarchy_id, patient_id, data)
+
+
+class PatientRxState(models.Model):
+    """A user's concentration & dosage choice for a medication"""
+    treatment = models.ForeignKey(PatientTreatmentState, related_name="rx",
+                                  on_delete=models.CASCADE)
+    medication = models.ForeignKey(Medication, on_delete=models.CASCADE)
+    concentration = models.CharField(max_length=50, blank=True, null=True)
+    dosage = models.CharField(max_length=50, blank=True, null=True)
+
+    class Meta:
+        unique_together = (("treatment", "medication"),)
+
+    def as_dict(self):
+        value = {}
+        if self.concentration is not None:
+            value['concentration'] = self.concentration
+        if self.dosage is not None:
+            value['dosage'] = self.dosage
+        return value
+
+    def update(self, value):
+        changed = False
+        for field in ['concentration', 'dosage']:
+            v = value.get(field)
+            if v is not None:
+                v = str(v)
+            if getattr(self, field) != v:
+                setattr(self, field, v)
+                changed = True
+        return changed
+
+
+class ActivityStateCache(object):
+    """
+    Read-only virtual patient states keyed by (user, hierarchy), for
+    reporting. Each state is fetched & decoded once, users without a
+    stored state get a blank one, and nothing is ever written.
+    """
+
+    def __init__(self):
+        self._states = {}  # user id -> {hierarchy id -> state}
+
+    def load(self, users, hierarchies):
+        """Fetch the states for many users in a single query"""
+        hierarchies = dict([(h.id, h) for h in hierarchies])
+        users = dict([(u.id, u) for u in users])
+        if len(hierarchies) == 0 or len(users) == 0:
+            return
+
+        states = ActivityState.objects.filter(
+            hierarchy__id__in=hierarchies.keys(), user__id__in=users.keys())
+        for state in states:
+            self._states.setdefault(
+                state.user_id, {})[state.hierarchy_id] = state
+
+        if state_tables():
+            self.load_tables(users.keys(), hierarchies.keys())
+
+        for user_id, user in users.items():
+            user_states = self._states.setdefault(user_id, {})
+            for hierarchy_id, hierarchy in hierarchies.items():
+                if hierarchy_id not in user_states:
+                    user_states[hierarchy_id] = ActivityState.blank(
+                        user, hierarchy)
+
+    def load_tables(self, user_ids, hierarchy_ids):
+        """fill in the loaded states from the normalized tables"""
+        rows = PatientTreatmentState.objects.filter(
+            user_id__in=user_ids,
+            hierarchy_id__in=hierarchy_ids).prefetch_related('rx')
+        for row in rows:
+            state = self._states.get(row.user_id, {}).get(row.hierarchy_id)
+            if state is not None and not state.from_json:
+                patients = state.data['patients']
+                patients.setdefault(
+                    str(row.patient_id), {})[row.tag] = row.as_dict()
+
+        for user_states in self._states.values():
+            for state in user_states.values():
+                state.complete = True
+
+    def get(self, user, hierarchy):
+        user_states = self._states.setdefault(user.id, {})
+        if hierarchy.id not in user_states:
+            user_states[hierarchy.id] = ActivityState.lookup(user, hierarchy)
+        return user_states[hierarchy.id]
+
+    def evict(self, user):
+        self._states.pop(user.id, None)
+
+    def __len__(self):
+        return len(self._states)
 
 
 @receiver(pre_save, sender=ActivityState)
 def pre_save_activity_state(sender, instance, *args, **kwargs):
-    instance.json = json.dumps(instance.data)
+    instance.encode()
 
 
 @python_2_unicode_compatible
@@ -219,6 +643,8 @@ class PatientAssessmentBlock(models.Model):
         (VIEW_RESULTS, 'Results')
     )
 
+    RX_FIELDS = ['concentration', 'dosage']
+
     pageblocks = GenericRelation(PageBlock)
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
     view = models.IntegerField(choices=VIEW_CHOICES)
@@ -235,7 +661,9 @@ class PatientAssessmentBlock(models.Model):
         return self.pageblocks.all()[0]
 
     def get_hierarchy(self):
-        return self.pageblock().section.hierarchy
+        if not hasattr(self, '_hierarchy'):
+            self._hierarchy = self.pageblock().section.hierarchy
+        return self._hierarchy
 
     def needs_submit(self):
         return self.view != self.VIEW_RESULTS
@@ -258,32 +686,67 @@ class PatientAssessmentBlock(models.Model):
                         patient_state[m][k] = 'true'
         return patient_state
 
-    def submit_write_prescription(self, data, patient_state):
+    def parse_prescription(self, data, patient_state):
+        """
+        Resolve all the posted fieldname-medicine_id keys against the
+        catalog before anything is written. Returns a list of
+        (medicine, field, value), or None if a key is malformed or names
+        a medication the patient state hasn't classified.
+        """
+        medications = catalog.get_catalog().medication
+        parsed = []
         for key, value in data.items():
-            field, med_id = key.split('-')  # fieldname-medicine_id
-            medicine = Medication.objects.get(id=med_id)
-            if 'rx' not in patient_state[medicine.tag]:
-                patient_state[medicine.tag]['rx'] = {}
-            if med_id not in patient_state[medicine.tag]['rx']:
-                patient_state[medicine.tag]['rx'][med_id] = {}
-            patient_state[medicine.tag]['rx'][med_id][field] = value
+            field, _, med_id = key.partition('-')
+            if field not in self.RX_FIELDS or not med_id.isdigit():
+                return None
+
+            medicine = medications.get(int(med_id))
+            if medicine is None or medicine.tag not in patient_state:
+                return None
+            parsed.append((medicine, field, value))
+        return parsed
+
+    def submit_write_prescription(self, data, patient_state):
+        parsed = self.parse_prescription(data, patient_state)
+        if parsed is None:
+            return None
+
+        for medicine, field, value in parsed:
+            rx = patient_state[medicine.tag].setdefault('rx', {})
+            rx.setdefault(str(medicine.id), {})[field] = value
         return patient_state
 
-    def submit(self, user, data):
-        state = ActivityState.get_for_user(user, self.get_hierarchy())
-        patient_state = state.patient_state(self.patient)
+    def user_state(self, user, state=None):
+        """state may be passed in if the caller has already loaded it,
+        e.g. from ActivityState.cached_for_user"""
+        if state is None:
+            state = ActivityState.lookup(user, self.get_hierarchy())
+        return state
+
+    def memo_key(self, name):
+        return (self.id, self.view, name)
 
+    def user_patient_state(self, user, state=None):
+        return self.user_state(user, state).patient_state(self.patient)
+
+    def submit_patient_state(self, data, patient_state):
         if self.view == self.CLASSIFY_TREATMENTS:
-            patient_state = self.submit_classify_treatments(
-                data, patient_state)
+            return self.submit_classify_treatments(data, patient_state)
         elif self.view == self.BEST_TREATMENT_OPTION:
-            patient_state = self.submit_best_treatment_option(
-                data, patient_state)
+            return self.submit_best_treatment_option(data, patient_state)
         elif self.view == self.WRITE_PRESCRIPTION:
-            patient_state = self.submit_write_prescription(
-                data, patient_state)
+            return self.submit_write_prescription(data, patient_state)
+        return patient_state
 
-        state.save_patient_state(self.patient, patient_state)
+    def submit(self, user, data):
+        state = ActivityState.update_patient(
+            user, self.get_hierarchy(), str(self.patient.id),
+            lambda patient_state: self.submit_patient_state(
+                data, patient_state))
+        if state is None:
+            return False
+
+        ActivityState.cache_for_user(user, state)
         return True
 
     def redirect_to_self_on_submit(self):
@@ -306,9 +769,13 @@ class PatientAssessmentBlock(models.Model):
         if form.is_valid():
             form.save()
 
-    def unlocked(self, user):
-        state = ActivityState.get_for_user(user, self.get_hierarchy())
-        patient_state = state.patient_state(self.patient)
+    def unlocked(self, user, state=None):
+        state = self.user_state(user, state)
+        return state.memoize(self.memo_key('unlocked'),
+                             lambda: self._unlocked(user, state))
+
+    def _unlocked(self, user, state):
+        patient_state = self.user_patient_state(user, state)
 
         if self.view == self.CLASSIFY_TREATMENTS:
             return (len(self.patient.treatments()) ==
@@ -316,9 +783,9 @@ class PatientAssessmentBlock(models.Model):
         elif self.view == self.BEST_TREATMENT_OPTION:
             return self.unlocked_best_treatment_option(patient_state)
         elif self.view == self.WRITE_PRESCRIPTION:
-            return self.unlocked_write_prescription(user)
+            return self.unlocked_write_prescription(user, state)
         elif self.view == self.VIEW_RESULTS:
-            medications = self.medications(user)
+            medications = self.medications(user, state)
             return len(medications) > 0
         return False
 
@@ -335,8 +802,8 @@ class PatientAssessmentBlock(models.Model):
                 (prescribe != 'combination' or
                  combination == 2))
 
-    def unlocked_write_prescription(self, user):
-        medications = self.medications(user)
+    def unlocked_write_prescription(self, user, state=None):
+        medications = self.medications(user, state)
         for med in medications:
             if len(med['choices']) != med['rx_count']:
                 return False
@@ -346,9 +813,8 @@ class PatientAssessmentBlock(models.Model):
                     return False
         return True
 
-    def available_treatments(self, user):
-        state = ActivityState.get_for_user(user, self.get_hierarchy())
-        patient_state = state.patient_state(self.patient)
+    def available_treatments(self, user, state=None):
+        patient_state = self.user_patient_state(user, state)
         qst = self.patient.treatments()
 
         lst = list(qst)
@@ -362,16 +828,21 @@ class PatientAssessmentBlock(models.Model):
                     setattr(med, "combination", "true")
         return lst
 
-    def medications(self, user):
-        state = ActivityState.get_for_user(user, self.get_hierarchy())
+    def medications(self, user, state=None):
+        state = self.user_state(user, state)
+        return state.memoize(self.memo_key('medications'),
+                             lambda: self._medications(state))
+
+    def _medications(self, state):
         patient_state = state.patient_state(self.patient)
+        reference = catalog.get_catalog()
 
         medications = []
         for key, value in patient_state.items():
             if (key != 'combination' and
                     ('combination' in value or 'prescribe' in value)):
-                qst = Medication.objects.filter(
-                    tag=key).order_by("display_order")
+                # copies, the catalog's medications are shared
+                qst = [copy(m) for m in reference.medications_for_tag(key)]
                 context = {'rx_count': len(qst),
                            'name': qst[0].name,
                            'tag': qst[0].tag,
@@ -384,10 +855,10 @@ class PatientAssessmentBlock(models.Model):
                         setattr(med, "selected_dosage",
                                 int(value['rx'][str(med.id)]['dosage']))
 
-                        cnc = ConcentrationChoice.objects.get(
-                            id=int(value['rx'][str(med.id)]['concentration']))
-                        dsc = DosageChoice.objects.get(
-                            id=int(value['rx'][str(med.id)]['dosage']))
+                        cnc = reference.concentration[
+                            int(value['rx'][str(med.id)]['concentration'])]
+                        dsc = reference.dosage[
+                            int(value['rx'][str(med.id)]['dosage'])]
 
                         setattr(med,
                                 "selected_concentration_label",
@@ -411,12 +882,13 @@ class PatientAssessmentBlock(models.Model):
 
     def correct_rx(self, medications):
         # "Correct" the concentration & dosage choices
+        reference = catalog.get_catalog()
         correct_rx = True
         medication_ids = []
         for medicine in medications:
             for choice in medicine['choices']:
-                cnc = choice.concentrationchoice_set.get(correct=True)
-                dsc = choice.dosagechoice_set.get(correct=True)
+                cnc = reference.correct_concentration[choice.id]
+                dsc = reference.correct_dosage[choice.id]
 
                 if (choice.selected_concentration != cnc.id or
                         choice.selected_dosage != dsc.id):
@@ -425,36 +897,28 @@ class PatientAssessmentBlock(models.Model):
                 medication_ids.append(choice.id)
         return correct_rx, medication_ids
 
-    def feedback(self, user):
-        if not self.unlocked(user):
+    def feedback(self, user, state=None):
+        state = self.user_state(user, state)
+        return state.memoize(self.memo_key('feedback'),
+                             lambda: self._feedback(user, state))
+
+    def _feedback(self, user, state):
+        if not self.unlocked(user, state):
             return None
 
-        medications = self.medications(user)
+        medications = self.medications(user, state)
         if not self.complete_rx(medications):
             return None
 
         correct_rx, medication_ids = self.correct_rx(medications)
-
-        # Find the treatment option associated with the prescribed medications
-        topt = TreatmentOption.objects.filter(patient__id=self.patient.id)
-
         combination = len(medications) == 2
-        if combination:
-            topt = topt.get(medication_one__id__in=medication_ids,
-                            medication_two__id__in=medication_ids)
-        else:
-            topt = topt.get(medication_one__id__in=medication_ids,
-                            medication_two__isnull=True)
-
-        tfd = TreatmentFeedback.objects.filter(
-            patient__id=self.patient.id, classification=topt.classification)
-
-        if topt.classification.rank == 1:
-            # For the best, factor in correct dosage
-            tfd = tfd.get(correct_dosage=correct_rx)
-        else:  # for ineffective + harmful factor in combination
-            tfd = tfd.get(combination_therapy=combination)
 
+        tfd = catalog.get_catalog().decide(
+            self.patient_id, medication_ids, correct_rx, combination)
+        if tfd is None:
+            raise TreatmentFeedback.DoesNotExist(
+                "No feedback for %s prescribing %s" % (self.patient,
+                                                       medication_ids))
         return tfd
 
 
@@ -465,6 +929,8 @@ class PatientAssessmentForm(forms.ModelForm):
 
 
 class VirtualPatientColumn(object):
+    state_cache = None
+
     def identifier(self):
         raise NotImplementedError
 
@@ -474,10 +940,39 @@ class VirtualPatientColumn(object):
     def user_value(self, user):
         raise NotImplementedError
 
+    def user_state(self, user):
+        if self.state_cache is None:
+            return ActivityState.lookup(user, self.hierarchy)
+        return self.state_cache.get(user, self.hierarchy)
+
+    @classmethod
+    def prefetch(cls, columns, users):
+        """
+        Load the virtual patient states for a page of users
+        in a single query, shared by all the given columns.
+        """
+        if len(columns) == 0:
+            return
+
+        cache = columns[0].state_cache
+        if cache is None:
+            cache = ActivityStateCache()
+
+        cache.load(users, set([c.hierarchy for c in columns]))
+        for column in columns:
+            column.state_cache = cache
+
+    @classmethod
+    def evict(cls, columns, user):
+        """Drop a user's states once their report row is written"""
+        for cache in set([c.state_cache for c in columns]):
+            if cache is not None:
+                cache.evict(user)
+
     @classmethod
     def all(cls, hrchy, section, key=True):
         columns = []
-        ctype = ContentType.objects.get(name='patient assessment block')
+        ctype = ContentType.objects.get_for_model(PatientAssessmentBlock)
 
         for activity in section.pageblock_set.filter(content_type=ctype):
             block = activity.block()
@@ -494,6 +989,11 @@ class VirtualPatientColumn(object):
                 columns += TreatmentRankColumn.all(hrchy, block, key)
                 columns += CorrectRxColumn.all(hrchy, block, key)
 
+        # the section's columns share a single parse of each user's state
+        cache = ActivityStateCache()
+        for column in columns:
+            column.state_cache = cache
+
         return columns
 
 
@@ -521,7 +1021,7 @@ class ClassifyTreatmentColumn(VirtualPatientColumn):
                 self.classification.rank, self.classification.description]
 
     def user_value(self, user):
-        state = ActivityState.get_for_user(user, self.hierarchy)
+        state = self.user_state(user)
         patient_state = state.patient_state(self.patient)
 
         try:
@@ -552,6 +1052,7 @@ class BestTreatmentColumn(VirtualPatientColumn):
         self.hierarchy = hierarchy
         self.patient = patient
         self.treatment = treatment
+        self._treatments = None
 
     def description(self):
         return "Step 2 - Best Treatment for %s" % self.patient.name
@@ -565,10 +1066,13 @@ class BestTreatmentColumn(VirtualPatientColumn):
                 self.treatment.id, self.treatment.name]
 
     def user_value(self, user):
-        state = ActivityState.get_for_user(user, self.hierarchy)
+        state = self.user_state(user)
         patient_state = state.patient_state(self.patient)
 
-        for treatment in self.patient.treatments():
+        if self._treatments is None:
+            self._treatments = list(self.patient.treatments())
+
+        for treatment in self._treatments:
             if (treatment.tag in patient_state and
                     'prescribe' in patient_state[treatment.tag]):
                 return treatment.id
@@ -614,7 +1118,7 @@ class CombinationTreatmentColumn(VirtualPatientColumn):
                 self.treatment.name]
 
     def user_value(self, user):
-        state = ActivityState.get_for_user(user, self.hierarchy)
+        state = self.user_state(user)
         patient_state = state.patient_state(self.patient)
 
         try:
@@ -661,7 +1165,7 @@ class WritePrescriptionColumn(VirtualPatientColumn):
                 getattr(self.choice, self.field)]
 
     def user_value(self, user):
-        state = ActivityState.get_for_user(user, self.hierarchy)
+        state = self.user_state(user)
         patient_state = state.patient_state(self.patient)
 
         try:
@@ -725,7 +1229,7 @@ class TreatmentRankColumn(VirtualPatientColumn):
                 self.classification.description]
 
     def user_value(self, user):
-        feedback = self.block.feedback(user)
+        feedback = self.block.feedback(user, self.user_state(user))
         if feedback is not None:
             return feedback.classification.rank
         else:
@@ -765,7 +1269,7 @@ class CorrectRxColumn(VirtualPatientColumn):
                 self.description()]
 
     def user_value(self, user):
-        medications = self.block.medications(user)
+        medications = self.block.medications(user, self.user_state(user))
 
         if not self.block.complete_rx(medications):
             return ''
@@ -1,7 +1,13 @@
 from django import template
+from tobaccocessation.activity_virtual_patient.models import ActivityState
 register = template.Library()
 
 
+def request_state(block, user):
+    """the state is loaded once per request & shared by the tags"""
+    return ActivityState.cached_for_user(user, block.get_hierarchy())
+
+
 class GetAvailableTreatments(template.Node):
     def __init__(self, block, var_name):
         self.block = block
@@ -10,7 +16,7 @@ class GetAvailableTreatments(template.Node):
     def render(self, context):
         b = context[self.block]
         u = context['request'].user
-        context[self.var_name] = b.available_treatments(u)
+        context[self.var_name] = b.available_treatments(u, request_state(b, u))
         return ''
 
 
@@ -30,7 +36,7 @@ class GetMedications(template.Node):
         b = context[self.block]
         u = context['request'].user
 
-        context[self.var_name] = b.medications(u)
+        context[self.var_name] = b.medications(u, request_state(b, u))
         return ''
 
 
@@ -50,7 +56,7 @@ class GetResults(template.Node):
         b = context[self.block]
         u = context['request'].user
 
-        context[self.var_name] = b.feedback(u)
+        context[self.var_name] = b.feedback(u, request_state(b, u))
         return ''
 
 
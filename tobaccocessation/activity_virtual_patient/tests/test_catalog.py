@@ -0,0 +1,135 @@
+from django.db.models import Q
+from django.test import TestCase
+
+from tobaccocessation.activity_virtual_patient import catalog
+from tobaccocessation.activity_virtual_patient.catalog import get_catalog
+from tobaccocessation.activity_virtual_patient.models import \
+    ConcentrationChoice, DosageChoice, Medication, Patient, \
+    TreatmentFeedback, TreatmentOption
+
+
+class CatalogTest(TestCase):
+    fixtures = ['virtualpatient.json']
+
+    def setUp(self):
+        # rolling back another test's edits doesn't send signals
+        catalog.invalidate()
+
+    def test_indexes(self):
+        catalog = get_catalog()
+
+        varenicline = list(Medication.objects.filter(
+            tag="varenicline").order_by("display_order"))
+        self.assertEquals(catalog.medications_for_tag("varenicline"),
+                          varenicline)
+        self.assertEquals(catalog.medications_for_tag("unknown"), [])
+
+        med = varenicline[0]
+        self.assertEquals(catalog.medication[med.id], med)
+        self.assertEquals(catalog.correct_concentration[med.id],
+                          med.concentrationchoice_set.get(correct=True))
+        self.assertEquals(catalog.correct_dosage[med.id],
+                          med.dosagechoice_set.get(correct=True))
+
+        choice = ConcentrationChoice.objects.first()
+        self.assertEquals(catalog.concentration[choice.id], choice)
+        choice = DosageChoice.objects.first()
+        self.assertEquals(catalog.dosage[choice.id], choice)
+
+        patient = Patient.objects.get(display_order=1)
+        self.assertEquals(catalog.options[patient.id],
+                          list(patient.treatmentoption_set.order_by('id')))
+
+    def test_patient_treatments(self):
+        catalog = get_catalog()
+        for patient in Patient.objects.all():
+            # the join Patient.treatments() ran before the catalog
+            expected = Medication.objects.filter(
+                Q(medication_one__patient__id=patient.id) |
+                Q(medication_two__patient__id=patient.id) |
+                Q(tag="combination")).distinct().order_by(
+                "display_order", "id")
+            self.assertEquals(catalog.patient_treatments(patient.id),
+                              list(expected))
+
+        # annotating the treatments leaves the catalog alone
+        patient = Patient.objects.get(display_order=1)
+        with self.assertNumQueries(0):
+            treatments = patient.treatments()
+        treatments[0].classification = "appropriate"
+        self.assertFalse(hasattr(patient.treatments()[0], "classification"))
+
+    def test_treatments_follow_options(self):
+        patient = Patient.objects.get(display_order=1)
+        before = len(patient.treatments())
+
+        option = patient.treatmentoption_set.exclude(
+            medication_two=None).first()
+        TreatmentOption.objects.filter(
+            medication_one=option.medication_two,
+            patient=patient).delete()
+        TreatmentOption.objects.filter(
+            medication_two=option.medication_two,
+            patient=patient).delete()
+        self.assertEquals(len(patient.treatments()), before - 1)
+
+    def test_loaded_once(self):
+        catalog = get_catalog()
+        with self.assertNumQueries(0):
+            self.assertTrue(get_catalog() is catalog)
+            for options in catalog.options.values():
+                for option in options:
+                    self.assertTrue(option.classification.rank > 0)
+                    self.assertTrue(len(option.medication_one.tag) > 0)
+
+    def test_invalidated_on_change(self):
+        catalog = get_catalog()
+
+        med = Medication.objects.first()
+        med.name = "renamed"
+        med.save()
+
+        self.assertFalse(get_catalog() is catalog)
+        self.assertEquals(get_catalog().medication[med.id].name, "renamed")
+
+        med.delete()
+        self.assertFalse(med.id in get_catalog().medication)
+
+    def feedback_query(self, patient, medication_ids, correct_rx, combination):
+        """the lookup feedback() made before the decision table"""
+        topt = TreatmentOption.objects.filter(patient__id=patient.id)
+        if combination:
+            topt = topt.get(medication_one__id__in=medication_ids,
+                            medication_two__id__in=medication_ids)
+        else:
+            topt = topt.get(medication_one__id__in=medication_ids,
+                            medication_two__isnull=True)
+
+        tfd = TreatmentFeedback.objects.filter(
+            patient__id=patient.id, classification=topt.classification)
+        try:
+            if topt.classification.rank == 1:
+                return tfd.get(correct_dosage=correct_rx)
+            return tfd.get(combination_therapy=combination)
+        except TreatmentFeedback.DoesNotExist:
+            return None
+
+    def test_decisions_match_queries(self):
+        catalog = get_catalog()
+
+        decided = 0  # lookups that found feedback
+        for patient in Patient.objects.all():
+            for option in patient.treatmentoption_set.all():
+                meds = [option.medication_one, option.medication_two]
+                tags = set([m.tag for m in meds if m is not None])
+                ids = list(Medication.objects.filter(
+                    tag__in=tags).values_list('id', flat=True))
+                combination = len(tags) == 2
+
+                for correct_rx in [True, False]:
+                    tfd = catalog.decide(patient.id, ids, correct_rx,
+                                         combination)
+                    self.assertEquals(tfd, self.feedback_query(
+                        patient, ids, correct_rx, combination))
+                    decided += tfd is not None
+        self.assertTrue(decided > 0)
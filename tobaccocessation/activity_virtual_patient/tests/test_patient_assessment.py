@@ -1,13 +1,19 @@
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.db.models import F
+from django.test import TestCase, override_settings
 from django.test.client import Client, RequestFactory
 from pagetree.helpers import get_section_from_path
 from pagetree.models import Hierarchy
+from tobaccocessation.activity_virtual_patient import catalog
 from tobaccocessation.activity_virtual_patient.models import \
     PatientAssessmentBlock, Patient, ClassifyTreatmentColumn, Medication, \
     TreatmentClassification, BestTreatmentColumn, CombinationTreatmentColumn, \
-    WritePrescriptionColumn, DosageChoice, TreatmentRankColumn, CorrectRxColumn
+    WritePrescriptionColumn, DosageChoice, TreatmentRankColumn, \
+    CorrectRxColumn, VirtualPatientColumn, ActivityState, ActivityStateCache, \
+    PatientTreatmentState, StaleActivityState
 from tobaccocessation.main.models import UserProfile
+from tobaccocessation.main.views import REJECTED_MESSAGE, page_post
 
 
 class VirtualPatientTestCase(TestCase):
@@ -25,6 +31,8 @@ class VirtualPatientTestCase(TestCase):
         return block
 
     def setUp(self):
+        # rolling back another test's edits doesn't send signals
+        catalog.invalidate()
         self.c = Client()
 
         self.user = User.objects.create_user('test_student',
@@ -340,6 +348,52 @@ class TestPatientAssessmentBlock(VirtualPatientTestCase):
         self.assertEquals(obj.selected_concentration_label, u'21 mg')
         self.assertEquals(obj.selected_dosage_label, u'2 boxes, 28 patches')
 
+    def test_prescribe_rejects_unknown(self):
+        block = self.create_block(self.section, self.patient1,
+                                  PatientAssessmentBlock.CLASSIFY_TREATMENTS)
+        block.submit(self.user, self.CLASSIFY_TREATMENTS_DATA)
+
+        block.view = PatientAssessmentBlock.BEST_TREATMENT_OPTION
+        block.submit(self.user, self.BEST_TREATMENT_SINGLE_INEFFECTIVE)
+
+        block.view = PatientAssessmentBlock.WRITE_PRESCRIPTION
+        before = ActivityState.objects.get(user=self.user).json
+        for data in [{'dosage-9999': '6'},
+                     {'refill-1': '6'},
+                     {'dosage': '6'},
+                     dict(self.PRESCRIPTION_SINGLE_INEFFECTIVE,
+                          **{'dosage-x': '6'})]:
+            self.assertFalse(block.submit(self.user, data))
+            self.assertEquals(
+                ActivityState.objects.get(user=self.user).json, before)
+
+        self.assertTrue(
+            block.submit(self.user, self.PRESCRIPTION_SINGLE_INEFFECTIVE))
+        self.assertTrue(block.unlocked(self.user))
+
+    def test_rejected_prescription_post(self):
+        block = self.create_block(self.section, self.patient1,
+                                  PatientAssessmentBlock.CLASSIFY_TREATMENTS)
+        block.submit(self.user, self.CLASSIFY_TREATMENTS_DATA)
+        block.view = PatientAssessmentBlock.BEST_TREATMENT_OPTION
+        block.submit(self.user, self.BEST_TREATMENT_SINGLE_INEFFECTIVE)
+        block.view = PatientAssessmentBlock.WRITE_PRESCRIPTION
+        block.save()
+        pageblock = self.section.pageblock_set.first()
+
+        request = RequestFactory().post('/', {
+            'pageblock-%d-dosage-9999' % pageblock.id: '6'})
+        request.user = self.user
+        request._messages = CookieStorage(request)
+        response = page_post(request, self.section)
+
+        # back on the page, told why
+        self.assertEquals(response['Location'],
+                          self.section.get_absolute_url())
+        self.assertEquals([str(m) for m in request._messages],
+                          [REJECTED_MESSAGE])
+        self.assertFalse(block.unlocked(self.user))
+
     def test_prescribe_double(self):
         block = self.create_block(self.section, self.patient1,
                                   PatientAssessmentBlock.CLASSIFY_TREATMENTS)
@@ -591,6 +645,37 @@ class TestPatientAssessmentBlock(VirtualPatientTestCase):
 #        self.assertEquals(response.request["PATH_INFO"], "/")
 
 
+class TestBlockMemo(VirtualPatientTestCase):
+
+    def test_results_computed_once(self):
+        for view, data in [
+                (PatientAssessmentBlock.CLASSIFY_TREATMENTS,
+                 self.CLASSIFY_TREATMENTS_DATA),
+                (PatientAssessmentBlock.BEST_TREATMENT_OPTION,
+                 self.BEST_TREATMENT_SINGLE_APPROPRIATE),
+                (PatientAssessmentBlock.WRITE_PRESCRIPTION,
+                 self.PRESCRIPTION_SINGLE_APPROPRIATE_CORRECT)]:
+            block = self.create_block(self.section, self.patient1, view)
+            block.submit(self.user, data)
+        results = self.create_block(self.section, self.patient1,
+                                    PatientAssessmentBlock.VIEW_RESULTS)
+
+        state = ActivityState.cached_for_user(self.user, self.hierarchy)
+        feedback = results.feedback(self.user, state)
+        self.assertTrue(feedback.correct_dosage)
+
+        with self.assertNumQueries(0):
+            state = ActivityState.cached_for_user(self.user, self.hierarchy)
+            self.assertTrue(results.unlocked(self.user, state))
+            self.assertEquals(len(results.medications(self.user, state)), 1)
+            self.assertEquals(results.feedback(self.user, state), feedback)
+
+        # submitting replaces the request's state
+        block.submit(self.user, self.PRESCRIPTION_SINGLE_APPROPRIATE_INCORRECT)
+        state = ActivityState.cached_for_user(self.user, self.hierarchy)
+        self.assertFalse(results.feedback(self.user, state).correct_dosage)
+
+
 class TestClassifyTreatmentColumn(VirtualPatientTestCase):
 
     def test_all(self):
@@ -859,3 +944,252 @@ class TestCorrectRxColumn(VirtualPatientTestCase):
 
         block.submit(self.user, self.PRESCRIPTION_SINGLE_APPROPRIATE_INCORRECT)
         self.assertEquals(column.user_value(self.user), False)
+
+
+class TestVirtualPatientColumnPrefetch(VirtualPatientTestCase):
+
+    def test_prefetch(self):
+        block = self.create_block(self.section, self.patient1,
+                                  PatientAssessmentBlock.CLASSIFY_TREATMENTS)
+        block.submit(self.user, self.CLASSIFY_TREATMENTS_DATA)
+        block = self.create_block(self.section, self.patient1,
+                                  PatientAssessmentBlock.BEST_TREATMENT_OPTION)
+        block.submit(self.user, self.BEST_TREATMENT_SINGLE_APPROPRIATE)
+
+        other = User.objects.create_user('other', 'other@ccnmtl.com', 'test')
+
+        med = Medication.objects.get(tag="nicotinepatch")
+        columns = [ClassifyTreatmentColumn(self.hierarchy, self.patient1, med),
+                   CombinationTreatmentColumn(self.hierarchy,
+                                              self.patient1, med)]
+
+        with self.assertNumQueries(1):
+            VirtualPatientColumn.prefetch(columns, [self.user, other])
+
+        with self.assertNumQueries(0):
+            self.assertEquals(columns[0].user_value(self.user), 1)
+            self.assertEquals(columns[1].user_value(self.user), '')
+            self.assertEquals(columns[0].user_value(other), '')
+
+        # reporting never creates state
+        self.assertFalse(ActivityState.objects.filter(user=other).exists())
+
+    def test_shared_state_cache(self):
+        block = self.create_block(self.section, self.patient1,
+                                  PatientAssessmentBlock.CLASSIFY_TREATMENTS)
+        block.submit(self.user, self.CLASSIFY_TREATMENTS_DATA)
+        self.create_block(self.section, self.patient1,
+                          PatientAssessmentBlock.BEST_TREATMENT_OPTION)
+
+        columns = VirtualPatientColumn.all(self.hierarchy, self.section,
+                                           False)
+        self.assertEquals(len(set([c.state_cache for c in columns])), 1)
+
+        # one load for all the columns of a user
+        with self.assertNumQueries(1):
+            for column in columns[:7]:
+                column.user_value(self.user)
+
+        VirtualPatientColumn.evict(columns, self.user)
+        self.assertEquals(len(columns[0].state_cache), 0)
+
+
+class TestActivityStateCache(VirtualPatientTestCase):
+
+    def test_load(self):
+        block = self.create_block(self.section, self.patient1,
+                                  PatientAssessmentBlock.CLASSIFY_TREATMENTS)
+        block.submit(self.user, self.CLASSIFY_TREATMENTS_DATA)
+        other = User.objects.create_user('other', 'other@ccnmtl.com', 'test')
+
+        cache = ActivityStateCache()
+        with self.assertNumQueries(1):
+            cache.load([self.user, other], [self.hierarchy])
+
+        with self.assertNumQueries(0):
+            state = cache.get(self.user, self.hierarchy)
+            self.assertTrue(
+                'nicotinepatch' in state.patient_state(self.patient1))
+            state = cache.get(other, self.hierarchy)
+            self.assertEquals(state.patient_state(self.patient1), {})
+            self.assertIsNone(state.pk)
+
+        self.assertEquals(len(cache), 2)
+        cache.evict(other)
+        self.assertEquals(len(cache), 1)
+
+    def test_get(self):
+        cache = ActivityStateCache()
+        with self.assertNumQueries(1):
+            state = cache.get(self.user, self.hierarchy)
+            self.assertTrue(state is cache.get(self.user, self.hierarchy))
+        self.assertFalse(
+            ActivityState.objects.filter(user=self.user).exists())
+
+
+class TestActivityStateData(VirtualPatientTestCase):
+
+    def test_decoded_on_use(self):
+        ActivityState.objects.create(user=self.user, hierarchy=self.hierarchy,
+                                     json='not decoded')
+
+        # listing & deleting never touch the json
+        self.assertEquals(len(ActivityState.objects.all()), 1)
+        ActivityState.objects.filter(user=self.user).delete()
+
+    def test_encoded_when_changed(self):
+        ActivityState.objects.create(user=self.user, hierarchy=self.hierarchy,
+                                     json='{"patients":{}}')
+
+        state = ActivityState.objects.get(user=self.user)
+        self.assertEquals(state.patient_state(self.patient1), {})
+        state.save()
+        state = ActivityState.objects.get(user=self.user)
+        self.assertEquals(state.json, '{"patients":{}}')
+
+        state.save_patient_state(self.patient1, {'bupropion': {}})
+        state = ActivityState.objects.get(user=self.user)
+        self.assertEquals(state.json, '{"patients": {"%s": {"bupropion": {}}}}'
+                          % self.patient1.id)
+
+
+class TestActivityStateUpdate(VirtualPatientTestCase):
+
+    def test_stale_write_rejected(self):
+        ActivityState.get_for_user(self.user, self.hierarchy)
+        first = ActivityState.objects.get(user=self.user)
+        second = ActivityState.objects.get(user=self.user)
+
+        first.save_patient_state(self.patient1, {'bupropion': {}})
+        with self.assertRaises(StaleActivityState):
+            second.save_patient_state(self.patient4, {'varenicline': {}})
+
+        state = ActivityState.objects.get(user=self.user)
+        self.assertEquals(state.patient_state(self.patient1),
+                          {'bupropion': {}})
+        self.assertEquals(state.patient_state(self.patient4), {})
+
+    def test_update_patient_retries(self):
+        ActivityState.update_patient(self.user, self.hierarchy,
+                                     str(self.patient1.id),
+                                     lambda patient_state: {'bupropion': {}})
+        calls = []
+
+        def change(patient_state):
+            if len(calls) == 0:
+                # another request writes between our read & write
+                ActivityState.objects.filter(user=self.user).update(
+                    version=F('version') + 1)
+            calls.append(patient_state)
+            return {'varenicline': {}}
+
+        state = ActivityState.update_patient(
+            self.user, self.hierarchy, str(self.patient4.id), change)
+        self.assertEquals(len(calls), 2)
+
+        state = ActivityState.objects.get(user=self.user)
+        self.assertEquals(state.patient_state(self.patient1),
+                          {'bupropion': {}})
+        self.assertEquals(state.patient_state(self.patient4),
+                          {'varenicline': {}})
+
+    def test_update_patient_unchanged(self):
+        self.assertIsNone(ActivityState.update_patient(
+            self.user, self.hierarchy, str(self.patient1.id),
+            lambda patient_state: None))
+        self.assertEquals(
+            ActivityState.objects.get(user=self.user).version, 0)
+
+
+@override_settings(VIRTUAL_PATIENT_STATE_TABLES=True)
+class TestPatientStateTables(VirtualPatientTestCase):
+
+    def submit_all(self, user):
+        for view, data in [
+                (PatientAssessmentBlock.CLASSIFY_TREATMENTS,
+                 self.CLASSIFY_TREATMENTS_DATA),
+                (PatientAssessmentBlock.BEST_TREATMENT_OPTION,
+                 self.BEST_TREATMENT_DOUBLE),
+                (PatientAssessmentBlock.WRITE_PRESCRIPTION,
+                 self.PRESCRIPTION_DOUBLE_CORRECT)]:
+            block = self.create_block(self.section, self.patient1, view)
+            block.submit(user, data)
+
+    def test_same_as_json(self):
+        self.submit_all(self.user)
+        other = User.objects.create_user('other', 'other@ccnmtl.com', 'test')
+        with self.settings(VIRTUAL_PATIENT_STATE_TABLES=False):
+            self.submit_all(other)
+            expected = ActivityState.objects.get(
+                user=other).patient_state(self.patient1)
+
+        state = ActivityState.objects.get(user=self.user)
+        self.assertEquals(state.patient_state(self.patient1), expected)
+        self.assertEquals(state.json, '{"patients": {}}')
+        self.assertEquals(PatientTreatmentState.objects.filter(
+            user=self.user).count(), len(self.CLASSIFY_TREATMENTS_DATA))
+
+    def test_writes_changed_rows(self):
+        self.submit_all(self.user)
+
+        state = ActivityState.objects.get(user=self.user)
+        patient_state = state.patient_state(self.patient1)
+        patient_state['nicotinegum']['classification'] = 'harmful'
+
+        # read the rows & their rx, update the one that changed & the
+        # version, plus the savepoint around the rows
+        with self.assertNumQueries(6):
+            state.save_patient_state(self.patient1, patient_state)
+
+        state = ActivityState.objects.get(user=self.user)
+        self.assertEquals(
+            state.patient_state(self.patient1)['nicotinegum'],
+            {'classification': 'harmful'})
+
+    def test_moves_json_on_write(self):
+        with self.settings(VIRTUAL_PATIENT_STATE_TABLES=False):
+            block = self.create_block(
+                self.section, self.patient1,
+                PatientAssessmentBlock.CLASSIFY_TREATMENTS)
+            block.submit(self.user, self.CLASSIFY_TREATMENTS_DATA)
+
+        # read from the json until the next write
+        state = ActivityState.objects.get(user=self.user)
+        self.assertEquals(
+            state.patient_state(self.patient1)['nicotinegum'],
+            {'classification': 'ineffective'})
+        self.assertFalse(PatientTreatmentState.objects.exists())
+
+        block = self.create_block(self.section, self.patient1,
+                                  PatientAssessmentBlock.BEST_TREATMENT_OPTION)
+        block.submit(self.user, self.BEST_TREATMENT_SINGLE_APPROPRIATE)
+
+        state = ActivityState.objects.get(user=self.user)
+        self.assertEquals(state.json, '{"patients": {}}')
+        self.assertEquals(
+            state.patient_state(self.patient1)['bupropion'],
+            {'classification': 'appropriate', 'prescribe': 'true'})
+
+    def test_clear_for_user(self):
+        self.submit_all(self.user)
+        ActivityState.clear_for_user(self.user, self.hierarchy,
+                                     str(self.patient1.id))
+
+        self.assertFalse(PatientTreatmentState.objects.exists())
+        state = ActivityState.objects.get(user=self.user)
+        self.assertEquals(state.patient_state(self.patient1), {})
+
+    def test_cache_load(self):
+        self.submit_all(self.user)
+
+        cache = ActivityStateCache()
+        # states, treatment rows, rx rows
+        with self.assertNumQueries(3):
+            cache.load([self.user], [self.hierarchy])
+
+        with self.assertNumQueries(0):
+            state = cache.get(self.user, self.hierarchy)
+            self.assertEquals(
+                state.patient_state(self.patient1)['varenicline']['rx']['7'],
+                {'concentration': '21', 'dosage': '26'})
+            self.assertEquals(state.patient_state(self.patient4), {})
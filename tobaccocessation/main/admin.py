@@ -1,6 +1,7 @@
 from django.contrib import admin
 from pagetree.models import Hierarchy
-from tobaccocessation.main.models import UserProfile
+from tobaccocessation.main.models import UserProfile, UserProgress, \
+    ReportJob
 
 
 class UserProfileAdmin(admin.ModelAdmin):
@@ -8,5 +9,20 @@ class UserProfileAdmin(admin.ModelAdmin):
     list_display = ['user', 'is_faculty', 'role', 'institute']
 
 
+class UserProgressAdmin(admin.ModelAdmin):
+    search_fields = ['user__username']
+    list_display = ['user', 'hierarchy', 'visited', 'sections', 'percent']
+    list_filter = ['hierarchy']
+    ordering = ['-percent']
+
+
+class ReportJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'hierarchy', 'include_superusers', 'status',
+                    'created', 'finished', 'progress', 'total']
+    list_filter = ['status', 'hierarchy']
+
+
 admin.site.register(UserProfile, UserProfileAdmin)
+admin.site.register(UserProgress, UserProgressAdmin)
+admin.site.register(ReportJob, ReportJobAdmin)
 admin.site.register(Hierarchy)
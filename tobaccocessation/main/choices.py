@@ -70,7 +70,7 @@ AGE_CHOICES = (
 )
 
 
-def choices_key(writer, items, name, item_type):
+def choices_key(items, name, item_type):
     for key, val in items:
         if key != '-----':
-            writer.writerow([name, 'profile', '', item_type, name, key, val])
+            yield [name, 'profile', '', item_type, name, key, val]
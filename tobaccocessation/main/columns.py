@@ -0,0 +1,83 @@
+"""
+Compiled report columns.
+
+Working out a hierarchy's report columns walks every section, loading
+its quiz, prescription & virtual patient blocks with their questions,
+answers, medications and treatments. Each process compiles the columns
+for a hierarchy, for the key or the values, once. Reports get copies,
+so nothing one report loads into its columns leaks into another's.
+
+Changes to the hierarchy's sections bump its navigation version. Edits
+to pageblocks, quiz questions & answers or the activities' reference
+data bump a version token in the cache. Every process checks both
+before reusing its copy.
+"""
+import copy
+
+from tobaccocessation.main import versions
+
+
+VERSION_KEY = "main.columns.version"
+
+_compiled = {}  # (hierarchy id, key) -> (version, columns), this process
+
+
+def get_version(hierarchy):
+    from tobaccocessation.main import navigation
+
+    return (versions.get_version(VERSION_KEY),
+            navigation.get_version(hierarchy.id))
+
+
+def invalidate():
+    versions.bump(VERSION_KEY)
+
+
+def walk(hierarchy, key):
+    """the columns, worked out from the tree"""
+    from tobaccocessation.activity_prescription_writing.models import \
+        PrescriptionColumn
+    from tobaccocessation.activity_virtual_patient.models import \
+        VirtualPatientColumn
+    from tobaccocessation.main.models import QuestionColumn
+
+    columns = []
+    for section in hierarchy.get_root().get_descendants():
+        columns += QuestionColumn.all(hierarchy, section, key)
+        columns += PrescriptionColumn.all(hierarchy, section, key)
+        columns += VirtualPatientColumn.all(hierarchy, section, key)
+    return columns
+
+
+def fresh(columns):
+    """copies of the compiled columns without anything loaded for users"""
+    from tobaccocessation.activity_virtual_patient.models import \
+        ActivityStateCache, VirtualPatientColumn
+    from tobaccocessation.main.models import QuestionColumn, \
+        QuizResponseCache
+
+    # the virtual patient columns share a single parse of each state,
+    # the quiz columns a single load of each user's responses
+    state_cache = ActivityStateCache()
+    responses = QuizResponseCache()
+
+    copies = []
+    for column in columns:
+        column = copy.copy(column)
+        if isinstance(column, VirtualPatientColumn):
+            column.state_cache = state_cache
+        elif isinstance(column, QuestionColumn):
+            column.responses = responses
+        else:
+            column._prefetched = None
+        copies.append(column)
+    return copies
+
+
+def get_columns(hierarchy, key):
+    version = get_version(hierarchy)
+    compiled = _compiled.get((hierarchy.id, key))
+    if compiled is None or compiled[0] != version:
+        compiled = (version, walk(hierarchy, key))
+        _compiled[(hierarchy.id, key)] = compiled
+    return fresh(compiled[1])
@@ -6,6 +6,7 @@ from tobaccocessation.main.choices import FACULTY_CHOICES, \
     INSTITUTION_CHOICES, GENDER_CHOICES, RACE_CHOICES, \
     HISPANIC_LATINO_CHOICES, AGE_CHOICES, SPECIALTY_CHOICES
 from tobaccocessation.main.models import UserProfile
+from tobaccocessation.main.provisioning import provision
 
 
 class CreateAccountForm(RegistrationForm):
@@ -132,6 +133,7 @@ def user_created(sender, user, request, **kwargs):
     profile.race = form.data['race']
     profile.age = form.data['age']
     profile.save()
+    provision([user])
 
 
 user_registered.connect(user_created)
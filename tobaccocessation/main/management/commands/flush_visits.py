@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from tobaccocessation.main.visits import flush_pending
+
+
+class Command(BaseCommand):
+    help = "Write the page visit times buffered in the cache. Run from cron."
+
+    def handle(self, *args, **options):
+        self.stdout.write("Flushed %d users" % flush_pending())
@@ -0,0 +1,23 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from tobaccocessation.main.provisioning import provision
+
+
+class Command(BaseCommand):
+    help = "Create missing activity states for users with a profile"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        user_ids = list(User.objects.filter(
+            profile__isnull=False).order_by('id').values_list(
+            'id', flat=True))
+
+        for start in range(0, len(user_ids), batch_size):
+            provision(User.objects.filter(
+                id__in=user_ids[start:start + batch_size]))
+
+        self.stdout.write("Provisioned %d users" % len(user_ids))
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from tobaccocessation.main.reports import run_pending
+
+
+class Command(BaseCommand):
+    help = "Build queued reports, polling the database for new jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="build what's pending, then exit")
+        parser.add_argument('--interval', type=int, default=5,
+                            help="seconds between polls")
+        parser.add_argument('--workers', type=int, default=1,
+                            help="processes computing each report")
+
+    def handle(self, *args, **options):
+        while True:
+            count = run_pending(options['workers'])
+            if count:
+                self.stdout.write("Built %d reports" % count)
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill(apps, schema_editor):
+    Hierarchy = apps.get_model('pagetree', 'Hierarchy')
+    Section = apps.get_model('pagetree', 'Section')
+    UserPageVisit = apps.get_model('pagetree', 'UserPageVisit')
+    UserProgress = apps.get_model('main', 'UserProgress')
+
+    for hierarchy in Hierarchy.objects.all():
+        sections = Section.objects.filter(hierarchy=hierarchy).count()
+        if not sections:
+            continue
+
+        visits = UserPageVisit.objects.filter(
+            section__hierarchy=hierarchy).values('user').annotate(
+            visited=Count('id'))
+        UserProgress.objects.bulk_create([
+            UserProgress(user_id=v['user'], hierarchy=hierarchy,
+                         visited=v['visited'], sections=sections,
+                         percent=v['visited'] * 100 // sections)
+            for v in visits], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pagetree', '0002_delete_testblock'),
+        ('main', '0002_auto_20150612_1525'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserProgress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True,
+                                        serialize=False, verbose_name='ID')),
+                ('visited', models.PositiveIntegerField(default=0)),
+                ('sections', models.PositiveIntegerField(default=0)),
+                ('percent', models.PositiveSmallIntegerField(
+                    db_index=True, default=0)),
+                ('hierarchy', models.ForeignKey(
+                    on_delete=models.deletion.CASCADE,
+                    to='pagetree.Hierarchy')),
+                ('user', models.ForeignKey(
+                    on_delete=models.deletion.CASCADE,
+                    related_name='progress',
+                    to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'user progress',
+                'ordering': ['user', 'hierarchy'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='userprogress',
+            unique_together=set([('user', 'hierarchy')]),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pagetree', '0002_delete_testblock'),
+        ('main', '0003_userprogress'),
+    ]
+
+    # no backfill: completions are worked out the first time they're needed
+    operations = [
+        migrations.CreateModel(
+            name='BlockCompletion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True,
+                                        serialize=False, verbose_name='ID')),
+                ('completed', models.BooleanField(default=False)),
+                ('pageblock', models.ForeignKey(
+                    on_delete=models.deletion.CASCADE,
+                    to='pagetree.PageBlock')),
+                ('user', models.ForeignKey(
+                    on_delete=models.deletion.CASCADE,
+                    related_name='block_completions',
+                    to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='blockcompletion',
+            unique_together=set([('user', 'pageblock')]),
+        ),
+    ]
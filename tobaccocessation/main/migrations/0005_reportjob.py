@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pagetree', '0002_delete_testblock'),
+        ('main', '0004_blockcompletion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True,
+                                        serialize=False, verbose_name='ID')),
+                ('include_superusers', models.BooleanField(default=False)),
+                ('status', models.CharField(
+                    choices=[('pending', 'Pending'), ('running', 'Running'),
+                             ('complete', 'Complete'), ('failed', 'Failed')],
+                    db_index=True, default='pending', max_length=10)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('progress', models.PositiveIntegerField(default=0)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('fingerprint', models.CharField(blank=True, max_length=255)),
+                ('artifact', models.FileField(blank=True,
+                                              upload_to='reports/')),
+                ('error', models.TextField(blank=True)),
+                ('hierarchy', models.ForeignKey(
+                    on_delete=models.deletion.CASCADE,
+                    to='pagetree.Hierarchy')),
+                ('requested_by', models.ForeignKey(
+                    blank=True, null=True,
+                    on_delete=models.deletion.SET_NULL,
+                    to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pagetree', '0002_delete_testblock'),
+        ('main', '0005_reportjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='modified',
+            field=models.DateTimeField(auto_now=True,
+                                       default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='ExportRow',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True,
+                                        serialize=False, verbose_name='ID')),
+                ('schema', models.CharField(max_length=40)),
+                ('modified', models.DateTimeField()),
+                ('row', models.TextField()),
+                ('hierarchy', models.ForeignKey(
+                    on_delete=models.deletion.CASCADE,
+                    to='pagetree.Hierarchy')),
+                ('user', models.ForeignKey(
+                    on_delete=models.deletion.CASCADE,
+                    related_name='export_rows',
+                    to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='exportrow',
+            unique_together=set([('user', 'hierarchy')]),
+        ),
+    ]
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """Created the database cache's table. The cache is memcached now,
+    so there's nothing to do; kept for the migrations that follow."""
+
+    dependencies = [
+        ('main', '0006_exportrow'),
+    ]
+
+    operations = [
+    ]
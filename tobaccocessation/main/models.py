@@ -1,10 +1,24 @@
+import hashlib
+from datetime import timedelta
+
 from django import forms
 from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_out
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
+from django.db.models import Count, F, Max, OuterRef, Subquery, Sum
+from django.db.models.signals import post_save, post_delete
+from django.dispatch.dispatcher import receiver
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
-from pagetree.models import Hierarchy, UserPageVisit
-from quizblock.models import Submission, Response
+from pagetree.models import Hierarchy, UserPageVisit, Section, PageBlock
+from quizblock.models import Answer, Question, Submission, Response
+
+from tobaccocessation.activity_prescription_writing import models as \
+    prescription_writing
+from tobaccocessation.activity_virtual_patient import models as \
+    virtual_patient
+from tobaccocessation.main import columns, navigation, visits
 
 from tobaccocessation.main.choices import GENDER_CHOICES, FACULTY_CHOICES, \
     INSTITUTION_CHOICES, SPECIALTY_CHOICES, RACE_CHOICES, AGE_CHOICES, \
@@ -27,6 +41,7 @@ class UserProfile(models.Model):
     year_of_graduation = models.PositiveIntegerField(blank=True)
     consent_participant = models.BooleanField(default=False)
     consent_not_participant = models.BooleanField(default=False)
+    modified = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.user.username
@@ -81,29 +96,446 @@ class UserProfile(models.Model):
         return section.get_uservisit(self.user) is not None
 
     def set_has_visited(self, sections):
-        for sect in sections:
-            sect.user_pagevisit(self.user, "complete")
-            sect.user_visit(self.user)
+        visits.record(self.user, sections)
 
     def last_location(self):
-        hierarchy = Hierarchy.get_hierarchy(self.role())
-        visits = UserPageVisit.objects.filter(
-            user=self.user).order_by('-last_visit')
+        visits.flush(self.user.id)
+        last_visit = UserPageVisit.objects.filter(
+            user=self.user).order_by('-last_visit').first()
 
-        if visits.count() < 1:
-            return hierarchy.get_first_leaf(hierarchy.get_root())
+        if last_visit is None:
+            return navigation.get_first_leaf(self.role())
         else:
-            return visits.first().section
+            return last_visit.section
 
     def percent_complete(self):
-        hierarchy = Hierarchy.get_hierarchy(self.role())
-        pages = len(hierarchy.get_root().get_descendants()) + 1
-        visits = UserPageVisit.objects.filter(user=self.user,
-                                              section__hierarchy=hierarchy)
-        if pages:
-            return int(len(visits) / float(pages) * 100)
-        else:
+        hierarchy = navigation.get_hierarchy(self.role())
+        progress = UserProgress.objects.filter(
+            user=self.user, hierarchy=hierarchy).first()
+        if progress is None:
             return 0
+        return progress.percent
+
+
+@python_2_unicode_compatible
+class UserProgress(models.Model):
+    """
+    How many of a hierarchy's sections the user has visited. Kept up to
+    date as UserPageVisits come and go, and as sections are added to or
+    removed from the hierarchy, so percent complete is a column read.
+    """
+    user = models.ForeignKey(User, related_name="progress",
+                             on_delete=models.CASCADE)
+    hierarchy = models.ForeignKey(Hierarchy, on_delete=models.CASCADE)
+    visited = models.PositiveIntegerField(default=0)
+    sections = models.PositiveIntegerField(default=0)
+    percent = models.PositiveSmallIntegerField(default=0, db_index=True)
+    # update() skips auto_now, so the class methods set it themselves
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('user', 'hierarchy'),)
+        ordering = ["user", "hierarchy"]
+        verbose_name_plural = "user progress"
+
+    def __str__(self):
+        return "%s %s" % (self.user.username, self.hierarchy.name)
+
+    @classmethod
+    def visit(cls, user_id, hierarchy):
+        progress, created = cls.objects.get_or_create(
+            user_id=user_id, hierarchy=hierarchy,
+            defaults={'sections': navigation.section_count(hierarchy)})
+
+        # the right hand side sees the row as it was before the update
+        cls.objects.filter(id=progress.id).update(
+            visited=F('visited') + 1,
+            percent=(F('visited') + 1) * 100 / F('sections'),
+            modified=timezone.now())
+
+    @classmethod
+    def recount(cls, user_id, hierarchy):
+        """for visits created without post_save, i.e. in bulk"""
+        progress, created = cls.objects.get_or_create(
+            user_id=user_id, hierarchy=hierarchy,
+            defaults={'sections': navigation.section_count(hierarchy)})
+
+        visited = UserPageVisit.objects.filter(
+            user_id=user_id, section__hierarchy=hierarchy).count()
+        cls.objects.filter(id=progress.id).update(
+            visited=visited, percent=visited * 100 / F('sections'),
+            modified=timezone.now())
+
+    @classmethod
+    def unvisit(cls, user_id, section_id):
+        cls.objects.filter(
+            user_id=user_id, visited__gt=0,
+            hierarchy__section__id=section_id).update(
+            visited=F('visited') - 1,
+            percent=(F('visited') - 1) * 100 / F('sections'),
+            modified=timezone.now())
+
+    @classmethod
+    def resize(cls, hierarchy_id):
+        sections = Section.objects.filter(hierarchy_id=hierarchy_id).count()
+        if sections:
+            cls.objects.filter(hierarchy_id=hierarchy_id).update(
+                sections=sections, percent=F('visited') * 100 / sections,
+                modified=timezone.now())
+
+
+@receiver(post_save, sender=Section)
+@receiver(post_delete, sender=Section)
+def section_changed(sender, instance, *args, **kwargs):
+    navigation.invalidate(instance.hierarchy_id)
+
+
+@receiver(post_save, sender=Hierarchy)
+@receiver(post_delete, sender=Hierarchy)
+def hierarchy_changed(sender, instance, *args, **kwargs):
+    navigation.invalidate_hierarchies()
+    navigation.invalidate(instance.id)
+
+
+@receiver(post_save, sender=Section)
+def section_added(sender, instance, created, **kwargs):
+    if created:
+        UserProgress.resize(instance.hierarchy_id)
+
+
+@receiver(post_delete, sender=Section)
+def section_removed(sender, instance, **kwargs):
+    UserProgress.resize(instance.hierarchy_id)
+
+
+@receiver(post_save, sender=UserPageVisit)
+def page_visited(sender, instance, created, **kwargs):
+    if created:
+        UserProgress.visit(instance.user_id, instance.section.hierarchy)
+
+
+@receiver(post_delete, sender=UserPageVisit)
+def page_visit_removed(sender, instance, **kwargs):
+    UserProgress.unvisit(instance.user_id, instance.section_id)
+    ExportRow.objects.filter(user_id=instance.user_id).delete()
+
+
+@receiver(user_logged_out)
+def flush_visits(sender, request, user, **kwargs):
+    if user is not None:
+        visits.flush(user.id)
+
+
+def gates(content_type_id):
+    """blocks of this type have to be completed to get past their page"""
+    model = ContentType.objects.get_for_id(content_type_id).model_class()
+    return hasattr(model, 'unlocked')
+
+
+@python_2_unicode_compatible
+class BlockCompletion(models.Model):
+    """
+    Whether the user has completed a gating page block, i.e. what its
+    unlocked(user) last returned. Written when the block's page is
+    submitted or reset. No row means it isn't known yet; it's worked out
+    & stored the next time the page is gated on.
+    """
+    user = models.ForeignKey(User, related_name="block_completions",
+                             on_delete=models.CASCADE)
+    pageblock = models.ForeignKey(PageBlock, on_delete=models.CASCADE)
+    completed = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = (('user', 'pageblock'),)
+
+    def __str__(self):
+        return "%s %s" % (self.user.username, self.pageblock_id)
+
+    @classmethod
+    def gating(cls, pageblocks, user):
+        """
+        (pageblock id, section id, content type id, object id, completed)
+        for the gating pageblocks, in one query. completed is None when
+        it isn't known yet.
+        """
+        completed = cls.objects.filter(
+            user=user, pageblock=OuterRef('pk')).values('completed')[:1]
+        rows = pageblocks.annotate(
+            completed=Subquery(completed)).values_list(
+            'id', 'section_id', 'content_type_id', 'object_id', 'completed')
+        return [row for row in rows if gates(row[2])]
+
+    @classmethod
+    def store(cls, user, completions):
+        """completions maps pageblock id -> completed"""
+        if len(completions) < 1:
+            return
+
+        cls.objects.filter(
+            user=user, pageblock_id__in=completions.keys()).delete()
+        cls.objects.bulk_create(
+            [cls(user=user, pageblock_id=pageblock_id, completed=completed)
+             for (pageblock_id, completed) in completions.items()],
+            ignore_conflicts=True)
+
+    @classmethod
+    def refresh(cls, user, section):
+        """work the section's completions out again, e.g. after a submit"""
+        completions = {}
+        for pageblock in section.pageblock_set.all():
+            block = pageblock.block()
+            if hasattr(block, 'unlocked'):
+                completions[pageblock.id] = block.unlocked(user)
+        cls.store(user, completions)
+
+    @classmethod
+    def forget(cls, model, **kwargs):
+        """drop the completions of model's blocks, narrowed by kwargs,
+        to be worked out again when next needed"""
+        ctype = ContentType.objects.get_for_model(model)
+        cls.objects.filter(pageblock__content_type=ctype, **kwargs).delete()
+
+
+@receiver(virtual_patient.patient_state_changed)
+def patient_state_changed(sender, user, hierarchy, **kwargs):
+    # a hierarchy's patient blocks all gate on the one state
+    BlockCompletion.forget(virtual_patient.PatientAssessmentBlock,
+                           user=user, pageblock__section__hierarchy=hierarchy)
+
+
+def virtual_patient_changed(sender, **kwargs):
+    BlockCompletion.forget(virtual_patient.PatientAssessmentBlock)
+
+
+def prescription_changed(sender, **kwargs):
+    BlockCompletion.forget(prescription_writing.Block)
+
+
+for model in [virtual_patient.PatientAssessmentBlock,
+              virtual_patient.Medication,
+              virtual_patient.ConcentrationChoice,
+              virtual_patient.DosageChoice,
+              virtual_patient.TreatmentOption]:
+    post_save.connect(virtual_patient_changed, sender=model)
+    post_delete.connect(virtual_patient_changed, sender=model)
+
+for model in [prescription_writing.Block, prescription_writing.Medication]:
+    post_save.connect(prescription_changed, sender=model)
+    post_delete.connect(prescription_changed, sender=model)
+
+
+def report_columns_changed(sender, **kwargs):
+    columns.invalidate()
+
+
+# what the report's columns are worked out from, besides the sections
+REPORT_COLUMN_MODELS = [Hierarchy, PageBlock, Question, Answer,
+                        prescription_writing.Block,
+                        prescription_writing.Medication,
+                        virtual_patient.PatientAssessmentBlock,
+                        virtual_patient.Patient,
+                        virtual_patient.Medication,
+                        virtual_patient.TreatmentClassification,
+                        virtual_patient.TreatmentOption]
+
+# what the values in the columns are worked out from, besides the user's
+# own data. These don't change the columns themselves.
+REPORT_VALUE_MODELS = [virtual_patient.ConcentrationChoice,
+                       virtual_patient.DosageChoice,
+                       virtual_patient.TreatmentFeedback]
+
+for model in REPORT_COLUMN_MODELS:
+    post_save.connect(report_columns_changed, sender=model)
+    post_delete.connect(report_columns_changed, sender=model)
+
+
+@python_2_unicode_compatible
+class ReportJob(models.Model):
+    """
+    A research export, built by the run_report_jobs worker instead of in
+    the request. Jobs are queued in this table: the worker claims the
+    oldest pending one, builds its zip into storage and records its
+    progress as it goes.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    COMPLETE = 'complete'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (COMPLETE, 'Complete'),
+        (FAILED, 'Failed'),
+    )
+
+    # a finished report is reused for this long, if nothing changed
+    REUSE_SECONDS = 60 * 60
+    # a job running longer than this is presumed dead
+    RUNNING_SECONDS = 60 * 60 * 6
+
+    hierarchy = models.ForeignKey(Hierarchy, on_delete=models.CASCADE)
+    include_superusers = models.BooleanField(default=False)
+    requested_by = models.ForeignKey(User, null=True, blank=True,
+                                     on_delete=models.SET_NULL)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    progress = models.PositiveIntegerField(default=0)  # users written
+    total = models.PositiveIntegerField(default=0)
+    # what the data looked like when the report was built
+    fingerprint = models.CharField(max_length=255, blank=True)
+    artifact = models.FileField(upload_to='reports/', blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['-created']
+
+    def __str__(self):
+        return "%s report %d (%s)" % (self.hierarchy.name, self.id,
+                                      self.status)
+
+    def filename(self):
+        return "tobacco_%s.zip" % self.hierarchy.name
+
+    def as_dict(self):
+        return {'id': self.id, 'status': self.status,
+                'progress': self.progress, 'total': self.total}
+
+    @classmethod
+    def fingerprint_for(cls, hierarchy, include_superusers):
+        """
+        Changes when any of the data the report reads does: profiles,
+        quiz submissions, activity states, progress and the tree itself.
+        Worked out from the database alone, so the web processes and the
+        worker agree on it.
+        """
+        profiles = UserProfile.objects.filter(consent_participant=True)
+        if not include_superusers:
+            profiles = profiles.filter(user__is_superuser=False)
+
+        parts = []
+        for (queryset, aggregates) in [
+                (profiles, [Count('id'), Max('id'), Max('modified')]),
+                (Submission.objects, [Count('id'), Max('id')]),
+                (virtual_patient.ActivityState.objects.filter(
+                    hierarchy=hierarchy),
+                 [Count('id'), Sum('version'), Max('modified')]),
+                (prescription_writing.ActivityState.objects,
+                 [Count('id'), Max('modified')]),
+                (UserProgress.objects,
+                 [Count('id'), Sum('visited'), Max('modified')])]:
+            values = queryset.aggregate(*aggregates)
+            parts += [str(values[k]) for k in sorted(values.keys())]
+
+        # the columns & their reference data: small tables, so every
+        # row counts
+        parts.append(str(list(Section.objects.filter(
+            hierarchy=hierarchy).order_by('path').values_list(
+            'id', 'path', 'label', 'slug'))))
+        for model in REPORT_COLUMN_MODELS + REPORT_VALUE_MODELS:
+            parts.append(str(list(
+                model.objects.order_by('pk').values_list())))
+
+        return hashlib.sha1(
+            "\n".join(parts).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def enqueue(cls, hierarchy, include_superusers, user=None):
+        """
+        The job that will produce the report: one already queued or
+        running for the same options, a recent one built from the same
+        data, or else a new one.
+        """
+        jobs = cls.objects.filter(hierarchy=hierarchy,
+                                  include_superusers=include_superusers)
+
+        now = timezone.now()
+        job = jobs.filter(status=cls.PENDING).first() or jobs.filter(
+            status=cls.RUNNING,
+            started__gte=now - timedelta(seconds=cls.RUNNING_SECONDS)
+        ).first()
+        if job is not None:
+            return job
+
+        job = jobs.filter(
+            status=cls.COMPLETE,
+            finished__gte=now - timedelta(seconds=cls.REUSE_SECONDS)).first()
+        if (job is not None and job.fingerprint ==
+                cls.fingerprint_for(hierarchy, include_superusers)):
+            return job
+
+        return cls.objects.create(hierarchy=hierarchy,
+                                  include_superusers=include_superusers,
+                                  requested_by=user)
+
+    @classmethod
+    def claim(cls):
+        """Take the oldest pending job for this worker, or None. The
+        conditional update makes sure no other worker also takes it."""
+        for job in cls.objects.filter(status=cls.PENDING).order_by(
+                'created', 'id')[:10]:
+            claimed = cls.objects.filter(
+                id=job.id, status=cls.PENDING).update(
+                status=cls.RUNNING, started=timezone.now())
+            if claimed:
+                job.refresh_from_db()
+                return job
+        return None
+
+    def update_progress(self, progress):
+        self.progress = progress
+        ReportJob.objects.filter(id=self.id).update(progress=progress)
+
+
+class ExportRow(models.Model):
+    """
+    A user's row in a hierarchy's research export, as of the latest
+    change to the data it was computed from. The next export reuses it
+    if none of that data changed since.
+    """
+    user = models.ForeignKey(User, related_name='export_rows',
+                             on_delete=models.CASCADE)
+    hierarchy = models.ForeignKey(Hierarchy, on_delete=models.CASCADE)
+    # the tree & columns the row was computed for
+    schema = models.CharField(max_length=40)
+    # when the row's inputs last changed
+    modified = models.DateTimeField()
+    row = models.TextField()  # json list of values
+
+    class Meta:
+        unique_together = (("user", "hierarchy"),)
+
+    @classmethod
+    def input_times(cls, hierarchy, profiles):
+        """
+        user id -> when the data in their row last changed: their
+        profile, page visits, progress, quiz submissions & activity
+        states. Progress is for any hierarchy, as percent complete is
+        read from the one for the user's role.
+        """
+        times = dict([(p.user_id, p.modified) for p in profiles])
+        for (queryset, field) in [
+                (UserPageVisit.objects.filter(section__hierarchy=hierarchy),
+                 'last_visit'),
+                (UserProgress.objects, 'modified'),
+                (Submission.objects, 'submitted'),
+                (virtual_patient.ActivityState.objects.filter(
+                    hierarchy=hierarchy), 'modified'),
+                (prescription_writing.ActivityState.objects, 'modified')]:
+            latest = queryset.filter(user_id__in=times.keys()).order_by() \
+                .values_list('user_id').annotate(Max(field))
+            for (user_id, modified) in latest:
+                if modified is not None and modified > times[user_id]:
+                    times[user_id] = modified
+        return times
+
+
+@receiver(post_delete, sender=Submission)
+def submission_removed(sender, instance, **kwargs):
+    # the latest input time may not change when one is removed
+    ExportRow.objects.filter(user_id=instance.user_id).delete()
 
 
 class QuickFixProfileForm(forms.Form):
@@ -205,16 +637,90 @@ def clean_header(s):
     return s
 
 
+class QuizResponseCache(object):
+    """
+    Users' latest quiz responses, keyed by user & quiz. Loaded for many
+    users at once and shared by every column of a quiz, including the
+    one per answer of a multiple choice question.
+    """
+
+    def __init__(self):
+        # user id -> {quiz id -> {question id -> [values]}}
+        self._responses = {}
+        # user id -> {question id -> set of values}
+        self._chosen = {}
+        # quiz id -> {question id -> {value -> answer id}}
+        self._answers = {}
+
+    def load(self, quiz_ids, users):
+        """
+        Fetch the users' latest submission to each quiz & its responses
+        in two queries. Users without a submission get no responses.
+        """
+        user_ids = [user.id for user in users]
+        for user_id in user_ids:
+            self._chosen.pop(user_id, None)
+            quizzes = self._responses.setdefault(user_id, {})
+            for quiz_id in quiz_ids:
+                quizzes[quiz_id] = {}
+
+        # later submissions replace earlier ones
+        latest = {}
+        submissions = Submission.objects.filter(
+            quiz__id__in=quiz_ids, user__id__in=user_ids).order_by(
+            'submitted', 'id')
+        for pk, quiz_id, user_id in submissions.values_list(
+                'id', 'quiz_id', 'user_id'):
+            latest[(user_id, quiz_id)] = pk
+        if len(latest) == 0:
+            return
+
+        by_submission = dict([(pk, self._responses[user_id][quiz_id])
+                              for ((user_id, quiz_id), pk) in latest.items()])
+        responses = Response.objects.filter(
+            submission__id__in=by_submission.keys()).order_by('question', 'id')
+        for submission_id, question_id, value in responses.values_list(
+                'submission_id', 'question_id', 'value'):
+            by_submission[submission_id].setdefault(
+                question_id, []).append(value)
+
+    def values(self, question, user):
+        quizzes = self._responses.get(user.id, {})
+        if question.quiz_id not in quizzes:
+            self.load([question.quiz_id], [user])
+            quizzes = self._responses[user.id]
+        return quizzes[question.quiz_id].get(question.id, [])
+
+    def chosen(self, question, user):
+        """the set of values the user chose for the question"""
+        chosen = self._chosen.setdefault(user.id, {})
+        if question.id not in chosen:
+            chosen[question.id] = frozenset(self.values(question, user))
+        return chosen[question.id]
+
+    def answer_id(self, question, value):
+        """the id of the question's first answer with the value, or ''"""
+        if question.quiz_id not in self._answers:
+            answers = {}
+            for answer_id, question_id, v in Answer.objects.filter(
+                    question__quiz__id=question.quiz_id).values_list(
+                    'id', 'question_id', 'value'):
+                answers.setdefault(question_id, {}).setdefault(v, answer_id)
+            self._answers[question.quiz_id] = answers
+        return self._answers[question.quiz_id].get(
+            question.id, {}).get(value, '')
+
+    def evict(self, user):
+        self._responses.pop(user.id, None)
+        self._chosen.pop(user.id, None)
+
+
 class QuestionColumn(object):
     def __init__(self, hierarchy, question, answer=None):
         self.hierarchy = hierarchy
         self.question = question
         self.answer = answer
-        self._submission_cache = Submission.objects.filter(
-            quiz=self.question.quiz)
-        self._response_cache = Response.objects.filter(
-            question=self.question)
-        self._answer_cache = self.question.answer_set.all()
+        self.responses = None  # a QuizResponseCache, shared once prefetched
 
     def question_id(self):
         return "%s_%s" % (self.hierarchy.id, self.question.id)
@@ -241,29 +747,56 @@ class QuestionColumn(object):
             row.append(clean_header(self.answer.label))
         return row
 
+    def response_cache(self):
+        if self.responses is None:
+            # on its own, a column reads the latest responses every time
+            return QuizResponseCache()
+        return self.responses
+
+    def user_responses(self, user):
+        """The values of the user's latest responses to this question"""
+        return self.response_cache().values(self.question, user)
+
     def user_value(self, user):
-        r = self._submission_cache.filter(user=user).order_by("-submitted")
-        if r.count() == 0:
-            # user has not submitted this form
-            return ""
-        submission = r[0]
-        r = self._response_cache.filter(submission=submission)
-        if r.count() > 0:
+        responses = self.response_cache()
+        if self.question.is_multiple_choice():
+            if self.answer.value in responses.chosen(self.question, user):
+                return self.answer.id
+            return ''
+
+        values = responses.values(self.question, user)
+        if len(values) > 0:
             if (self.question.is_short_text() or
                     self.question.is_long_text()):
-                return r[0].value
-            elif self.question.is_multiple_choice():
-                if self.answer.value in [res.value for res in r]:
-                    return self.answer.id
+                return values[0]
             else:  # single choice
-                return self.single_choice_answer(r)
+                return responses.answer_id(self.question, values[0])
         return ''
 
-    def single_choice_answer(self, r):
-        for a in self._answer_cache:
-            if a.value == r[0].value:
-                return a.id
-        return ''
+    @classmethod
+    def prefetch(cls, columns, users):
+        """
+        Load the latest quiz submission & responses for a page of users
+        in two queries, shared by all the given columns.
+        """
+        quiz_ids = set([c.question.quiz_id for c in columns])
+        if len(quiz_ids) == 0:
+            return
+
+        responses = columns[0].responses
+        if responses is None:
+            responses = QuizResponseCache()
+
+        responses.load(quiz_ids, users)
+        for column in columns:
+            column.responses = responses
+
+    @classmethod
+    def evict(cls, columns, user):
+        """Drop a user's responses once their report row is written"""
+        for responses in set([c.responses for c in columns]):
+            if responses is not None:
+                responses.evict(user)
 
     @classmethod
     def all(cls, hrchy, section, key=True):
@@ -272,7 +805,8 @@ class QuestionColumn(object):
 
         # quizzes
         for p in section.pageblock_set.filter(content_type=ctype):
-            for q in p.block().question_set.all():
+            questions = p.block().question_set.prefetch_related('answer_set')
+            for q in questions:
                 if q.answerable() and (key or q.is_multiple_choice()):
                     # need to make a column for each answer
                     for a in q.answer_set.all():
@@ -0,0 +1,224 @@
+"""
+Precomputed depth-first navigation for pagetree hierarchies.
+
+The index for a hierarchy is built once from the treebeard tree and
+kept both in this process and in the cache backend, so navigation
+lookups are dictionary reads. Any change to the hierarchy's sections
+bumps its version in the cache, which every process checks before
+reusing its own copy.
+
+Hierarchies themselves are looked up by name through a registry kept the
+same way, so resolving a hierarchy, its root, first leaf or a section by
+path takes no queries.
+"""
+from django.core.cache import cache
+
+from tobaccocessation.main import versions
+
+
+_indexes = {}  # hierarchy id -> NavigationIndex, for this process
+_registry = {'version': None, 'hierarchies': {}}  # for this process
+
+REGISTRY_VERSION_KEY = "main.navigation.hierarchies.version"
+
+INDEX_TIMEOUT = 60 * 60 * 24
+
+
+class NavigationIndex(object):
+
+    def __init__(self, sections):
+        """sections is the depth-first traversal, starting at the root"""
+        self.version = None
+        self.sections = sections
+        self._position = {}
+        self._ancestors = {}
+        self._previous_leaf = {}
+        self._first_leaf = {}
+        self._by_path = {}
+
+        stack = []
+        last_leaf = None
+        for (i, s) in enumerate(sections):
+            self._position[s.id] = i
+
+            while len(stack) > 0 and stack[-1].depth >= s.depth:
+                stack.pop()
+            self._ancestors[s.id] = list(stack)
+            # by the slugs below the root, as in the section's url
+            if i == 0:
+                self._by_path[""] = s
+            else:
+                self._by_path["/".join(
+                    [a.slug for a in stack[1:]] + [s.slug])] = s
+            stack.append(s)
+
+            # the closest preceding leaf, never the root
+            self._previous_leaf[s.id] = last_leaf
+            if i > 0 and s.is_leaf():
+                last_leaf = s
+
+        following = None
+        for s in reversed(sections):
+            if s.is_leaf():
+                self._first_leaf[s.id] = s
+            else:
+                self._first_leaf[s.id] = self._first_leaf[following.id]
+            following = s
+
+    @classmethod
+    def build(cls, hierarchy):
+        from pagetree.models import Section
+        root = hierarchy.get_root()
+        return cls(list(Section.get_tree(root).select_related('hierarchy')))
+
+    def __contains__(self, section):
+        return section is not None and section.id in self._position
+
+    def root(self):
+        return self.sections[0]
+
+    def next(self, section):
+        """next node in the depth-first traversal"""
+        i = self._position.get(section.id)
+        if i is None or i + 1 >= len(self.sections):
+            return None
+        return self.sections[i + 1]
+
+    def previous(self, section):
+        """previous node in the depth-first traversal, excluding the root"""
+        i = self._position.get(section.id)
+        if i is None or i < 2:
+            return None
+        return self.sections[i - 1]
+
+    def previous_leaf(self, section):
+        return self._previous_leaf.get(section.id)
+
+    def first_leaf(self, section):
+        return self._first_leaf.get(section.id)
+
+    def find(self, path):
+        """the section at the path below the hierarchy's base url"""
+        return self._by_path.get(path.strip("/"))
+
+    def ancestors(self, section):
+        """root first, not including the section itself"""
+        return self._ancestors.get(section.id, [])
+
+    def module(self, section):
+        """the top level section that the section is in"""
+        ancestors = self.ancestors(section)
+        if len(ancestors) == 0:
+            return None  # root
+        if len(ancestors) == 1:
+            return self.sections[self._position[section.id]]
+        return ancestors[1]
+
+
+def _version_key(hierarchy_id):
+    return "main.navigation.%d.version" % hierarchy_id
+
+
+def _index_key(hierarchy_id, version):
+    return "main.navigation.%d.%s" % (hierarchy_id, version)
+
+
+def get_version(hierarchy_id):
+    return versions.get_version(_version_key(hierarchy_id))
+
+
+def invalidate(hierarchy_id):
+    versions.bump(_version_key(hierarchy_id))
+
+
+def get_navigation(hierarchy, section=None):
+    """
+    The navigation index for the hierarchy. If a section is given and
+    the index does not know about it yet, the index is rebuilt.
+    """
+    version = get_version(hierarchy.id)
+
+    index = _indexes.get(hierarchy.id)
+    if index is not None and index.version == version and (
+            section is None or section in index):
+        return index
+
+    key = _index_key(hierarchy.id, version)
+    index = cache.get(key)
+    if index is not None and section is not None and section not in index:
+        invalidate(hierarchy.id)
+        version = get_version(hierarchy.id)
+        key = _index_key(hierarchy.id, version)
+        index = None
+
+    if index is None:
+        index = NavigationIndex.build(hierarchy)
+        index.version = version
+        cache.set(key, index, INDEX_TIMEOUT)
+
+    _indexes[hierarchy.id] = index
+    return index
+
+
+def _registry_key(version):
+    return "main.navigation.hierarchies.%s" % version
+
+
+def invalidate_hierarchies():
+    versions.bump(REGISTRY_VERSION_KEY)
+
+
+def get_hierarchy(name):
+    """
+    The named Hierarchy, created if it doesn't exist yet, as
+    pagetree.helpers.get_hierarchy does. Hierarchy objects are shared, so
+    don't change them.
+    """
+    from pagetree.models import Hierarchy
+
+    if isinstance(name, Hierarchy):
+        return name
+
+    version = versions.get_version(REGISTRY_VERSION_KEY)
+
+    if _registry['version'] != version:
+        _registry['version'] = version
+        _registry['hierarchies'] = cache.get(_registry_key(version)) or {}
+
+    hierarchies = _registry['hierarchies']
+    if name not in hierarchies:
+        hierarchies[name] = Hierarchy.objects.get_or_create(
+            name=name, defaults=dict(base_url="/"))[0]
+        cache.set(_registry_key(version), hierarchies, INDEX_TIMEOUT)
+    return hierarchies[name]
+
+
+def get_root(hierarchy):
+    return get_navigation(get_hierarchy(hierarchy)).root()
+
+
+def get_first_leaf(hierarchy):
+    index = get_navigation(get_hierarchy(hierarchy))
+    return index.first_leaf(index.root())
+
+
+def get_section(hierarchy, path):
+    """the section at the path in the hierarchy, or Http404. Stands in
+    for pagetree.helpers.get_section_from_path."""
+    hierarchy = get_hierarchy(hierarchy)
+    section = get_navigation(hierarchy).find(path)
+    if section is None:
+        section = hierarchy.get_section_from_path(path)
+        # the index didn't know about it, so it's out of date
+        get_navigation(hierarchy, section)
+    return section
+
+
+def section_count(hierarchy):
+    return len(get_navigation(hierarchy).sections)
+
+
+def clear_section_caches(section):
+    """PAGETREE_CUSTOM_CACHE_CLEAR hook. pagetree calls this after
+    sections are moved or reordered, which bypasses post_save."""
+    invalidate(section.hierarchy_id)
@@ -0,0 +1,18 @@
+"""
+Creates the activity state rows a user needs up front, when their profile
+is created, so the pages they read afterwards never have to insert them.
+"""
+from tobaccocessation.activity_prescription_writing.models import \
+    ActivityState as PrescriptionWritingState
+from tobaccocessation.activity_virtual_patient.models import \
+    ActivityState as VirtualPatientActivityState
+
+
+def provision(users):
+    """bulk create every missing activity state for the users"""
+    users = list(users)
+    if len(users) < 1:
+        return
+
+    PrescriptionWritingState.provision(users)
+    VirtualPatientActivityState.provision(users)
@@ -0,0 +1,190 @@
+"""
+Builds queued ReportJobs, outside of any request. The run_report_jobs
+management command is the worker: it claims pending jobs from the
+database one at a time and writes each report's zip to storage.
+
+Each user's row is kept as an ExportRow, and only recomputed once any
+of the data it was computed from changes, or the hierarchy does.
+
+With more than one worker process, the values are computed in shards of
+consecutive user ids, each in its own process with its own database
+connection, and merged back in user order. The csv comes out the same
+as when it's built in one process.
+"""
+import hashlib
+import json
+import multiprocessing
+import tempfile
+import traceback
+import uuid
+
+from django.core.files import File
+from django.db import connections
+from django.utils import timezone
+from pagetree.models import Hierarchy
+
+from tobaccocessation.activity_virtual_patient import catalog
+from tobaccocessation.main.columns import \
+    get_version as columns_version
+from tobaccocessation.main.models import ExportRow, ReportJob
+from tobaccocessation.main.views import REPORT_PAGE_SIZE, \
+    _all_results_key, _get_columns, _page_rows, _profile_pages, \
+    _report_profiles, _results_header, stream_zip
+
+
+SHARDS_PER_WORKER = 4  # smaller shards even out the workers' load
+
+
+def shard_bounds(profiles, count):
+    """
+    Split the profiles into at most count shards of consecutive user
+    ids, returning (first user id, next shard's first user id) pairs.
+    The last shard is open ended.
+    """
+    user_ids = list(profiles.order_by('user_id').values_list(
+        'user_id', flat=True))
+    if len(user_ids) < 1:
+        return []
+
+    size = -(-len(user_ids) // count)  # rounded up
+    starts = user_ids[::size]
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def export_schema(hierarchy, columns):
+    """identifies the tree, columns & reference data rows are computed
+    for, so rows are recomputed when any of them change"""
+    schema = json.dumps([columns_version(hierarchy), catalog.get_version(),
+                         _results_header(columns)])
+    return hashlib.sha1(schema.encode('utf-8')).hexdigest()
+
+
+def cached_rows(hierarchy, columns, profiles):
+    """
+    The rows for the profiles, in user order. Stored rows are reused
+    where the user's data hasn't changed since, the rest are computed
+    and stored for next time.
+    """
+    schema = export_schema(hierarchy, columns)
+    for page in _profile_pages(profiles):
+        times = ExportRow.input_times(hierarchy, page)
+        stored = dict([
+            (r.user_id, r) for r in ExportRow.objects.filter(
+                hierarchy=hierarchy, schema=schema,
+                user_id__in=times.keys())
+            if r.modified == times[r.user_id]])
+
+        stale = [p for p in page if p.user_id not in stored]
+        fresh = [ExportRow(user_id=profile.user_id, hierarchy=hierarchy,
+                           schema=schema, modified=times[profile.user_id],
+                           row=json.dumps(row))
+                 for (profile, row) in zip(stale, _page_rows(columns, stale))]
+        if len(fresh) > 0:
+            ExportRow.objects.filter(
+                hierarchy=hierarchy,
+                user_id__in=[r.user_id for r in fresh]).delete()
+            # another job may be storing the same users
+            ExportRow.objects.bulk_create(fresh, ignore_conflicts=True)
+            stored.update([(r.user_id, r) for r in fresh])
+
+        for profile in page:
+            yield json.loads(stored[profile.user_id].row)
+
+
+def shard_rows(shard):
+    """the value rows for one shard. Runs in a worker process."""
+    (hierarchy_id, include_superusers, first, end) = shard
+
+    profiles = _report_profiles(include_superusers).filter(
+        user_id__gte=first)
+    if end is not None:
+        profiles = profiles.filter(user_id__lt=end)
+
+    hierarchy = Hierarchy.objects.get(id=hierarchy_id)
+    return list(cached_rows(hierarchy, _get_columns(False, hierarchy),
+                            profiles))
+
+
+def sharded_results(hierarchy, include_superusers, workers):
+    """_all_results, computed by a pool of worker processes"""
+    yield _results_header(_get_columns(False, hierarchy))
+
+    shards = [(hierarchy.id, include_superusers, first, end)
+              for (first, end) in shard_bounds(
+                  _report_profiles(include_superusers),
+                  workers * SHARDS_PER_WORKER)]
+
+    if workers < 2:
+        for rows in map(shard_rows, shards):
+            for row in rows:
+                yield row
+        return
+
+    # shard_rows needs a forked copy of this process, with Django set up
+    # and its caches warm, whatever the platform's default start method.
+    # The workers must open their own connections, not share ours.
+    connections.close_all()
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        # imap hands the shards back in order, whichever finishes first
+        for rows in pool.imap(shard_rows, shards):
+            for row in rows:
+                yield row
+
+
+def counted(rows, job):
+    """pass the rows through, recording the job's progress every page"""
+    written = -1  # not counting the header
+    for row in rows:
+        yield row
+        written += 1
+        if written > 0 and written % REPORT_PAGE_SIZE == 0:
+            job.update_progress(written)
+    job.update_progress(max(written, 0))
+
+
+def build(job, workers=1):
+    hierarchy = job.hierarchy
+    job.fingerprint = ReportJob.fingerprint_for(
+        hierarchy, job.include_superusers)
+    job.total = _report_profiles(job.include_superusers).count()
+    job.save(update_fields=['fingerprint', 'total'])
+
+    files = [
+        ("tobacco_%s_key.csv" % hierarchy.name,
+         _all_results_key(hierarchy)),
+        ("tobacco_%s_values.csv" % hierarchy.name,
+         counted(sharded_results(hierarchy, job.include_superusers,
+                                 workers), job))]
+
+    with tempfile.TemporaryFile() as f:
+        for chunk in stream_zip(files):
+            f.write(chunk)
+        f.seek(0)
+        # a name that can't be guessed, wherever storage serves it
+        job.artifact.save("%s/%s" % (uuid.uuid4().hex, job.filename()),
+                          File(f), save=False)
+
+    job.status = ReportJob.COMPLETE
+    job.finished = timezone.now()
+    job.save()
+
+
+def run(job, workers=1):
+    try:
+        build(job, workers)
+    except Exception:
+        job.status = ReportJob.FAILED
+        job.finished = timezone.now()
+        job.error = traceback.format_exc()
+        job.save()
+
+
+def run_pending(workers=1):
+    """build every pending job, returning how many were run"""
+    count = 0
+    job = ReportJob.claim()
+    while job is not None:
+        run(job, workers)
+        count += 1
+        job = ReportJob.claim()
+    return count
@@ -1,4 +1,5 @@
 from django import template
+from tobaccocessation.main import navigation
 from tobaccocessation.main.views import accessible as section_accessible
 
 register = template.Library()
@@ -16,7 +17,7 @@ class AccessibleNode(template.Node):
         if 'request' in context:
             r = context['request']
             u = r.user
-            if section_accessible(s, u):
+            if section_accessible(s, u, r):
                 return self.nodelist_true.render(context)
 
         return self.nodelist_false.render(context)
@@ -33,3 +34,30 @@ def accessible(parser, token):
     else:
         nodelist_false = None
     return AccessibleNode(section, nodelist_true, nodelist_false)
+
+
+@register.simple_tag(takes_context=True)
+def navkey(context, root, gated=True):
+    """
+    Identifies how the nav under root renders: the version of the
+    hierarchy, and if gated which of its sections the user can get to.
+    Changes when the tree is edited or the user unlocks a section, so it
+    can key a cached nav fragment.
+    """
+    hierarchy = root.hierarchy
+    version = navigation.get_version(hierarchy.id)
+    if not gated or 'request' not in context:
+        return "%d.%s" % (hierarchy.id, version)
+
+    request = context['request']
+    sections = navigation.get_navigation(hierarchy).sections
+    bits = "".join([
+        section_accessible(s, request.user, request) and "1" or "0"
+        for s in sections])
+    return "%d.%s.%s" % (hierarchy.id, version, bits)
+
+
+@register.simple_tag
+def navversion(name):
+    """the version of the named hierarchy's tree"""
+    return navigation.get_version(navigation.get_hierarchy(name).id)
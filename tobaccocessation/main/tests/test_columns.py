@@ -0,0 +1,83 @@
+from django.core.cache import cache
+from django.test import TestCase
+from pagetree.models import Hierarchy
+from quizblock.models import Answer, Question, Quiz
+
+from tobaccocessation.activity_prescription_writing.models import \
+    Block as PrescriptionBlock
+from tobaccocessation.activity_virtual_patient.models import Patient, \
+    PatientAssessmentBlock, TreatmentClassification
+from tobaccocessation.main import columns
+
+
+def identifiers(cols):
+    return [c.identifier() for c in cols]
+
+
+class ColumnsTest(TestCase):
+    fixtures = ['prescriptionwriting.json', 'virtualpatient.json']
+
+    def setUp(self):
+        cache.clear()
+        self.hierarchy = Hierarchy.objects.create(name="main", base_url="/")
+        root = self.hierarchy.get_root()
+        self.one = root.append_child("One", "one")
+        self.two = root.append_child("Two", "two")
+
+        self.quiz = Quiz.objects.create()
+        self.one.append_pageblock(label="quiz", css_extra="",
+                                  content_object=self.quiz)
+        self.question = Question.objects.create(
+            quiz=self.quiz, text="foo", question_type="multiple choice")
+        Answer.objects.create(question=self.question, value="a", label="A")
+
+        self.one.append_pageblock(
+            label="rx", css_extra="",
+            content_object=PrescriptionBlock.objects.create(
+                medication_name="Nicotine Patch"))
+        self.two.append_pageblock(
+            label="patient", css_extra="",
+            content_object=PatientAssessmentBlock.objects.create(
+                patient=Patient.objects.first(),
+                view=PatientAssessmentBlock.CLASSIFY_TREATMENTS))
+
+    def test_compiled_once(self):
+        for key in [True, False]:
+            expected = identifiers(columns.walk(self.hierarchy, key))
+            self.assertEquals(
+                identifiers(columns.get_columns(self.hierarchy, key)),
+                expected)
+
+            with self.assertNumQueries(0):
+                cols = columns.get_columns(self.hierarchy, key)
+            self.assertEquals(identifiers(cols), expected)
+
+    def test_copies(self):
+        first = columns.get_columns(self.hierarchy, False)
+        second = columns.get_columns(self.hierarchy, False)
+        for (a, b) in zip(first, second):
+            self.assertFalse(a is b)
+
+        self.assertFalse(first[0].responses is second[0].responses)
+        self.assertFalse(first[-1].state_cache is second[-1].state_cache)
+
+    def test_recompiled_on_change(self):
+        before = len(columns.get_columns(self.hierarchy, False))
+
+        Answer.objects.create(question=self.question, value="b", label="B")
+        self.assertEquals(len(columns.get_columns(self.hierarchy, False)),
+                          before + 1)
+
+        self.two.append_child("Three", "three").append_pageblock(
+            label="quiz", css_extra="",
+            content_object=Quiz.objects.create())
+        Question.objects.create(quiz=Quiz.objects.last(), text="bar",
+                                question_type="short text")
+        self.assertEquals(len(columns.get_columns(self.hierarchy, False)),
+                          before + 2)
+
+        classification = TreatmentClassification.objects.first()
+        classification.description = "renamed"
+        classification.save()
+        key = columns.get_columns(self.hierarchy, True)
+        self.assertTrue("renamed" in [c.key_row()[-1] for c in key])
@@ -1,14 +1,23 @@
 from __future__ import unicode_literals
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import TestCase
 from django.test.client import Client
+from django.utils import timezone
 from django.utils.encoding import smart_text
 from pagetree.helpers import get_section_from_path
-from pagetree.models import Hierarchy, Section
+from pagetree.models import Hierarchy, Section, UserPageVisit
 from quizblock.models import Quiz, Question, Answer
+from tobaccocessation.activity_prescription_writing.models import \
+    Block as PrescriptionBlock, Medication as PrescriptionMedication
+from tobaccocessation.activity_virtual_patient.models import Patient, \
+    PatientAssessmentBlock, DosageChoice, \
+    Medication as VirtualPatientMedication
 from tobaccocessation.main.models import QuestionColumn, UserProfile, \
-    clean_header
+    UserProgress, BlockCompletion, ReportJob, clean_header
+from tobaccocessation.main.tests.factories import UserProfileFactory
+from tobaccocessation.main.views import Gate
 
 
 class UserProfileTest(TestCase):
@@ -93,6 +102,30 @@ class UserProfileTest(TestCase):
         profile.set_has_visited([self.section2])
         self.assertEquals(100, profile.percent_complete())
 
+    def test_progress(self):
+        user = User.objects.get(username="test_student")
+        profile = UserProfile.objects.get(user=user)
+
+        profile.set_has_visited([self.section1, self.section2])
+        progress = UserProgress.objects.get(user=user,
+                                            hierarchy=self.hierarchy)
+        self.assertEquals(progress.visited, 2)
+        self.assertEquals(progress.sections, 3)
+        self.assertEquals(progress.percent, 66)
+
+        # revisiting does not count twice
+        profile.set_has_visited([self.section1])
+        self.assertEquals(66, profile.percent_complete())
+
+        self.root.append_child("Section 3", "section-3")
+        self.assertEquals(50, profile.percent_complete())
+
+        self.section2.delete()
+        self.assertEquals(33, profile.percent_complete())
+
+        UserPageVisit.objects.filter(user=user).delete()
+        self.assertEquals(0, profile.percent_complete())
+
     def test_percent_complete_null_hierarchy(self):
         user = User.objects.get(username="test_student")
         profile = UserProfile.objects.get(user=user)
@@ -311,6 +344,186 @@ class TestQuestionColumn(TestCase):
         self.assertEquals(columns[1].question, quest2)
         self.assertEquals(columns[1].answer, None)
 
+    def test_prefetch(self):
+        choice_quiz = self.create_quizblock(self.section)
+        question = Question.objects.create(
+            quiz=choice_quiz, text="foo", question_type="multiple choice")
+        answer1 = Answer.objects.create(question=question,
+                                        value="1", label="one")
+        answer2 = Answer.objects.create(question=question,
+                                        value="2", label="two")
+        text = Question.objects.create(
+            quiz=choice_quiz, text="bar", question_type="short text")
+
+        columns = [QuestionColumn(self.hierarchy, question, answer1),
+                   QuestionColumn(self.hierarchy, question, answer2),
+                   QuestionColumn(self.hierarchy, text)]
+
+        other = User.objects.create_user("other", "other@ccnmtl.com", "test")
+        choice_quiz.submit(self.user, {"question%s" % question.id: "1",
+                                       "question%s" % text.id: "first"})
+        choice_quiz.submit(self.user, {"question%s" % question.id: "2",
+                                       "question%s" % text.id: "second"})
+
+        with self.assertNumQueries(2):
+            QuestionColumn.prefetch(columns, [self.user, other])
+
+        with self.assertNumQueries(0):
+            self.assertEquals(columns[0].user_value(self.user), "")
+            self.assertEquals(columns[1].user_value(self.user), answer2.id)
+            self.assertEquals(columns[2].user_value(self.user), "second")
+            self.assertEquals(columns[2].user_value(other), "")
+
+    def test_shared_responses(self):
+        quiz = self.create_quizblock(self.section)
+        multiple = Question.objects.create(
+            quiz=quiz, text="foo", question_type="multiple choice")
+        answers = [Answer.objects.create(question=multiple, value=str(i),
+                                         label=str(i)) for i in range(3)]
+        single = Question.objects.create(
+            quiz=quiz, text="bar", question_type="single choice")
+        choice = Answer.objects.create(question=single, value="x", label="x")
+
+        columns = [QuestionColumn(self.hierarchy, multiple, a)
+                   for a in answers]
+        columns.append(QuestionColumn(self.hierarchy, single))
+        quiz.submit(self.user, {"question%s" % multiple.id: ["0", "2"],
+                                "question%s" % single.id: "x"})
+
+        QuestionColumn.prefetch(columns, [self.user])
+        self.assertEquals(len(set([c.responses for c in columns])), 1)
+
+        # the single choice answers are looked up once for the quiz
+        with self.assertNumQueries(1):
+            self.assertEquals([c.user_value(self.user) for c in columns],
+                              [answers[0].id, '', answers[2].id, choice.id])
+
+        QuestionColumn.evict(columns, self.user)
+        with self.assertNumQueries(2):
+            self.assertEquals(columns[0].user_value(self.user),
+                              answers[0].id)
+
     def test_clean_header(self):
         s = "<p></p></div>\n\r<>'\"foobar,"
         self.assertEquals(clean_header(s), b'foobar')
+
+
+class BlockCompletionTest(TestCase):
+    fixtures = ['prescriptionwriting.json', 'virtualpatient.json']
+
+    def setUp(self):
+        self.user = User.objects.create_user("test_student",
+                                             "test@ccnmtl.com",
+                                             "testpassword")
+        self.hierarchy = Hierarchy.objects.create(name="main", base_url="/")
+        root = self.hierarchy.get_root()
+        self.one = root.append_child("One", "one")
+        self.two = root.append_child("Two", "two")
+
+        self.rx_block = PrescriptionBlock.objects.create(
+            medication_name="Nicotine Patch")
+        self.one.append_pageblock(label="rx", css_extra="",
+                                  content_object=self.rx_block)
+        self.patient_block = PatientAssessmentBlock.objects.create(
+            patient=Patient.objects.first(),
+            view=PatientAssessmentBlock.CLASSIFY_TREATMENTS)
+        self.two.append_pageblock(label="patient", css_extra="",
+                                  content_object=self.patient_block)
+
+        self.gate = Gate(self.user, None)
+
+    def completions(self):
+        return dict(BlockCompletion.objects.filter(
+            user=self.user).values_list('pageblock_id', 'completed'))
+
+    def test_worked_out_once(self):
+        self.assertTrue(self.gate.unlocked_blocks(self.one))
+        pageblock = self.one.pageblock_set.first()
+        self.assertEquals(self.completions(), {pageblock.id: False})
+
+        with self.assertNumQueries(1):
+            self.assertTrue(self.gate.unlocked_blocks(self.one))
+
+    def test_refresh(self):
+        self.assertTrue(self.gate.unlocked_blocks(self.one))
+
+        self.rx_block.submit(self.user, {'dosage': '21mg',
+                                         'disp': '28 patches',
+                                         'sig': 'one daily',
+                                         'refills': '1'})
+        BlockCompletion.refresh(self.user, self.one)
+        with self.assertNumQueries(1):
+            self.assertFalse(self.gate.unlocked_blocks(self.one))
+
+    def test_forgotten_on_change(self):
+        self.assertTrue(self.gate.unlocked_blocks(self.one))
+        self.assertTrue(self.gate.unlocked_blocks(self.two))
+        self.assertEquals(len(self.completions()), 2)
+
+        # writing the patient state forgets the hierarchy's patient blocks
+        self.patient_block.submit(self.user, {})
+        pageblock = self.one.pageblock_set.first()
+        self.assertEquals(self.completions(), {pageblock.id: False})
+
+        # as does editing prescription reference data
+        PrescriptionMedication.objects.first().save()
+        self.assertEquals(self.completions(), {})
+
+
+class ReportJobTest(TestCase):
+
+    def setUp(self):
+        self.hierarchy = Hierarchy.objects.create(name="main", base_url="/")
+
+    def test_enqueue_pending(self):
+        job = ReportJob.enqueue(self.hierarchy, False)
+        self.assertEquals(ReportJob.enqueue(self.hierarchy, False), job)
+        self.assertNotEquals(ReportJob.enqueue(self.hierarchy, True), job)
+
+    def test_claim(self):
+        job = ReportJob.enqueue(self.hierarchy, False)
+
+        claimed = ReportJob.claim()
+        self.assertEquals(claimed, job)
+        self.assertEquals(claimed.status, ReportJob.RUNNING)
+        self.assertIsNone(ReportJob.claim())
+
+        # a running job is still the one to wait for
+        self.assertEquals(ReportJob.enqueue(self.hierarchy, False), job)
+
+    def test_enqueue_reuses_complete(self):
+        job = ReportJob.enqueue(self.hierarchy, False)
+        ReportJob.objects.filter(id=job.id).update(
+            status=ReportJob.COMPLETE, finished=timezone.now(),
+            fingerprint=ReportJob.fingerprint_for(self.hierarchy, False))
+        self.assertEquals(ReportJob.enqueue(self.hierarchy, False), job)
+
+        # until the data changes
+        UserProfileFactory()
+        self.assertNotEquals(ReportJob.enqueue(self.hierarchy, False), job)
+
+    def test_fingerprint(self):
+        fingerprint = ReportJob.fingerprint_for(self.hierarchy, False)
+
+        # the same in every process
+        cache.clear()
+        self.assertEquals(ReportJob.fingerprint_for(self.hierarchy, False),
+                          fingerprint)
+
+        section = self.hierarchy.get_root().append_child("One", "one")
+        changed = ReportJob.fingerprint_for(self.hierarchy, False)
+        self.assertNotEquals(changed, fingerprint)
+
+        section.label = "Uno"
+        section.save()
+        self.assertNotEquals(
+            ReportJob.fingerprint_for(self.hierarchy, False), changed)
+
+        # the correct dosages decide the CorrectRx values
+        medication = VirtualPatientMedication.objects.create(
+            name="Foo", display_order=1)
+        changed = ReportJob.fingerprint_for(self.hierarchy, False)
+        DosageChoice.objects.create(medication=medication, dosage="1mg",
+                                    correct=True, display_order=1)
+        self.assertNotEquals(
+            ReportJob.fingerprint_for(self.hierarchy, False), changed)
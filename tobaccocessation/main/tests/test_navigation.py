@@ -0,0 +1,149 @@
+from django.http import Http404
+from django.test import TestCase
+from pagetree.models import Hierarchy, Section
+
+from tobaccocessation.main import navigation
+from tobaccocessation.main.navigation import get_navigation
+
+
+class NavigationIndexTest(TestCase):
+
+    def setUp(self):
+        self.hierarchy = Hierarchy.objects.create(name="main", base_url="/")
+        self.root = self.hierarchy.get_root()
+
+        # root
+        #   one
+        #     one-a
+        #     one-b
+        #   two
+        #     two-a
+        #       two-a-i
+        #   three
+        self.one = self.root.append_child("One", "one")
+        self.one_a = self.one.append_child("One A", "one-a")
+        self.one_b = self.one.append_child("One B", "one-b")
+        self.two = self.root.append_child("Two", "two")
+        self.two_a = self.two.append_child("Two A", "two-a")
+        self.two_a_i = self.two_a.append_child("Two A i", "two-a-i")
+        self.three = self.root.append_child("Three", "three")
+
+    def test_next(self):
+        nav = get_navigation(self.hierarchy)
+        self.assertEquals(nav.next(self.root), self.one)
+        self.assertEquals(nav.next(self.one_b), self.two)
+        self.assertEquals(nav.next(self.two_a_i), self.three)
+        self.assertIsNone(nav.next(self.three))
+
+    def test_previous(self):
+        nav = get_navigation(self.hierarchy)
+        self.assertIsNone(nav.previous(self.root))
+        self.assertIsNone(nav.previous(self.one))
+        self.assertEquals(nav.previous(self.one_a), self.one)
+        self.assertEquals(nav.previous(self.two), self.one_b)
+
+    def test_previous_leaf(self):
+        nav = get_navigation(self.hierarchy)
+        self.assertIsNone(nav.previous_leaf(self.root))
+        self.assertIsNone(nav.previous_leaf(self.one))
+        self.assertIsNone(nav.previous_leaf(self.one_a))
+        self.assertEquals(nav.previous_leaf(self.one_b), self.one_a)
+        self.assertEquals(nav.previous_leaf(self.two_a_i), self.one_b)
+        self.assertEquals(nav.previous_leaf(self.three), self.two_a_i)
+
+    def test_first_leaf(self):
+        nav = get_navigation(self.hierarchy)
+        self.assertEquals(nav.first_leaf(self.root), self.one_a)
+        self.assertEquals(nav.first_leaf(self.two), self.two_a_i)
+        self.assertEquals(nav.first_leaf(self.three), self.three)
+
+    def test_ancestors_and_module(self):
+        nav = get_navigation(self.hierarchy)
+        self.assertEquals(nav.ancestors(self.root), [])
+        self.assertEquals(nav.ancestors(self.two_a_i),
+                          [self.root, self.two, self.two_a])
+        self.assertEquals(nav.ancestors(self.two_a_i),
+                          list(self.two_a_i.get_ancestors()))
+
+        self.assertIsNone(nav.module(self.root))
+        self.assertEquals(nav.module(self.two), self.two)
+        self.assertEquals(nav.module(self.two_a_i), self.two)
+
+    def test_no_queries(self):
+        get_navigation(self.hierarchy)
+        with self.assertNumQueries(0):
+            nav = get_navigation(self.hierarchy)
+            nav.next(self.one_a)
+            nav.previous_leaf(self.two)
+
+    def test_shared_through_cache(self):
+        nav = get_navigation(self.hierarchy)
+        navigation._indexes.clear()
+        with self.assertNumQueries(0):
+            self.assertEquals(get_navigation(self.hierarchy).version,
+                              nav.version)
+
+    def test_invalidated_on_change(self):
+        nav = get_navigation(self.hierarchy)
+        self.assertIsNone(nav.next(self.three))
+
+        four = self.root.append_child("Four", "four")
+        nav = get_navigation(self.hierarchy)
+        self.assertEquals(nav.next(self.three), four)
+
+        four.delete()
+        nav = get_navigation(self.hierarchy)
+        self.assertIsNone(nav.next(self.three))
+
+    def test_invalidated_on_move(self):
+        get_navigation(self.hierarchy)
+
+        self.three.move(self.one, pos="first-child")
+        self.three.clear_tree_cache()
+        self.three = Section.objects.get(id=self.three.id)
+
+        nav = get_navigation(self.hierarchy)
+        self.assertEquals(nav.next(self.one), self.three)
+        self.assertEquals(nav.first_leaf(self.root), self.three)
+
+    def test_find(self):
+        nav = get_navigation(self.hierarchy)
+        self.assertEquals(nav.find(""), self.root)
+        self.assertEquals(nav.find("one"), self.one)
+        self.assertEquals(nav.find("two/two-a/two-a-i/"), self.two_a_i)
+        self.assertIsNone(nav.find("two/one-a"))
+
+    def test_get_section(self):
+        get_navigation(self.hierarchy)
+        navigation.get_hierarchy("main")
+        with self.assertNumQueries(0):
+            self.assertEquals(navigation.get_section("main", "one/one-b/"),
+                              self.one_b)
+            self.assertEquals(navigation.get_root("main"), self.root)
+            self.assertEquals(navigation.get_first_leaf("main"),
+                              self.one_a)
+
+        with self.assertRaises(Http404):
+            navigation.get_section("main", "four")
+
+    def test_hierarchy_registry(self):
+        self.assertEquals(navigation.get_hierarchy("main"), self.hierarchy)
+
+        navigation._registry['version'] = None  # another process
+        with self.assertNumQueries(0):
+            self.assertEquals(navigation.get_hierarchy("main"),
+                              self.hierarchy)
+
+        get_navigation(self.hierarchy)
+        self.hierarchy.base_url = "/main/"
+        self.hierarchy.save()
+        self.assertEquals(navigation.get_hierarchy("main").base_url,
+                          "/main/")
+
+        # the index's sections carry the old hierarchy
+        self.assertEquals(
+            get_navigation(self.hierarchy).find("one").hierarchy.base_url,
+            "/main/")
+
+        # created if it doesn't exist, as pagetree does
+        self.assertEquals(navigation.get_hierarchy("other").base_url, "/")
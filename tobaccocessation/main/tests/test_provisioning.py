@@ -0,0 +1,73 @@
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.six import StringIO
+from pagetree.models import Hierarchy
+from pagetree.tests.factories import UserFactory
+
+from tobaccocessation.activity_prescription_writing.models import \
+    ActivityState as PrescriptionWritingState, Block as PrescriptionBlock
+from tobaccocessation.activity_virtual_patient.models import \
+    ActivityState as VirtualPatientActivityState, Patient, \
+    PatientAssessmentBlock
+from tobaccocessation.main.provisioning import provision
+from tobaccocessation.main.tests.factories import UserProfileFactory
+
+
+class ProvisioningTest(TestCase):
+    fixtures = ['virtualpatient.json']
+
+    def setUp(self):
+        self.user = UserFactory()
+
+        self.hierarchy = Hierarchy.objects.create(name="main", base_url="/")
+        self.other = Hierarchy.objects.create(name="other", base_url="/o/")
+        section = self.hierarchy.get_root().append_child("One", "one")
+
+        self.patient_block = PatientAssessmentBlock.objects.create(
+            patient=Patient.objects.first(),
+            view=PatientAssessmentBlock.CLASSIFY_TREATMENTS)
+        section.append_pageblock(label="patient", css_extra="",
+                                 content_object=self.patient_block)
+
+        self.rx_block = PrescriptionBlock.objects.create(
+            medication_name="Varenicline")
+        section.append_pageblock(label="rx", css_extra="",
+                                 content_object=self.rx_block)
+
+    def test_provision(self):
+        # the lookups & one insert per state table
+        with self.assertNumQueries(5):
+            provision([self.user])
+
+        state = VirtualPatientActivityState.objects.get(user=self.user)
+        self.assertEquals(state.hierarchy, self.hierarchy)
+        self.assertEquals(state.patient_state(self.patient_block.patient),
+                          {})
+
+        state = PrescriptionWritingState.objects.get(user=self.user)
+        self.assertEquals(state.block, self.rx_block)
+        self.assertFalse(self.rx_block.unlocked(self.user))
+
+        # provisioning again keeps what the user has done
+        self.rx_block.submit(self.user, {'dosage': '0.5mg'})
+        provision([self.user])
+        self.assertEquals(PrescriptionWritingState.objects.get(
+            user=self.user).loads()['Varenicline'], {'dosage': '0.5mg'})
+
+    def test_reads_dont_create(self):
+        self.assertFalse(self.rx_block.unlocked(self.user))
+        self.assertFalse(self.patient_block.unlocked(self.user))
+        self.assertFalse(PrescriptionWritingState.objects.exists())
+        self.assertFalse(VirtualPatientActivityState.objects.exists())
+
+    def test_command(self):
+        UserProfileFactory(user=self.user)
+        UserFactory()  # no profile, not enrolled
+
+        out = StringIO()
+        call_command('provision_states', stdout=out)
+        self.assertEquals(out.getvalue().strip(), "Provisioned 1 users")
+        self.assertEquals(
+            VirtualPatientActivityState.objects.get().user, self.user)
+        self.assertEquals(PrescriptionWritingState.objects.get().user,
+                          self.user)
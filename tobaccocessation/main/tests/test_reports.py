@@ -0,0 +1,182 @@
+import csv
+import multiprocessing
+import os
+from io import StringIO
+
+from django.test import TestCase
+from pagetree.models import Hierarchy, UserPageVisit
+from pagetree.tests.factories import ModuleFactory
+from quizblock.models import Answer, Question, Quiz
+
+from tobaccocessation.activity_virtual_patient.models import \
+    ActivityState
+from tobaccocessation.main import reports
+from tobaccocessation.main.models import ExportRow
+from tobaccocessation.main.tests.factories import UserProfileFactory
+from tobaccocessation.main.views import _all_results, _get_columns, \
+    _report_profiles
+
+
+def as_csv(rows):
+    f = StringIO()
+    csv.writer(f).writerows(rows)
+    return f.getvalue()
+
+
+def worker_pid(shard):
+    """stands in for reports.shard_rows"""
+    return [[os.getpid()]]
+
+
+class ShardTest(TestCase):
+
+    def setUp(self):
+        ModuleFactory("main", "/pages/main/")
+        self.hierarchy = Hierarchy.objects.get(name='main')
+        self.profiles = [UserProfileFactory() for i in range(7)]
+
+        admin = UserProfileFactory()
+        admin.user.is_superuser = True
+        admin.user.save()
+
+    def test_shard_bounds(self):
+        user_ids = sorted([p.user_id for p in self.profiles])
+
+        bounds = reports.shard_bounds(_report_profiles(False), 3)
+        self.assertEquals(bounds, [(user_ids[0], user_ids[3]),
+                                   (user_ids[3], user_ids[6]),
+                                   (user_ids[6], None)])
+
+        bounds = reports.shard_bounds(_report_profiles(False), 20)
+        self.assertEquals(len(bounds), 7)
+
+        self.assertEquals(reports.shard_bounds(
+            _report_profiles(False).none(), 3), [])
+
+    def test_same_as_sequential(self):
+        for include_superusers in [False, True]:
+            expected = as_csv(_all_results(self.hierarchy,
+                                           include_superusers))
+            self.assertEquals(as_csv(reports.sharded_results(
+                self.hierarchy, include_superusers, 1)), expected)
+
+            # shards that hold a single user each
+            shards = reports.SHARDS_PER_WORKER
+            reports.SHARDS_PER_WORKER = 10
+            try:
+                self.assertEquals(as_csv(reports.sharded_results(
+                    self.hierarchy, include_superusers, 1)), expected)
+            finally:
+                reports.SHARDS_PER_WORKER = shards
+
+    def test_pool(self):
+        expected = as_csv(_all_results(self.hierarchy, False))
+
+        # workers are forked even where the default is to spawn them,
+        # which would leave them without Django or the test's database
+        default = multiprocessing.get_start_method(allow_none=True)
+        multiprocessing.set_start_method('spawn', force=True)
+        try:
+            self.assertEquals(as_csv(reports.sharded_results(
+                self.hierarchy, False, 2)), expected)
+
+            # the rows really do come from worker processes
+            shard_rows = reports.shard_rows
+            reports.shard_rows = worker_pid
+            try:
+                pids = [row[0] for row in reports.sharded_results(
+                    self.hierarchy, False, 2)][1:]
+            finally:
+                reports.shard_rows = shard_rows
+        finally:
+            multiprocessing.set_start_method(default, force=True)
+
+        self.assertNotIn(os.getpid(), pids)
+
+
+class CachedRowsTest(TestCase):
+
+    def setUp(self):
+        ModuleFactory("main", "/pages/main/")
+        self.hierarchy = Hierarchy.objects.get(name='main')
+        self.profiles = [UserProfileFactory() for i in range(3)]
+        self.columns = _get_columns(False, self.hierarchy)
+
+    def rows(self):
+        return list(reports.cached_rows(self.hierarchy, self.columns,
+                                        _report_profiles(False)))
+
+    def mark(self, profile):
+        """tamper with the user's stored row, to see if it's reused"""
+        ExportRow.objects.filter(user=profile.user).update(row='["stored"]')
+
+    def test_stored(self):
+        expected = list(_all_results(self.hierarchy, False))[1:]
+        self.assertEquals(self.rows(), expected)
+        self.assertEquals(ExportRow.objects.count(), 3)
+
+        self.mark(self.profiles[1])
+        self.assertEquals(self.rows()[1], ["stored"])
+
+    def test_recomputed_on_change(self):
+        self.rows()
+        for profile in self.profiles:
+            self.mark(profile)
+
+        self.profiles[0].save()
+        ActivityState.get_for_user(self.profiles[2].user, self.hierarchy)
+
+        rows = self.rows()
+        self.assertEquals(rows[0][0], self.profiles[0].user.username)
+        self.assertEquals(rows[1], ["stored"])
+        self.assertEquals(rows[2][0], self.profiles[2].user.username)
+
+    def test_recomputed_on_tree_change(self):
+        self.rows()
+        self.mark(self.profiles[0])
+
+        self.hierarchy.get_root().append_child("New", "new")
+        self.columns = _get_columns(False, self.hierarchy)
+        self.assertEquals(self.rows()[0][0], self.profiles[0].user.username)
+
+    def test_recomputed_on_other_progress(self):
+        # percent complete comes from the hierarchy for the user's role
+        ModuleFactory("general", "/pages/general/")
+        general = Hierarchy.objects.get(name='general')
+        profile = self.profiles[0]
+        profile.specialty = 'S1'
+        profile.save()
+
+        self.rows()
+        self.mark(profile)
+
+        section = general.get_root().get_first_leaf()
+        UserPageVisit.objects.create(user=profile.user, section=section,
+                                     status="complete")
+        row = self.rows()[0]
+        self.assertEquals(row[0], profile.user.username)
+        self.assertEquals(row, list(_all_results(self.hierarchy, False))[1])
+
+    def test_recomputed_on_answer_change(self):
+        section = self.hierarchy.get_root().get_first_leaf()
+        quiz = Quiz.objects.create()
+        section.append_pageblock(label="quiz", css_extra="",
+                                 content_object=quiz)
+        question = Question.objects.create(
+            quiz=quiz, text="foo", question_type="single choice")
+        a = Answer.objects.create(question=question, value="a", label="a")
+        b = Answer.objects.create(question=question, value="b", label="b")
+        quiz.submit(self.profiles[0].user,
+                    {"question%s" % question.id: "b"})
+
+        self.columns = _get_columns(False, self.hierarchy)
+        self.assertEquals(self.rows()[0][-1], str(b.id))
+
+        # the same columns, but "b" is now the first answer
+        (a.value, b.value) = ("b", "a")
+        a.save()
+        b.save()
+        self.columns = _get_columns(False, self.hierarchy)
+        row = self.rows()[0]
+        self.assertEquals(row[-1], str(a.id))
+        self.assertEquals(row, list(_all_results(self.hierarchy, False))[1])
@@ -1,8 +1,15 @@
 from django.contrib.auth.models import User
+from django.template import Context
+from django.template.loader import get_template
 from django.test import TestCase
+from pagetree.models import Hierarchy
 from quizblock.models import Quiz, Question, Answer, Submission, Response
+from tobaccocessation.main import navigation
+from tobaccocessation.main.models import BlockCompletion
+from tobaccocessation.main.templatetags.accessible import navkey
 from tobaccocessation.main.templatetags.quizcorrect import IfQuizCorrectNode, \
     IfQuizCompleteNode
+from tobaccocessation.main.tests.factories import UserProfileFactory
 
 
 class FakeRequest(object):
@@ -353,3 +360,57 @@ class IfQuizCorrectTest(TestCase):
         Response.objects.create(question=ques2, submission=sub, value="c")
 
         self.assert_render_false()
+
+
+class NavKeyTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="testuser")
+        UserProfileFactory(user=self.user)
+
+        self.hierarchy = Hierarchy.objects.create(name="main", base_url="/")
+        self.root = self.hierarchy.get_root()
+        self.one = self.root.append_child("One", "one")
+        self.two = self.root.append_child("Two", "two")
+
+        self.quiz = Quiz.objects.create()
+        self.one.append_pageblock(label="quiz", css_extra="",
+                                  content_object=self.quiz)
+
+    def context(self):
+        request = FakeRequest()
+        request.user = User.objects.get(id=self.user.id)
+        return Context(dict(request=request, root=self.root,
+                            module=None, section=self.one))
+
+    def test_key(self):
+        key = navkey(self.context(), self.root)
+        self.assertTrue(key.endswith(".110"))
+        self.assertEquals(navkey(self.context(), self.root), key)
+
+        # unlocking the next section
+        self.user.profile.set_has_visited([self.one])
+        self.assertEquals(navkey(self.context(), self.root), key)
+        Submission.objects.create(quiz=self.quiz, user=self.user)
+        BlockCompletion.refresh(self.user, self.one)
+        unlocked = navkey(self.context(), self.root)
+        self.assertTrue(unlocked.endswith(".111"))
+
+        # editing the tree
+        self.root.append_child("Three", "three")
+        self.assertNotEquals(navkey(self.context(), self.root), unlocked)
+
+        # ungated, the user's progress doesn't matter
+        self.assertEquals(navkey(self.context(), self.root, False),
+                          "%d.%s" % (self.hierarchy.id,
+                                     navigation.get_version(
+                                         self.hierarchy.id)))
+
+    def test_nav_cached(self):
+        template = get_template("primary_nav.html")
+        html = template.render(self.context().flatten())
+        self.assertTrue('<a href="/one/">One</a>' in html)
+
+        # the user's profile, visits & completions, not the tree
+        context = self.context().flatten()
+        with self.assertNumQueries(3):
+            self.assertEquals(template.render(context), html)
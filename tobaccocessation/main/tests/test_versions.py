@@ -0,0 +1,46 @@
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from tobaccocessation.main import versions
+
+
+class VersionsTest(TestCase):
+
+    def setUp(self):
+        cache.delete("test.version")
+
+    def test_get_version(self):
+        version = versions.get_version("test.version")
+        self.assertIsNotNone(version)
+        self.assertEquals(versions.get_version("test.version"), version)
+        self.assertNotEquals(versions.get_version("test.other"), version)
+
+    def test_bump(self):
+        version = versions.get_version("test.version")
+        versions.bump("test.version")
+        self.assertNotEquals(versions.get_version("test.version"), version)
+
+    def test_read_once_per_request(self):
+        versions.start_request()
+        try:
+            version = versions.get_version("test.version")
+            cache.set("test.version", "another process")
+            self.assertEquals(versions.get_version("test.version"), version)
+
+            # but this request's own changes are seen
+            versions.bump("test.version")
+            bumped = versions.get_version("test.version")
+            self.assertNotIn(bumped, [version, "another process"])
+        finally:
+            versions.finish_request()
+
+        cache.set("test.version", "another process")
+        self.assertEquals(versions.get_version("test.version"),
+                          "another process")
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+    def test_no_cache(self):
+        # e.g. memcached isn't running: copies are never reused
+        self.assertNotEquals(versions.get_version("test.version"),
+                             versions.get_version("test.version"))
@@ -1,8 +1,18 @@
-from django.test import TestCase
+from io import BytesIO, StringIO
+from json import loads
+import tempfile
+from zipfile import ZipFile
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
 from pagetree.models import Hierarchy
 from pagetree.tests.factories import ModuleFactory, UserFactory
+from quizblock.models import Question, Quiz, Submission
 
+from tobaccocessation.main import navigation
+from tobaccocessation.main.models import BlockCompletion, ReportJob
 from tobaccocessation.main.tests.factories import UserProfileFactory
+from tobaccocessation.main.views import AccessibilityMap, accessible
 
 
 class TestViews(TestCase):
@@ -74,3 +84,123 @@ class TestViews(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEquals(response.templates[0].name,
                           "main/page.html")
+
+    def test_report_builds_zip(self):
+        UserProfileFactory(user=self.user)
+        self.user.is_superuser = True
+        self.user.save()
+        hierarchy = Hierarchy.objects.get(name='main')
+
+        self.client.login(username=self.user.username, password='test')
+        response = self.client.post('/main/report/',
+                                    {'hierarchy-id': hierarchy.id,
+                                     'include-superusers': 'on'})
+        self.assertEqual(response.status_code, 302)
+        job = ReportJob.objects.get()
+        self.assertEqual(job.status, ReportJob.PENDING)
+        self.assertTrue(job.include_superusers)
+
+        response = self.client.get('/main/report/')
+        self.assertEqual(list(response.context['jobs']), [job])
+
+        with override_settings(MEDIA_ROOT=tempfile.mkdtemp()):
+            call_command('run_report_jobs', '--once', stdout=StringIO())
+
+            response = self.client.get(
+                '/main/report/%d/status/' % job.id)
+            self.assertEqual(loads(response.content.decode('utf-8')), {
+                'id': job.id, 'status': 'complete',
+                'progress': 1, 'total': 1})
+
+            response = self.client.get(
+                '/main/report/%d/download/' % job.id)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Disposition'],
+                             'attachment; filename="tobacco_main.zip"')
+            z = ZipFile(BytesIO(b''.join(response.streaming_content)))
+            response.close()
+
+        self.assertEqual(z.namelist(),
+                         ['tobacco_main_key.csv', 'tobacco_main_values.csv'])
+
+        key = z.read('tobacco_main_key.csv').decode('utf-8').splitlines()
+        self.assertEqual(key[0], 'itemIdentifier,hierarchy,exercise type,'
+                         'itemType,itemText,answerIdentifier,answerText')
+        self.assertEqual(key[1], 'username,profile,,string,Username')
+
+        values = z.read(
+            'tobacco_main_values.csv').decode('utf-8').splitlines()
+        self.assertEqual(len(values), 2)
+        self.assertTrue(values[0].startswith('username,email,gender'))
+        self.assertTrue(values[1].startswith(self.user.username))
+
+    def test_report_superuser_only(self):
+        job = ReportJob.enqueue(Hierarchy.objects.get(name='main'), False)
+
+        self.client.login(username=self.user.username, password='test')
+        response = self.client.get('/main/report/%d/status/' % job.id)
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get('/main/report/%d/download/' % job.id)
+        self.assertEqual(response.status_code, 302)
+
+    def test_accessibility_map(self):
+        profile = UserProfileFactory(user=self.user)
+        hierarchy = Hierarchy.objects.get(name='main')
+        sections = hierarchy.get_root().get_descendants()
+        profile.set_has_visited([self.section])
+
+        access = AccessibilityMap(hierarchy, self.user, profile)
+        for section in sections:
+            self.assertEquals(access.accessible(section),
+                              accessible(section, self.user))
+
+        with self.assertNumQueries(0):
+            for section in sections:
+                access.accessible(section)
+
+    def test_accessibility_map_reads_version_once(self):
+        profile = UserProfileFactory(user=self.user)
+        hierarchy = Hierarchy.objects.get(name='main')
+        sections = hierarchy.get_root().get_descendants()
+
+        reads = []
+        get_version = navigation.get_version
+
+        def counted(hierarchy_id):
+            reads.append(hierarchy_id)
+            return get_version(hierarchy_id)
+
+        navigation.get_version = counted
+        try:
+            access = AccessibilityMap(hierarchy, self.user, profile)
+            for section in sections:
+                access.accessible(section)
+        finally:
+            navigation.get_version = get_version
+        self.assertEquals(reads, [hierarchy.id])
+
+    def test_accessibility_map_quiz(self):
+        profile = UserProfileFactory(user=self.user)
+        hierarchy = Hierarchy.objects.get(name='main')
+        sections = hierarchy.get_root().get_descendants()
+        following = self.section.get_next()
+        profile.set_has_visited([self.section])
+
+        # Quiz.unlocked takes only the user
+        quiz = Quiz.objects.create()
+        self.section.append_pageblock(label="quiz", css_extra="",
+                                      content_object=quiz)
+        Question.objects.create(quiz=quiz, text="foo",
+                                question_type="short text")
+
+        access = AccessibilityMap(hierarchy, self.user, profile)
+        self.assertFalse(access.accessible(following))
+        for section in sections:
+            self.assertEquals(access.accessible(section),
+                              accessible(section, self.user))
+
+        Submission.objects.create(quiz=quiz, user=self.user)
+        BlockCompletion.refresh(self.user, self.section)  # as page_post does
+        access = AccessibilityMap(hierarchy, self.user, profile)
+        self.assertTrue(access.accessible(following))
+        self.assertTrue(accessible(following, self.user))
@@ -0,0 +1,165 @@
+from datetime import timedelta
+from io import StringIO
+
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from pagetree.models import Hierarchy, UserLocation, UserPageVisit
+from pagetree.tests.factories import UserFactory
+
+from tobaccocessation.main import visits
+from tobaccocessation.main.models import UserProgress
+
+
+class CountingCache(LocMemCache):
+    """records the cache operations made through it"""
+
+    def __init__(self, *args, **kwargs):
+        super(CountingCache, self).__init__(*args, **kwargs)
+        self.calls = []
+
+    def add(self, *args, **kwargs):
+        self.calls.append('add')
+        return super(CountingCache, self).add(*args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        self.calls.append('get')
+        return super(CountingCache, self).get(*args, **kwargs)
+
+    def set(self, *args, **kwargs):
+        self.calls.append('set')
+        return super(CountingCache, self).set(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        self.calls.append('delete')
+        return super(CountingCache, self).delete(*args, **kwargs)
+
+
+class VisitsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = UserFactory()
+
+        self.hierarchy = Hierarchy.objects.create(name="main", base_url="/")
+        self.root = self.hierarchy.get_root()
+        self.one = self.root.append_child("One", "one")
+        self.one_a = self.one.append_child("One A", "one-a")
+
+    def test_record_new(self):
+        visits.record(self.user, [self.root, self.one, self.one_a])
+
+        self.assertEquals(UserPageVisit.objects.filter(
+            user=self.user, status="complete").count(), 3)
+        location = UserLocation.objects.get(user=self.user)
+        self.assertEquals(location.path, self.one_a.get_absolute_url())
+
+        progress = UserProgress.objects.get(user=self.user)
+        self.assertEquals(progress.visited, 3)
+        self.assertEquals(progress.percent, 100)
+
+    def test_record_incomplete(self):
+        self.one.user_pagevisit(self.user)
+        visits.record(self.user, [self.one])
+
+        visit = UserPageVisit.objects.get(user=self.user)
+        self.assertEquals(visit.status, "complete")
+        self.assertEquals(UserProgress.objects.get(user=self.user).visited, 1)
+
+    def test_repeat_visit_is_buffered(self):
+        visits.record(self.user, [self.one])
+        before = UserPageVisit.objects.get(user=self.user).last_visit
+
+        # one read, no writes
+        with self.assertNumQueries(1):
+            visits.record(self.user, [self.one])
+        self.assertEquals(
+            UserPageVisit.objects.get(user=self.user).last_visit, before)
+
+        visits.flush(self.user.id)
+        self.assertTrue(
+            UserPageVisit.objects.get(user=self.user).last_visit > before)
+
+    def test_buffer_flushes_after_interval(self):
+        visits.record(self.user, [self.one, self.one_a])
+        visits.record(self.user, [self.one])
+        visit = UserPageVisit.objects.get(user=self.user, section=self.one)
+
+        # pretend the buffer was started a while ago
+        key = visits._pending_key(self.user.id)
+        pending = cache.get(key)
+        pending['since'] -= timedelta(seconds=visits.FLUSH_INTERVAL)
+        cache.set(key, pending)
+
+        visits.record(self.user, [self.one_a])
+        self.assertIsNone(cache.get(key))
+
+        visit.refresh_from_db()
+        self.assertEquals(visit.last_visit, pending['visits'][visit.id])
+
+    def test_logout_flushes(self):
+        visits.record(self.user, [self.one])
+        visits.record(self.user, [self.one])
+        self.assertIsNotNone(cache.get(visits._pending_key(self.user.id)))
+
+        self.client.login(username=self.user.username, password="test")
+        self.client.logout()
+        self.assertIsNone(cache.get(visits._pending_key(self.user.id)))
+
+    def test_forget(self):
+        visits.record(self.user, [self.one])
+        UserLocation.objects.filter(user=self.user).delete()
+        visits.forget(self.user.id)
+
+        visits.record(self.user, [self.one])
+        self.assertEquals(UserLocation.objects.get(user=self.user).path,
+                          self.one.get_absolute_url())
+
+    def test_flush_pending(self):
+        other = UserFactory()
+        for user in [self.user, other]:
+            visits.record(user, [self.one])
+            visits.record(user, [self.one])
+        before = UserPageVisit.objects.get(user=self.user).last_visit
+
+        out = StringIO()
+        call_command('flush_visits', stdout=out)
+        self.assertEquals(out.getvalue().strip(), "Flushed 2 users")
+
+        self.assertTrue(
+            UserPageVisit.objects.get(user=self.user).last_visit > before)
+        self.assertIsNone(cache.get(visits._pending_key(other.id)))
+
+        # dropped from the index once there's nothing left to flush
+        self.assertEquals(len(cache.get(visits.INDEX_KEY)), 2)
+        self.assertEquals(visits.flush_pending(), 0)
+        self.assertEquals(cache.get(visits.INDEX_KEY), {})
+
+    def test_locked_index_writes_through(self):
+        visits.record(self.user, [self.one])
+        before = UserPageVisit.objects.get(user=self.user).last_visit
+
+        # flush_pending is changing the index
+        with visits._locked(visits.INDEX_KEY):
+            visits.record(self.user, [self.one])
+
+        self.assertIsNone(cache.get(visits._pending_key(self.user.id)))
+        self.assertTrue(
+            UserPageVisit.objects.get(user=self.user).last_visit > before)
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'tobaccocessation.main.tests.test_visits.CountingCache'}})
+    def test_repeat_visit_cost(self):
+        # stands in for memcached: no queries, but count the round trips
+        counting = caches['default']
+        visits.record(self.user, [self.one])
+        visits.record(self.user, [self.one])  # starts the buffer
+
+        counting.calls = []
+        with self.assertNumQueries(1):  # the user's visits
+            visits.record(self.user, [self.one])
+        # the buffer's get & set, the user's locations and the
+        # section's path, which pagetree caches
+        self.assertEquals(sorted(counting.calls),
+                          ['get', 'get', 'get', 'set'])
@@ -3,7 +3,7 @@ import os.path
 
 from django.conf.urls import url
 from tobaccocessation.main.views import (
-    is_accessible, clear_state, report,
+    is_accessible, clear_state, report, report_status, report_download,
 )
 
 media_root = os.path.join(os.path.dirname(__file__), "media")
@@ -18,4 +18,8 @@ urlpatterns += [
         'is-accessible'),
     url(r'^clear/$', clear_state, {}, 'clear-state'),
     url(r'^report/$', report, {}, 'report'),
+    url(r'^report/(?P<job_id>\d+)/status/$', report_status, {},
+        'report-status'),
+    url(r'^report/(?P<job_id>\d+)/download/$', report_download, {},
+        'report-download'),
 ]
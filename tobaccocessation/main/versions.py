@@ -0,0 +1,60 @@
+"""
+Version tokens for process-local copies of shared data.
+
+A process keeps its copy along with the token it was built under, and
+rebuilds it once the token in the cache has changed. Bumping the token
+invalidates every process's copy at once, so the cache has to be one
+they all share (settings.CACHES).
+
+During a request each token is read from the cache once, so a page that
+checks a hierarchy's version for every section still makes a single
+round trip. Tokens bumped by the request itself are seen straight away.
+"""
+import threading
+import uuid
+
+from django.core.cache import cache
+from django.core.signals import request_finished, request_started
+from django.dispatch import receiver
+
+
+_request = threading.local()  # key -> token, for the current request
+
+
+@receiver(request_started)
+def start_request(**kwargs):
+    _request.tokens = {}
+
+
+@receiver(request_finished)
+def finish_request(**kwargs):
+    _request.tokens = None
+
+
+def get_version(key):
+    """the current token for key, set to a new one if there isn't one"""
+    tokens = getattr(_request, 'tokens', None)
+    if tokens is not None and key in tokens:
+        return tokens[key]
+
+    version = cache.get(key)
+    if version is None:
+        # add, so processes racing to set it agree on the winner
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    if version is None:
+        # the cache isn't keeping anything, so nothing can be reused
+        return uuid.uuid4().hex
+
+    if tokens is not None:
+        tokens[key] = version
+    return version
+
+
+def bump(key):
+    version = uuid.uuid4().hex
+    cache.set(key, version, None)
+
+    tokens = getattr(_request, 'tokens', None)
+    if tokens is not None:
+        tokens[key] = version
@@ -1,31 +1,43 @@
 import csv
-from io import StringIO
 from json import dumps
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_DEFLATED
 
 from django.conf import settings
+from django.contrib import messages
 from django.contrib.auth.decorators import login_required, user_passes_test
-from django.http import HttpResponseRedirect, HttpResponse
+from django.contrib.contenttypes.models import ContentType
+from django.http import HttpResponseRedirect, HttpResponse, FileResponse
 from django.http.response import Http404
-from django.shortcuts import render
+from django.shortcuts import get_object_or_404, render
 from django.urls.base import reverse
 from django.utils.encoding import smart_str
-from pagetree.helpers import get_section_from_path, get_module, get_hierarchy
-from pagetree.models import Section, UserLocation, UserPageVisit, Hierarchy
+from pagetree.models import Section, UserLocation, UserPageVisit, \
+    Hierarchy, PageBlock
 
 from tobaccocessation.activity_prescription_writing.models import \
-    ActivityState as PrescriptionWritingState, PrescriptionColumn
+    ActivityState as PrescriptionWritingState, PrescriptionColumn, \
+    Block as PrescriptionBlock
 from tobaccocessation.activity_virtual_patient.models import \
-    ActivityState as VirtualPatientActivityState, VirtualPatientColumn
+    ActivityState as VirtualPatientActivityState, VirtualPatientColumn, \
+    PatientAssessmentBlock
+from tobaccocessation.main.columns import get_columns
 from tobaccocessation.main.choices import RACE_CHOICES, SPECIALTY_CHOICES, \
     INSTITUTION_CHOICES, HISPANIC_LATINO_CHOICES, GENDER_CHOICES, choices_key
 from tobaccocessation.main.forms import get_boolean
 from tobaccocessation.main.models import QuickFixProfileForm, UserProfile, \
-    QuestionColumn
+    QuestionColumn, UserProgress, BlockCompletion, ExportRow, ReportJob
+from tobaccocessation.main import navigation, visits
+from tobaccocessation.main.navigation import get_navigation
+from tobaccocessation.main.provisioning import provision
 
 
 UNLOCKED = ['resources', 'faculty']  # special cases
 
+REPORT_PAGE_SIZE = 100  # users whose report data is loaded at once
+
+REJECTED_MESSAGE = ("Your answers could not be saved. "
+                    "Please check them and try again.")
+
 
 def context_processor(request):
     ctx = {}
@@ -43,12 +55,11 @@ def index(request):
         profile = None
 
     if profile is not None and profile.has_consented():
-        profile = UserProfile.objects.get(user=request.user)
-        hierarchy = get_hierarchy(name=profile.role())
+        hierarchy = navigation.get_hierarchy(profile.role())
         ctx = {'user': request.user,
                'profile': profile,
                'hierarchy': hierarchy,
-               'root': hierarchy.get_root()}
+               'root': navigation.get_root(hierarchy)}
         return render(request, 'main/index.html', ctx)
     else:
         return HttpResponseRedirect(reverse('create_profile'))
@@ -56,47 +67,88 @@ def index(request):
 
 @user_passes_test(lambda u: u.is_staff)
 def edit_page(request, hierarchy, path):
-    section = get_section_from_path(path, hierarchy)
+    section = navigation.get_section(hierarchy, path)
+    nav = get_navigation(section.hierarchy, section)
     ctx = dict(section=section,
                hierarchy=section.hierarchy,
-               module=get_module(section),
-               root=section.hierarchy.get_root())
+               module=nav.module(section),
+               root=nav.root())
     return render(request, 'main/edit_page.html', ctx)
 
 
 def page_post(request, section):
     proceed = True
+    rejected = False
     for p in section.pageblock_set.all():
         if request.POST.get('action', '') == 'reset':
             section.reset(request.user)
+            BlockCompletion.refresh(request.user, section)
             return HttpResponseRedirect(section.get_absolute_url())
 
-        if hasattr(p.block(), 'needs_submit') and p.block().needs_submit():
-            proceed = section.submit(request.POST, request.user)
+        block = p.block()
+        if hasattr(block, 'needs_submit') and block.needs_submit():
+            # submit handles every block on the page
+            proceed, rejected = submit(section, request.POST, request.user)
+            BlockCompletion.refresh(request.user, section)
+            break
+
+    if rejected:
+        messages.error(request, REJECTED_MESSAGE)
 
     if request.is_ajax():
-        json = dumps({'submitted': 'True'})
+        json = dumps({'submitted': str(not rejected)})
         return HttpResponse(json, 'application/json')
-    elif request.POST.get('proceed', False) or proceed:
+    elif not rejected and (request.POST.get('proceed', False) or proceed):
         return HttpResponseRedirect(section.get_next().get_absolute_url())
     else:
         # giving them feedback before they proceed
         return HttpResponseRedirect(section.get_absolute_url())
 
 
+def submit(section, data, user):
+    """
+    Store the user's responses to the section's blocks, as Section.submit
+    does, but keeping track of blocks that turn down what was posted by
+    returning False. Returns (proceed, rejected).
+    """
+    proceed = True
+    rejected = False
+    for p in section.pageblock_set.all():
+        block = p.block()
+        if hasattr(block, 'needs_submit') and block.needs_submit():
+            accepted = block.submit(user, block_data(data, p))
+            rejected = rejected or accepted is False
+            if hasattr(block, 'redirect_to_self_on_submit'):
+                proceed = not block.redirect_to_self_on_submit()
+    return proceed, rejected
+
+
+def block_data(data, pageblock):
+    """the posted values for the pageblock, without its prefix"""
+    prefix = "pageblock-%d-" % pageblock.id
+    values = {}
+    for k in data.keys():
+        if k.startswith(prefix):
+            # handle lists for multi-selects
+            v = data.getlist(k)
+            values[k[len(prefix):]] = v[0] if len(v) == 1 else v
+    return values
+
+
 @login_required
 def page(request, hierarchy, path):
     profile = UserProfile.objects.filter(user=request.user).first()
     if profile is None:
         return HttpResponseRedirect(reverse('create_profile'))
 
-    section = get_section_from_path(path, hierarchy)
+    section = navigation.get_section(hierarchy, path)
     h = section.hierarchy
     if request.method == "POST":
         # user has submitted a form. deal with it
         return page_post(request, section)
-    first_leaf = h.get_first_leaf(section)
-    ancestors = first_leaf.get_ancestors()
+    nav = get_navigation(h, section)
+    first_leaf = nav.first_leaf(section)
+    ancestors = nav.ancestors(first_leaf)
 
     if len(ancestors) < 1:
         raise Http404('Page does not exist')
@@ -107,8 +159,8 @@ def page(request, hierarchy, path):
         return HttpResponseRedirect(first_leaf.get_absolute_url())
 
     # the previous node is the last leaf, if one exists.
-    prev_page = _get_previous_leaf(first_leaf)
-    next_page = _get_next(first_leaf)
+    prev_page = nav.previous_leaf(first_leaf)
+    next_page = nav.next(first_leaf)
 
     # Is this section unlocked now?
     can_access = _unlocked(first_leaf, request.user, prev_page, profile)
@@ -168,6 +220,7 @@ def create_profile(request):
             user_profile.race = form.data['race']
             user_profile.age = form.data['age']
             user_profile.save()
+            provision([request.user])
             return HttpResponseRedirect('/')
     else:
         form = QuickFixProfileForm()
@@ -177,9 +230,14 @@ def create_profile(request):
     })
 
 
-def accessible(section, user):
+def accessible(section, user, request=None):
     try:
-        previous = section.get_previous()
+        if request is not None:
+            return get_accessibility(
+                request, section.hierarchy).accessible(section)
+
+        previous = get_navigation(
+            section.hierarchy, section).previous(section)
         return _unlocked(section, user, previous, user.profile)
     except AttributeError:
         return False
@@ -188,7 +246,7 @@ def accessible(section, user):
 @login_required
 def is_accessible(request, section_slug):
     section = Section.objects.get(slug=section_slug)
-    previous = section.get_previous()
+    previous = get_navigation(section.hierarchy, section).previous(section)
     response = {}
 
     if _unlocked(section, request.user, previous, request.user.profile):
@@ -206,6 +264,7 @@ def clear_state(request):
         pass
 
     # clear visits & saved locations
+    visits.forget(request.user.id)
     UserLocation.objects.filter(user=request.user).delete()
     UserPageVisit.objects.filter(user=request.user).delete()
 
@@ -219,43 +278,19 @@ def clear_state(request):
     # clear virtual patient
     VirtualPatientActivityState.objects.filter(user=request.user).delete()
 
+    BlockCompletion.objects.filter(user=request.user).delete()
+    ExportRow.objects.filter(user=request.user).delete()
+
     return HttpResponseRedirect(reverse("index"))
 
 
 # ####################################################################
 # View Utility Methods
 
-def _get_next(section):
-    # next node in the depth-first traversal
-    depth_first_traversal = Section.get_annotated_list(section.get_root())
-    for (i, (s, ai)) in enumerate(depth_first_traversal):
-        if s.id == section.id:
-            if i < len(depth_first_traversal) - 1:
-                return depth_first_traversal[i + 1][0]
-            else:
-                return None
-    # made it through without finding ourselves? weird.
-    return None
-
-
-def _get_previous_leaf(section):
-    depth_first_traversal = Section.get_annotated_list(section.get_root())
-    for (i, (s, ai)) in enumerate(depth_first_traversal):
-        if s.id == section.id:
-            # first element is the root, so we don't want to return that
-            prev = None
-            while i > 1 and not prev:
-                (node, x) = depth_first_traversal[i - 1]
-                if node and len(node.get_children()) > 0:
-                    i -= 1
-                else:
-                    prev = node
-            return prev
-    # made it through without finding ourselves? weird.
-    return None
-
-
-def _unlocked(section, user, previous, profile):
+def _unlocked(section, user, previous, profile, gate=None):
+    if gate is None:
+        gate = Gate(user, profile)
+
     if (section.hierarchy.name == 'faculty' and (
             not profile.is_role_faculty() and not user.is_staff)):
         return False
@@ -263,7 +298,7 @@ def _unlocked(section, user, previous, profile):
     # if the user can proceed past this section
     if (not section or
         section.is_root() or
-        profile.get_has_visited(section) or
+        gate.has_visited(section) or
         section.slug in UNLOCKED or
             section.hierarchy.name in UNLOCKED):
         return True
@@ -271,21 +306,134 @@ def _unlocked(section, user, previous, profile):
     if not previous or previous.is_root():
         return True
 
-    if unlocked_blocks(previous, user):
+    if gate.unlocked_blocks(previous):
         return False
 
     if previous.slug in UNLOCKED:
         return True
 
-    return profile.get_has_visited(previous)
+    return gate.has_visited(previous)
+
+
+class Gate(object):
+    """Answers _unlocked's questions for a single section"""
+
+    def __init__(self, user, profile):
+        self.user = user
+        self.profile = profile
+
+    def has_visited(self, section):
+        return self.profile.get_has_visited(section)
+
+    def unlocked_blocks(self, section):
+        """whether a block on the section still has to be completed"""
+        return self.incomplete(BlockCompletion.gating(
+            section.pageblock_set.all(), self.user))
 
+    def incomplete(self, rows):
+        completions = dict([(row[0], row[4]) for row in rows])
+        missing = [row for row in rows if row[4] is None]
+        if len(missing) > 0:
+            worked_out = self.work_out(missing)
+            BlockCompletion.store(self.user, worked_out)
+            completions.update(worked_out)
+        return not all(completions.values())
 
-def unlocked_blocks(page, user):
-    for pbl in page.pageblock_set.all():
-        if hasattr(pbl.block(), 'unlocked'):
-            if not pbl.block().unlocked(user):
-                return True
-    return False
+    def work_out(self, rows):
+        """{pageblock id: completed} for the gating rows, from the blocks
+        themselves"""
+        object_ids = {}
+        for (_, _, content_type_id, object_id, _) in rows:
+            object_ids.setdefault(content_type_id, []).append(object_id)
+
+        objects = {}
+        for content_type_id, ids in object_ids.items():
+            model = ContentType.objects.get_for_id(
+                content_type_id).model_class()
+            objects[content_type_id] = model.objects.in_bulk(ids)
+
+        completions = {}
+        for (pageblock_id, _, content_type_id, object_id, _) in rows:
+            block = objects[content_type_id].get(object_id)
+            completions[pageblock_id] = (block is None or
+                                         self.block_unlocked(block))
+        return completions
+
+    def block_unlocked(self, block):
+        return block.unlocked(self.user)
+
+
+class AccessibilityMap(Gate):
+    """
+    Which sections of a hierarchy the user can get to, worked out once
+    per request. Visits are fetched in one query, and the completion of
+    all the hierarchy's gating blocks in another.
+    """
+
+    def __init__(self, hierarchy, user, profile):
+        super(AccessibilityMap, self).__init__(user, profile)
+        self.hierarchy = hierarchy
+        self._accessible = {}
+        self._navigation = None
+        self._visited = None
+        self._gating = None
+
+    def navigation(self, section):
+        """the hierarchy's navigation index, looked up once unless it
+        doesn't know the section"""
+        if self._navigation is None or section not in self._navigation:
+            self._navigation = get_navigation(self.hierarchy, section)
+        return self._navigation
+
+    def accessible(self, section):
+        if section.id not in self._accessible:
+            previous = self.navigation(section).previous(section)
+            self._accessible[section.id] = _unlocked(
+                section, self.user, previous, self.profile, self)
+        return self._accessible[section.id]
+
+    def has_visited(self, section):
+        if self._visited is None:
+            self._visited = set(UserPageVisit.objects.filter(
+                user=self.user, section__hierarchy=self.hierarchy
+            ).values_list('section_id', flat=True))
+        return section.id in self._visited
+
+    def unlocked_blocks(self, section):
+        if self._gating is None:
+            self._gating = {}
+            for row in BlockCompletion.gating(PageBlock.objects.filter(
+                    section__hierarchy=self.hierarchy), self.user):
+                self._gating.setdefault(row[1], []).append(row)
+        return self.incomplete(self._gating.get(section.id, []))
+
+    def block_unlocked(self, block):
+        state = self.state(block)
+        if state is None:
+            return block.unlocked(self.user)
+        return block.unlocked(self.user, state)
+
+    def state(self, block):
+        """The user's state for an activity block, loaded once"""
+        if isinstance(block, PatientAssessmentBlock):
+            return VirtualPatientActivityState.cached_for_user(
+                self.user, self.hierarchy)
+
+        if isinstance(block, PrescriptionBlock):
+            return PrescriptionWritingState.cached_for_user(block, self.user)
+
+        return None
+
+
+def get_accessibility(request, hierarchy):
+    """The request's AccessibilityMap for the hierarchy"""
+    if not hasattr(request, '_accessibility'):
+        request._accessibility = {}
+
+    if hierarchy.id not in request._accessibility:
+        request._accessibility[hierarchy.id] = AccessibilityMap(
+            hierarchy, request.user, request.user.profile)
+    return request._accessibility[hierarchy.id]
 
 
 # ####################################################################
@@ -293,15 +441,10 @@ def unlocked_blocks(page, user):
 
 
 def _get_columns(key, hierarchy):
-    columns = []
-    for section in hierarchy.get_root().get_descendants():
-        columns += QuestionColumn.all(hierarchy, section, key)
-        columns += PrescriptionColumn.all(hierarchy, section, key)
-        columns += VirtualPatientColumn.all(hierarchy, section, key)
-    return columns
+    return get_columns(hierarchy, key)
 
 
-def _all_results_key(output, hierarchy):
+def _all_results_key(hierarchy):
     """
         A "key" for all questions and answers in the system.
         * One row for short/long text questions
@@ -316,37 +459,40 @@ def _all_results_key(output, hierarchy):
         itemText - identifying text for the item
         answerIdentifier - for single/multiple-choice questions. an answer id
         answerText
+
+        Rows are yielded one at a time so they can be streamed.
     """
-    writer = csv.writer(output)
-    headers = ['itemIdentifier', 'hierarchy', 'exercise type',
-               'itemType', 'itemText', 'answerIdentifier', 'answerText']
-    writer.writerow(headers)
+    yield ['itemIdentifier', 'hierarchy', 'exercise type',
+           'itemType', 'itemText', 'answerIdentifier', 'answerText']
 
     # key to profile choices / values
     # username, e-mail, gender, is_faculty, institution, specialty
     #    hispanic/latino, race, year_of_graduation, consent, % complete
-    writer.writerow(['username', 'profile', '', 'string', 'Username'])
-    writer.writerow(['email', 'profile', '', 'string', 'User E-mail'])
-    choices_key(writer, GENDER_CHOICES, 'gender', 'single_choice')
-    writer.writerow(['faculty', 'profile', '', 'boolean', 'Is Faculty'])
-    choices_key(writer, INSTITUTION_CHOICES, 'institution', 'single_choice')
-    choices_key(writer, SPECIALTY_CHOICES, 'specialty', 'single_choice')
-    choices_key(writer, HISPANIC_LATINO_CHOICES,
-                'hispanic_latino', 'single_choice')
-    choices_key(writer, RACE_CHOICES, 'race', 'single_choice')
-    writer.writerow(['year_of_graduation',
-                     'profile', '', 'number', 'Graduation Year'])
-    writer.writerow(['consent', 'profile', '', 'boolean', 'Has Consented'])
-    writer.writerow(['complete', 'profile', '', 'percent', 'Percent Complete'])
+    yield ['username', 'profile', '', 'string', 'Username']
+    yield ['email', 'profile', '', 'string', 'User E-mail']
+    for row in choices_key(GENDER_CHOICES, 'gender', 'single_choice'):
+        yield row
+    yield ['faculty', 'profile', '', 'boolean', 'Is Faculty']
+    for row in choices_key(INSTITUTION_CHOICES, 'institution',
+                           'single_choice'):
+        yield row
+    for row in choices_key(SPECIALTY_CHOICES, 'specialty', 'single_choice'):
+        yield row
+    for row in choices_key(HISPANIC_LATINO_CHOICES,
+                           'hispanic_latino', 'single_choice'):
+        yield row
+    for row in choices_key(RACE_CHOICES, 'race', 'single_choice'):
+        yield row
+    yield ['year_of_graduation', 'profile', '', 'number', 'Graduation Year']
+    yield ['consent', 'profile', '', 'boolean', 'Has Consented']
+    yield ['complete', 'profile', '', 'percent', 'Percent Complete']
 
     # quizzes, prescription writing, virtual patient keys -- data / values
     for column in _get_columns(True, hierarchy):
-        writer.writerow(column.key_row())
+        yield column.key_row()
 
-    return writer
 
-
-def _all_results(output, hierarchy, include_superusers):
+def _all_results(hierarchy, include_superusers):
     """
     All system results
     * One or more column for each question in system.
@@ -364,37 +510,149 @@ def _all_results(output, hierarchy, include_superusers):
                     ** answer id is listed in each question/answer
                     column the user selected
                 * Unanswered fields represented as an empty cell
-    """
-    writer = csv.writer(output)
 
+    Rows are yielded one at a time so they can be streamed.
+    """
     columns = _get_columns(False, hierarchy)
+    yield _results_header(columns)
+
+    for row in _result_rows(columns, _report_profiles(include_superusers)):
+        yield row
 
+
+def _results_header(columns):
     headers = ['username', 'email', 'gender', 'faculty', 'institution',
                'specialty', 'hispanic_latino', 'race', 'year_of_graduation',
                'consent', 'percent_complete']
     for column in columns:
         headers += [column.identifier()]
-    writer.writerow(headers)
+    return headers
 
-    # Only look at users who have create a profile + consented
-    profiles = UserProfile.objects.filter(consent_participant=True)
-    if not include_superusers:
-        profiles = profiles.filter(user__is_superuser=False)
 
-    for profile in profiles:
+def _result_rows(columns, profiles):
+    """a row for each of the profiles, in user order"""
+    for page in _profile_pages(profiles):
+        for row in _page_rows(columns, page):
+            yield row
+
+
+def _page_rows(columns, page):
+    """the rows for a page of profiles"""
+    if len(page) < 1:
+        return
+
+    _prefetch(columns, [profile.user for profile in page])
+    progress = _progress(page)
+
+    for profile in page:
         row = [profile.user.username, profile.user.email, profile.gender,
                profile.is_role_faculty(), profile.institute,
                profile.specialty, profile.hispanic_latino, profile.race,
                profile.year_of_graduation, profile.has_consented(),
-               profile.percent_complete()]
+               progress.get((profile.user_id, profile.role()), 0)]
 
         for column in columns:
             v = smart_str(column.user_value(profile.user))
             row.append(v)
 
-        writer.writerow(row)
+        yield row
+        _evict(columns, profile.user)
+
+
+def _report_profiles(include_superusers):
+    # Only look at users who have create a profile + consented
+    profiles = UserProfile.objects.filter(
+        consent_participant=True).select_related('user')
+    if not include_superusers:
+        profiles = profiles.filter(user__is_superuser=False)
+    return profiles
+
+
+def _progress(profiles):
+    """percent complete keyed by (user id, hierarchy name)"""
+    rows = UserProgress.objects.filter(
+        user__in=[profile.user_id for profile in profiles]).values_list(
+        'user_id', 'hierarchy__name', 'percent')
+    return dict([((user_id, name), percent)
+                 for (user_id, name, percent) in rows])
+
+
+def _profile_pages(profiles):
+    page = []
+    for profile in profiles.iterator():
+        page.append(profile)
+        if len(page) == REPORT_PAGE_SIZE:
+            yield page
+            page = []
+    if len(page) > 0:
+        yield page
+
+
+def _prefetch(columns, users):
+    """
+    Each column family loads its data for a page of users in a fixed
+    number of queries. user_value is then computed in memory.
+    """
+    for family in (QuestionColumn, PrescriptionColumn, VirtualPatientColumn):
+        family.prefetch(
+            [c for c in columns if isinstance(c, family)], users)
+
+
+def _evict(columns, user):
+    for family in (QuestionColumn, VirtualPatientColumn):
+        family.evict([c for c in columns if isinstance(c, family)], user)
+
+
+class ZipStream(object):
+    """A write-only file object that hands back whatever ZipFile
+    wrote to it since the last drain. It deliberately has no tell()
+    or seek(), so ZipFile writes data descriptors instead of seeking
+    back to patch the local headers."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
 
-    return writer
+
+class Echo(object):
+    """Lets csv.writer format a row without buffering it"""
+
+    def write(self, value):
+        return value
+
+
+def stream_zip(files):
+    """
+    Generate a zip archive chunk by chunk.
+    files is a list of (filename, rows) pairs, rows being an iterable
+    of csv rows. Memory use is bounded by a single row.
+    """
+    stream = ZipStream()
+    writer = csv.writer(Echo())
+    with ZipFile(stream, 'w', ZIP_DEFLATED) as z:
+        for filename, rows in files:
+            with z.open(filename, 'w') as dest:
+                # send the local file header right away
+                yield stream.drain()
+
+                for row in rows:
+                    dest.write(writer.writerow(row).encode('utf-8'))
+                    chunk = stream.drain()
+                    if chunk:
+                        yield chunk
+            yield stream.drain()
+    yield stream.drain()
 
 
 @user_passes_test(lambda u: u.is_superuser)
@@ -403,26 +661,30 @@ def report(request):
         exclusions = ['faculty', 'resources']
         hierarchies = Hierarchy.objects.all().exclude(
             name__in=exclusions).order_by("id")
-        return render(
-            request, 'main/report.html', {'hierarchies': hierarchies})
+        jobs = ReportJob.objects.select_related('hierarchy')[:10]
+        return render(request, 'main/report.html',
+                      {'hierarchies': hierarchies, 'jobs': jobs})
     else:
         hierarchy_id = request.POST.get('hierarchy-id', None)
         hierarchy = Hierarchy.objects.get(id=hierarchy_id)
 
-        include_superusers = request.POST.get('include-superusers', False)
+        include_superusers = bool(
+            request.POST.get('include-superusers', False))
 
-        response = HttpResponse(content_type='application/zip')
-        response['Content-Disposition'] = 'attachment; filename=tobacco.zip'
+        # built by the run_report_jobs worker
+        ReportJob.enqueue(hierarchy, include_superusers, request.user)
+        return HttpResponseRedirect(reverse('report'))
 
-        z = ZipFile(response, 'w')
 
-        output = StringIO()  # temp output file
-        _all_results_key(output, hierarchy)
-        z.writestr("tobacco_%s_key.csv" % hierarchy.name, output.getvalue())
+@user_passes_test(lambda u: u.is_superuser)
+def report_status(request, job_id):
+    job = get_object_or_404(ReportJob, id=job_id)
+    return HttpResponse(dumps(job.as_dict()), 'application/json')
 
-        output.truncate(0)
-        output.seek(0)
-        _all_results(output, hierarchy, include_superusers)
-        z.writestr("tobacco_%s_values.csv" % hierarchy.name, output.getvalue())
 
-        return response
+@user_passes_test(lambda u: u.is_superuser)
+def report_download(request, job_id):
+    job = get_object_or_404(ReportJob, id=job_id,
+                            status=ReportJob.COMPLETE)
+    return FileResponse(job.artifact.open('rb'), as_attachment=True,
+                        filename=job.filename())
@@ -0,0 +1,196 @@
+"""
+Write-coalescing visit tracking.
+
+Recording a visit only writes to the database when something changed: a
+section visited for the first time, a visit that wasn't complete yet, or
+a new location in the hierarchy. Repeat visits just note the time in the
+cache. Those timestamps are written in one bulk update once the oldest is
+FLUSH_INTERVAL seconds old, when the user logs out, or before anything
+reads last_visit. Users who just leave are caught by the flush_visits
+command, run from cron, which drains every buffer.
+
+A repeat visit costs a cache get and set, no locks. Two requests for
+the same user racing to merge their timestamps may lose one of them,
+which is only a slightly older last_visit. The index of users with a
+buffer is changed under a lock taken with cache.add, only when a buffer
+is started; a request that can't get it writes straight through.
+"""
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django.utils import timezone
+
+
+FLUSH_INTERVAL = 60
+PENDING_TIMEOUT = 60 * 60 * 24
+LOCK_TIMEOUT = 10
+
+INDEX_KEY = "main.visits.pending"  # user id -> when their buffer began
+
+
+def _pending_key(user_id):
+    return "main.visits.%d.pending" % user_id
+
+
+def _locations_key(user_id):
+    return "main.visits.%d.locations" % user_id
+
+
+def record(user, sections):
+    """mark the sections complete for the user and move their location"""
+    from pagetree.models import UserPageVisit
+    from tobaccocessation.main.models import UserProgress
+
+    sections = list(sections)
+    if len(sections) < 1:
+        return
+
+    visits = {}
+    for (section_id, visit_id, status) in UserPageVisit.objects.filter(
+            user=user, section__in=sections).values_list(
+            'section_id', 'id', 'status'):
+        visits[section_id] = (visit_id, status)
+
+    now = timezone.now()
+    new = [s for s in sections if s.id not in visits]
+    incomplete = [visit_id for (visit_id, status) in visits.values()
+                  if status != "complete"]
+    repeated = [visit_id for (visit_id, status) in visits.values()
+                if status == "complete"]
+
+    if len(new) > 0:
+        # a concurrent request may have created some of these already
+        UserPageVisit.objects.bulk_create(
+            [UserPageVisit(user=user, section=s, status="complete")
+             for s in new], ignore_conflicts=True)
+        hierarchies = dict([(s.hierarchy_id, s.hierarchy) for s in new])
+        for hierarchy in hierarchies.values():
+            UserProgress.recount(user.id, hierarchy)
+
+    if len(incomplete) > 0:
+        UserPageVisit.objects.filter(id__in=incomplete).update(
+            status="complete", last_visit=now)
+
+    if len(repeated) > 0:
+        _buffer(user.id, repeated, now)
+
+    # the user ends up at the last section given in each hierarchy
+    _locate(user, dict([(s.hierarchy_id, s) for s in sections]))
+
+
+@contextmanager
+def _locked(key):
+    """Hold the lock on a cache key. Yields False, without waiting, if
+    another process holds it."""
+    lock = "%s.lock" % key
+    acquired = cache.add(lock, True, LOCK_TIMEOUT)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cache.delete(lock)
+
+
+def _buffer(user_id, visit_ids, now):
+    key = _pending_key(user_id)
+    pending = cache.get(key)
+    if pending is None:
+        if not _track(user_id, now):
+            # flush_pending has the index, don't wait for it
+            _write(dict([(visit_id, now) for visit_id in visit_ids]))
+            return
+        pending = {'since': now, 'visits': {}}
+
+    for visit_id in visit_ids:
+        pending['visits'][visit_id] = now
+
+    if (now - pending['since']).total_seconds() >= FLUSH_INTERVAL:
+        cache.delete(key)
+        _write(pending['visits'])
+    else:
+        cache.set(key, pending, PENDING_TIMEOUT)
+
+
+def _track(user_id, now):
+    """add the user to the index flush_pending drains"""
+    with _locked(INDEX_KEY) as locked:
+        if locked:
+            users = cache.get(INDEX_KEY) or {}
+            users[user_id] = now
+            cache.set(INDEX_KEY, users, None)
+        return locked
+
+
+def _write(last_visits):
+    from pagetree.models import UserPageVisit
+
+    UserPageVisit.objects.bulk_update(
+        [UserPageVisit(id=visit_id, last_visit=last_visit)
+         for (visit_id, last_visit) in last_visits.items()],
+        ['last_visit'], batch_size=500)
+
+
+def _locate(user, sections):
+    """sections maps hierarchy id -> the section the user is now at"""
+    from pagetree.models import UserLocation
+
+    key = _locations_key(user.id)
+    locations = cache.get(key) or {}
+
+    changed = False
+    for (hierarchy_id, section) in sections.items():
+        path = section.get_absolute_url()
+        if locations.get(hierarchy_id) == path:
+            continue
+
+        UserLocation.objects.update_or_create(
+            user=user, hierarchy_id=hierarchy_id, defaults={'path': path})
+        locations[hierarchy_id] = path
+        changed = True
+
+    if changed:
+        cache.set(key, locations, PENDING_TIMEOUT)
+
+
+def flush(user_id):
+    """Write the user's buffered last_visit timestamps. Returns False if
+    there weren't any."""
+    key = _pending_key(user_id)
+    pending = cache.get(key)
+    if pending is None:
+        return False
+
+    cache.delete(key)
+    _write(pending['visits'])
+    return True
+
+
+def flush_pending():
+    """Write every user's buffered timestamps, returning how many users
+    were flushed"""
+    started = timezone.now()
+    flushed = 0
+    idle = []
+    for user_id in cache.get(INDEX_KEY) or {}:
+        if flush(user_id):
+            flushed += 1
+        else:
+            idle.append(user_id)
+
+    # Users stay in the index until a run finds nothing to flush, in
+    # case a request was merging into a buffer as it was flushed
+    with _locked(INDEX_KEY) as locked:
+        if locked:
+            users = cache.get(INDEX_KEY) or {}
+            for user_id in idle:
+                # unless a request started a new buffer since
+                if users.get(user_id, started) < started:
+                    del users[user_id]
+            cache.set(INDEX_KEY, users, None)
+    return flushed
+
+
+def forget(user_id):
+    """drop anything buffered for the user, e.g. when their state is
+    cleared"""
+    cache.delete_many([_pending_key(user_id), _locations_key(user_id)])
@@ -1,6 +1,8 @@
 # Django settings for tobaccocessation project.
 import os.path
+import sys
 from ccnmtlsettings.shared import common
+from tobaccocessation.main.navigation import clear_section_caches
 
 project = 'tobaccocessation'
 base = os.path.dirname(__file__)
@@ -34,6 +36,8 @@ INSTALLED_APPS += [  # noqa
 ]
 
 # Pageblocks/Pagetree settings
+PAGETREE_CUSTOM_CACHE_CLEAR = clear_section_caches
+
 PAGEBLOCKS = [
     'pageblocks.HTMLBlockWYSIWYG',
     'pageblocks.HTMLBlock',
@@ -48,3 +52,25 @@ LOGOUT_REDIRECT_URL = LOGIN_REDIRECT_URL = '/'
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 SESSION_SAVE_EVERY_REQUEST = True
 SESSION_COOKIE_AGE = 3600
+
+# The navigation indexes, virtual patient catalog, report columns and
+# rendered nav fragments are checked against version tokens in the
+# cache, and visits are buffered there. Every process - web servers, the
+# run_report_jobs worker, cron - has to see the same cache, and reading
+# it mustn't cost a query, so it is memcached. Deployments with their
+# server elsewhere set CACHES in local_settings.
+if 'test' not in sys.argv and 'jenkins' not in sys.argv:
+    CACHES = {
+        'default': {
+            'BACKEND':
+            'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': '127.0.0.1:11211',
+            'KEY_PREFIX': 'tobaccocessation',
+        }
+    }
+
+# Keep virtual patient state in normalized tables rather than json.
+# See activity_virtual_patient.models.state_tables
+# One way: once on, saved states no longer keep their patients in the
+# json. Turning it back off drops every patient written in the meantime.
+VIRTUAL_PATIENT_STATE_TABLES = False